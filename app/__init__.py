@@ -7,7 +7,7 @@ import os
 
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from flask_httpauth import HTTPBasicAuth
+from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth, MultiAuth
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 logging.basicConfig(level=logging.DEBUG)
@@ -21,6 +21,11 @@ app.wsgi_app = ProxyFix(
 )
 
 auth = HTTPBasicAuth()
+# API keys, passed as 'Authorization: Bearer <api key>'
+token_auth = HTTPTokenAuth(scheme="Bearer")
+multi_auth = MultiAuth(auth, token_auth)
 db_users = SQLAlchemy(app)
 
-from app import views
+# The metrics and the profiler are imported first, so that their
+# after_request handlers are called last and include the other handlers
+from app import metrics, profiler, views, errors, compression
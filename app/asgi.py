@@ -0,0 +1,313 @@
+"""ASGI entry point
+
+An alternative to the uwsgi setup of main.py, that serves the API on an
+event loop, so that a worker holds many slow clients at once. Run it with an
+ASGI server, for example:
+
+    uvicorn app.asgi:application --workers 4
+
+The collection items and the single features are served by coroutines. The
+cjdb Exporter only works with a psycopg2 connection, so the features are
+exported in a bounded pool of ASGI_THREADS threads, with the connections of
+``app.views.backend``. The other blocking work of a request, the BBOX
+queries, the serialization, the compression and the rate limit, also runs in
+the threads, so that a large page does not stall the event loop. The
+threads are only taken for this work, not while a response is sent to a
+slow client. The other routes are served by the Flask app in the same
+threads.
+
+Thus the number of requests that a worker exports at once is still limited
+by ASGI_THREADS and the DB pool, only the slow clients are not. Serving
+more exports at once needs an exporter that runs on an async DB driver.
+
+The indexes, the caches, the parameter validation and the documents are the
+ones of the Flask app in app/views.py, which is loaded at import.
+
+Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
+"""
+
+import asyncio
+import contextvars
+import io
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
+
+from flask import Response, abort, g, request
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from app import (app, caching, compression, loading, metrics, profiler,
+                 ratelimit, views)
+from app.parameters import Parameters, feature_parameters, items_parameters
+
+# Threads that export the features and serve the other routes. Each of them
+# can take a connection from the pool of app.views.backend.
+ASGI_THREADS = int(os.environ.get("ASGI_THREADS",
+                                  os.environ.get("POSTGRES_POOL_MAX", 4)))
+
+executor = ThreadPoolExecutor(max_workers=ASGI_THREADS,
+                              thread_name_prefix="asgi")
+
+
+async def run_sync(func, *args):
+    """Run a blocking function in the :data:`executor`, in the context of
+    the request, so that it can use :data:`flask.g` and the stages of
+    :mod:`app.profiler`."""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, context.run, func, *args)
+
+
+def bbox_indexed() -> bool:
+    bbox_index = views.bbox_cache.bbox_index
+    return bbox_index is not None and bbox_index.loaded
+
+
+def items_page(query_params: Parameters) -> Tuple[dict, Tuple[str]]:
+    """:func:`app.views.items_page`, with a DB connection only if the
+    in-memory index cannot answer the BBOX query."""
+    if not query_params.bbox or bbox_indexed():
+        return views.items_page(None, query_params)
+    with views.backend.connection() as conn:
+        return views.items_page(conn, query_params)
+
+
+def add_features(feature_collection: dict, page: Tuple[str], crs: str):
+    with views.backend.connection() as conn:
+        loading.add_features(feature_collection, page, conn, raw=True,
+                             crs=crs)
+
+
+def load_feature(feature_id: str) -> Tuple[dict, dict]:
+    with views.backend.connection() as conn:
+        return loading.load_cityjsonfeature(feature_id, conn)
+
+
+async def pand_items():
+    query_params = items_parameters(request.args)
+    if query_params.resulttype == "hits":
+        return await run_sync(views.pand_items_hits, query_params)
+    feature_collection, page = await run_sync(items_page, query_params)
+    if not query_params.stream:
+        await run_sync(add_features, feature_collection, page,
+                       query_params.crs)
+    return await run_sync(views.items_response, feature_collection, page,
+                          query_params)
+
+
+async def get_feature(featureId):
+    logging.debug(f"Requesting {featureId}")
+    query_params = feature_parameters(request.args)
+    try:
+        metadata, cityjsonfeature = await run_sync(load_feature, featureId)
+    except KeyError:
+        abort(404)
+    g.number_returned = 1
+    return await run_sync(views.feature_response, metadata, cityjsonfeature,
+                          query_params.crs)
+
+
+# The views that are served by coroutines, by endpoint
+ASYNC_VIEWS = {
+    "pand_items": pand_items,
+    "get_feature": get_feature,
+}
+# The validation of the requests of the async views, see
+# :func:`app.caching.conditional`
+VALIDATORS = {
+    "pand_items": views.validate_items,
+    "get_feature": views.validate_feature,
+}
+
+
+async def call_view(view, view_args: dict) -> Response:
+    """Call an async view with the rate limit, the conditional requests and
+    the compressed responses of the Flask views, see
+    :func:`app.ratelimit.limited`, :func:`app.caching.conditional` and
+    :func:`app.compression.precompressed`, the Server-Timing header of
+    :mod:`app.profiler` and the :mod:`app.metrics`."""
+    g.request_started = time.perf_counter()
+    # The rate limiter waits for the lock of the file of the counters
+    client = await run_sync(ratelimit.admit)
+    VALIDATORS[request.endpoint](**view_args)
+    etag = g.etag = caching.make_etag()
+    cache_control = caching.cache_control_policy(request.endpoint)
+    if caching.is_fresh(etag):
+        response = caching.set_cache_headers(Response(status=304), etag,
+                                             cache_control)
+    else:
+        response = None
+        encoding = compression.negotiate(request.accept_encodings)
+        if encoding is not None:
+            response = compression.stored_response(etag, encoding)
+        if response is None:
+            response = await run_sync(compressed_response,
+                                      await view(**view_args))
+        if response.status_code == 200:
+            caching.set_cache_headers(response, etag, cache_control)
+    if client is not None:
+        response = await run_sync(ratelimit.charge, client, response)
+    return metrics.record(profiler.server_timing(response))
+
+
+def compressed_response(rv) -> Response:
+    """The compressed response of the return value of a view."""
+    return compression.compress_response(app.make_response(rv), lookup=False)
+
+
+def error_response(e: Exception) -> Response:
+    """The response of the error handlers of the Flask app. Must be called
+    while the exception is handled."""
+    try:
+        return app.make_response(app.handle_user_exception(e))
+    except Exception as unhandled:
+        return app.make_response(app.handle_exception(unhandled))
+
+
+def wsgi_environ(scope: dict, body: bytes = b"") -> dict:
+    """The WSGI environ of an ASGI HTTP request."""
+    path = scope["path"]
+    root_path = scope.get("root_path", "")
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": root_path.encode("utf-8").decode("latin-1"),
+        "PATH_INFO": path.encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": str(server[0]),
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = f"HTTP_{name}"
+        if name in environ:
+            value = f"{environ[name]},{value}"
+        environ[name] = value
+    return environ
+
+
+def _proxy_fixed(environ, start_response):
+    return environ
+
+
+# Rewrites the environ of the async views like the ProxyFix of the Flask app
+if isinstance(app.wsgi_app, ProxyFix):
+    fix_environ = ProxyFix(
+        _proxy_fixed, x_for=app.wsgi_app.x_for, x_proto=app.wsgi_app.x_proto,
+        x_host=app.wsgi_app.x_host, x_port=app.wsgi_app.x_port,
+        x_prefix=app.wsgi_app.x_prefix)
+else:
+    fix_environ = _proxy_fixed
+
+
+def call_wsgi(environ: dict) -> Tuple[int, list, bytes]:
+    """Serve a request with the Flask app, in a thread."""
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [int(status.split(" ", 1)[0]), headers]
+
+    result = app(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return started[0], started[1], body
+
+
+async def read_body(receive) -> bytes:
+    body = []
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            break
+        body.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    return b"".join(body)
+
+
+def encode_headers(headers) -> list:
+    return [(name.lower().encode("latin-1"), value.encode("latin-1"))
+            for name, value in headers]
+
+
+async def send_response(send, response: Response, head: bool = False):
+    """Send a Flask response. The chunks of a streamed response are
+    produced in the :data:`executor`, because they are loaded from the
+    DB."""
+    await send({"type": "http.response.start",
+                "status": response.status_code,
+                "headers": encode_headers(response.headers.items())})
+    if head or not response.is_streamed:
+        body = b"" if head else response.get_data()
+        response.close()
+        await send({"type": "http.response.body", "body": body})
+        return
+    chunks = iter(response.response)
+    try:
+        while True:
+            chunk = await run_sync(next, chunks, None)
+            if chunk is None:
+                break
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk,
+                            "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        response.close()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    """The ASGI application."""
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        raise NotImplementedError(f"Unsupported scope {scope['type']}")
+    environ = wsgi_environ(scope, await read_body(receive))
+    head = scope["method"] == "HEAD"
+    with app.request_context(fix_environ(dict(environ), None)):
+        view = ASYNC_VIEWS.get(request.endpoint) \
+            if request.routing_exception is None else None
+        if view is not None:
+            try:
+                response = await call_view(view, request.view_args)
+            except Exception as e:
+                response = error_response(e)
+            await send_response(send, response, head)
+            return
+    status, headers, body = await run_sync(call_wsgi, environ)
+    await send({"type": "http.response.start", "status": status,
+                "headers": encode_headers(headers)})
+    await send({"type": "http.response.body", "body": body})
@@ -2,11 +2,33 @@
 Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
 """
 
-from app import db_users, auth
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from app import db_users, auth, token_auth
 from enum import Enum
 from werkzeug.security import check_password_hash, generate_password_hash
 from flask import g
 
+# The key of the hashes of the API keys. Without it, a leaked copy of the
+# user DB is enough to verify guessed keys.
+API_KEY_SECRET = os.environ.get("API_KEY_SECRET", "")
+if API_KEY_SECRET == "":
+    logging.warning("API_KEY_SECRET is not set, the API keys are hashed "
+                    "without a key.")
+# Seconds that a verified credential is trusted without checking the DB
+AUTH_CACHE_TTL = float(os.environ.get("AUTH_CACHE_TTL", 60))
+# Seconds that an API key that is not in the DB is not looked up again
+AUTH_NEGATIVE_TTL = float(os.environ.get("AUTH_NEGATIVE_TTL", 5))
+
 
 class Permission(Enum):
     USER = 1
@@ -51,18 +73,242 @@ class UserAuth(db_users.Model):
         return self.role
 
 
+class ApiKey(db_users.Model):
+    __tablename__ = "apikey"
+
+    id = db_users.Column(db_users.Integer, primary_key=True)
+    # HMAC-SHA256 of the API key, see hash_api_key
+    key_hash = db_users.Column(db_users.String(64),
+                               unique=True,
+                               nullable=False)
+    user_id = db_users.Column(db_users.Integer,
+                              db_users.ForeignKey("userauth.id"),
+                              nullable=False)
+    user = db_users.relationship("UserAuth")
+
+    def __repr__(self):
+        return '<ApiKey of %r>' % self.user_id
+
+
+@dataclass(frozen=True)
+class AuthenticatedUser:
+    """A verified user. Unlike a :class:`UserAuth`, it is not bound to a DB
+    session, so it can be kept between requests."""
+    username: str
+    role: Permission
+
+    def get_roles(self):
+        return self.role
+
+
+def hash_api_key(api_key: str) -> str:
+    """The keyed hash of an API key, that is stored instead of the key.
+
+    The API keys are long random strings, so they do not need a slow hash
+    like the passwords.
+    """
+    return hmac.new(API_KEY_SECRET.encode("utf-8"), api_key.encode("utf-8"),
+                    hashlib.sha256).hexdigest()
+
+
+def generate_api_key(user: UserAuth) -> str:
+    """Create a new API key for the `user`. Only its hash is stored, the key
+    cannot be retrieved later."""
+    api_key = secrets.token_urlsafe(32)
+    db_users.session.add(ApiKey(key_hash=hash_api_key(api_key),
+                                user_id=user.id))
+    db_users.session.commit()
+    return api_key
+
+
+class ApiKeyIndex:
+    """The API keys, by their hash.
+
+    A key is verified with a dict lookup of its hash. All the keys are
+    loaded from the DB on the first lookup, and again on a lookup that is
+    more than `ttl` seconds after the last load. A key that is not in the
+    index is looked up in the DB on its own, so that the keys that were
+    created by another worker are valid at once. The keys that are not in
+    the DB either are remembered for `negative_ttl` seconds, at most
+    `max_unknown` of them, so that invalid keys do not query the DB on every
+    request. The DB is queried without holding the lock, so the lookups do
+    not wait for a reload.
+    """
+
+    def __init__(self, ttl: float = AUTH_CACHE_TTL,
+                 negative_ttl: float = AUTH_NEGATIVE_TTL,
+                 max_unknown: int = 10000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_unknown = max_unknown
+        self._users = None
+        self._loaded_at = 0.0
+        self._loading = False
+        self._unknown = OrderedDict()
+        self._lock = threading.Lock()
+
+    def query(self, key_hash: Optional[str] = None) \
+            -> Dict[str, AuthenticatedUser]:
+        """The users of all the keys, or of the key with the `key_hash`,
+        from the DB."""
+        query = db_users.session.query(
+            ApiKey.key_hash, UserAuth.username, UserAuth.role).join(
+            UserAuth, ApiKey.user_id == UserAuth.id)
+        if key_hash is not None:
+            query = query.filter(ApiKey.key_hash == key_hash)
+        return {key_hash: AuthenticatedUser(username, role)
+                for key_hash, username, role in query.all()}
+
+    def load(self) -> Dict[str, AuthenticatedUser]:
+        users = self.query()
+        with self._lock:
+            self._users = users
+            self._loaded_at = time.monotonic()
+            self._unknown.clear()
+        logging.debug(f"Loaded {len(users)} API keys.")
+        return users
+
+    def _current(self) -> Dict[str, AuthenticatedUser]:
+        """The index, which is reloaded if it expired. While one thread
+        reloads it, the others use the expired index."""
+        with self._lock:
+            users = self._users
+            expired = users is None or \
+                time.monotonic() - self._loaded_at > self.ttl
+            if not expired or (self._loading and users is not None):
+                return users
+            self._loading = True
+        try:
+            return self.load()
+        finally:
+            with self._lock:
+                self._loading = False
+
+    def get(self, api_key: str) -> Optional[AuthenticatedUser]:
+        key_hash = hash_api_key(api_key)
+        user = self._current().get(key_hash)
+        if user is not None:
+            return user
+        with self._lock:
+            unknown_until = self._unknown.get(key_hash)
+        if unknown_until is not None and time.monotonic() < unknown_until:
+            return None
+        user = self.query(key_hash).get(key_hash)
+        with self._lock:
+            if user is not None:
+                if self._users is not None:
+                    self._users[key_hash] = user
+            else:
+                self._unknown.pop(key_hash, None)
+                self._unknown[key_hash] = \
+                    time.monotonic() + self.negative_ttl
+                while len(self._unknown) > self.max_unknown:
+                    self._unknown.popitem(last=False)
+        return user
+
+    def clear(self):
+        with self._lock:
+            self._users = None
+            self._unknown.clear()
+
+
+class CredentialCache:
+    """The recently verified Basic-auth credentials.
+
+    Keeps a keyed hash of the password of each user that was verified in
+    the last `ttl` seconds, so that the slow password hash is not checked on
+    every request. The hash key is random, and is not shared with other
+    processes. At most `max_entries` users are kept.
+    """
+
+    def __init__(self, ttl: float = AUTH_CACHE_TTL, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._key = os.urandom(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _digest(self, password: str) -> bytes:
+        return hmac.new(self._key, password.encode("utf-8"),
+                        hashlib.sha256).digest()
+
+    def get(self, username: str, password: str) \
+            -> Optional[AuthenticatedUser]:
+        with self._lock:
+            entry = self._entries.get(username)
+        if entry is None or time.monotonic() > entry[1]:
+            return None
+        if not hmac.compare_digest(entry[0], self._digest(password)):
+            return None
+        return entry[2]
+
+    def add(self, username: str, password: str, user: AuthenticatedUser):
+        entry = (self._digest(password), time.monotonic() + self.ttl, user)
+        with self._lock:
+            self._entries.pop(username, None)
+            self._entries[username] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+api_keys = ApiKeyIndex()
+credential_cache = CredentialCache()
+
+
+def invalidate_credentials():
+    """Forget the verified credentials of this worker, after the users
+    changed. The other workers forget them after AUTH_CACHE_TTL seconds, new
+    API keys are valid in all the workers at once."""
+    api_keys.clear()
+    credential_cache.clear()
+
+
 @auth.get_user_roles
+@token_auth.get_user_roles
 def get_user_roles(user):
     return user.get_roles()
 
 
-@auth.verify_password
-def verify_password(username, password):
+def check_password(username: str, password: str) \
+        -> Optional[AuthenticatedUser]:
+    """The user of the Basic-auth credentials, or None if they are not
+    valid. Does not change the request, unlike :func:`verify_password`."""
     if username == "":
         return None
+    user = credential_cache.get(username, password)
+    if user is not None:
+        return user
     existing_user = UserAuth.query.filter_by(username=username).first()
-    if not existing_user:
+    if not existing_user or not existing_user.verify_password(password):
         return None
-    g.current_user = username
-    if existing_user.verify_password(password):
-        return existing_user
+    user = AuthenticatedUser(existing_user.username, existing_user.role)
+    credential_cache.add(username, password, user)
+    return user
+
+
+def check_token(token: str) -> Optional[AuthenticatedUser]:
+    """The user of the API key, or None if it is not valid."""
+    return api_keys.get(token)
+
+
+@auth.verify_password
+def verify_password(username, password):
+    user = check_password(username, password)
+    if user is not None:
+        g.current_user = user.username
+    return user
+
+
+@token_auth.verify_token
+def verify_token(token):
+    user = check_token(token)
+    if user is not None:
+        g.current_user = user.username
+    return user
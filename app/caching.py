@@ -0,0 +1,217 @@
+"""HTTP caching
+
+Validators and Cache-Control policies for the responses. The data only
+changes with a new version of the dataset, so the validators are derived
+from the dataset version and the request, without loading any data.
+
+Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
+"""
+
+import hashlib
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import partial, wraps
+from typing import Callable, Optional
+
+from flask import Response, g, make_response, request
+
+# The version of the 3DBAG that is served
+DATASET_VERSION = os.environ.get("DATASET_VERSION", "v2023.10.08")
+
+# The Cache-Control header of the responses of each route, by endpoint name.
+# It can be set with the environment variable CACHE_CONTROL_<ENDPOINT>, for
+# example CACHE_CONTROL_GET_FEATURE. An empty value disables the header.
+DEFAULT_CACHE_CONTROL = {
+    "pand_items": "public, max-age=86400",
+    "get_feature": "public, max-age=86400",
+    "landing_page": "public, max-age=3600",
+    "api": "public, max-age=3600",
+    "api_html": "public, max-age=3600",
+    "conformance": "public, max-age=3600",
+    "collections": "public, max-age=3600",
+    "pand": "public, max-age=3600",
+}
+
+
+def dataset_last_modified(version: str) -> Optional[datetime]:
+    """The release date of the dataset version, as 'vYYYY.MM.DD'."""
+    match = re.fullmatch(r"v(\d{4})\.(\d{2})\.(\d{2})", version)
+    if match is None:
+        logging.warning(f"Cannot derive a date from the dataset version "
+                        f"{version}, responses have no Last-Modified.")
+        return None
+    return datetime(*map(int, match.groups()), tzinfo=timezone.utc)
+
+
+LAST_MODIFIED = dataset_last_modified(DATASET_VERSION)
+
+
+def cache_control_policy(endpoint: str) -> Optional[str]:
+    """The Cache-Control header of the `endpoint`, or None."""
+    policy = os.environ.get(f"CACHE_CONTROL_{endpoint.upper()}",
+                            DEFAULT_CACHE_CONTROL.get(endpoint))
+    return policy or None
+
+
+def make_etag(version: str = DATASET_VERSION) -> str:
+    """The entity tag of the response to the current request.
+
+    The response only depends on the dataset version, the URL without the
+    query (which includes the host and the prefix of the links) and the
+    query parameters, in any order.
+    """
+    h = hashlib.sha1(version.encode("utf-8"))
+    h.update(request.base_url.encode("utf-8"))
+    for key, value in sorted(request.args.items(multi=True)):
+        h.update(f"\0{key}={value}".encode("utf-8"))
+    return h.hexdigest()
+
+
+def set_cache_headers(response: Response, etag: str,
+                      cache_control: Optional[str],
+                      weak: bool = True) -> Response:
+    response.set_etag(etag, weak=weak)
+    if weak and LAST_MODIFIED is not None:
+        response.last_modified = LAST_MODIFIED
+    if cache_control is not None:
+        response.headers["Cache-Control"] = cache_control
+    return response
+
+
+def matching_etag(etag: str) -> Optional[str]:
+    """The entity tag in the If-None-Match header of the request that
+    matches the `etag`, or None.
+
+    The compressed responses have the encoding added to a strong ETag, see
+    :func:`app.compression.encode_etag`, so the tags of all the encodings of
+    the response match.
+    """
+    if request.if_none_match.star_tag:
+        return etag
+    for tag in request.if_none_match.as_set(include_weak=True):
+        if tag == etag or tag.startswith(f"{etag}-"):
+            return tag
+    return None
+
+
+def is_fresh(etag: str) -> bool:
+    """Whether the client has the current response, from the If-None-Match
+    or, without it, the If-Modified-Since header of the request."""
+    if request.if_none_match:
+        return matching_etag(etag) is not None
+    if request.if_modified_since is not None and LAST_MODIFIED is not None:
+        return request.if_modified_since >= LAST_MODIFIED
+    return False
+
+
+def conditional(view=None, *, validate: Optional[Callable] = None):
+    """Make a GET view answer conditional requests.
+
+    The validators are checked before the view is called, so a client that
+    has the current response gets a 304 without any DB work. Successful
+    responses get the ETag, Last-Modified and the Cache-Control policy of
+    the route, see :data:`DEFAULT_CACHE_CONTROL`. The ETag of the request
+    is set on :data:`flask.g` for the view.
+
+    `validate` is called with the arguments of the view before the
+    validators are checked. It aborts the requests that the view would not
+    answer with a 200, for example the ones with invalid parameters, so
+    that they do not get a 304 either.
+    """
+    if view is None:
+        return partial(conditional, validate=validate)
+    cache_control = cache_control_policy(view.__name__)
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if validate is not None:
+            validate(*args, **kwargs)
+        etag = g.etag = make_etag()
+        if is_fresh(etag):
+            return set_cache_headers(Response(status=304), etag,
+                                     cache_control)
+        response = make_response(view(*args, **kwargs))
+        if response.status_code == 200:
+            set_cache_headers(response, etag, cache_control)
+        return response
+    return wrapper
+
+
+class StaticDocuments:
+    """The serialized documents of the static routes.
+
+    Keyed by the URL of the request without the query, because the links in
+    the documents depend on the host and the prefix of the request. Holds
+    at most `max_entries` documents, the least recently used ones are
+    evicted, so that requests with arbitrary Host headers cannot fill the
+    memory.
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> Optional[tuple]:
+        """The (body, headers, ETag) of the document, or None."""
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+            return entry
+
+    def add(self, url: str, body: bytes, headers: dict) -> tuple:
+        entry = (body, headers, hashlib.sha1(body).hexdigest())
+        with self._lock:
+            self._entries[url] = entry
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+static_documents = StaticDocuments()
+
+
+def static(view):
+    """Render the document of a GET view without parameters once.
+
+    The serialized document is kept in :data:`static_documents`, and it is
+    served with a strong ETag of its content, without calling the view
+    again. The ETag is set on :data:`flask.g`, so that the compressed
+    responses are kept too, see :func:`app.compression.compress_response`.
+    A 304 has the tag that the client sent, which can be the ETag of a
+    compressed response.
+    """
+    cache_control = cache_control_policy(view.__name__)
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        entry = static_documents.get(request.base_url)
+        if entry is None:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            entry = static_documents.add(
+                request.base_url, response.get_data(),
+                {"Content-Type": response.headers["Content-Type"]})
+        body, headers, etag = entry
+        g.etag = etag
+        matched = matching_etag(etag)
+        if matched is not None:
+            return set_cache_headers(Response(status=304), matched,
+                                     cache_control, weak=False)
+        return set_cache_headers(Response(body, headers=headers), etag,
+                                 cache_control, weak=False)
+    return wrapper
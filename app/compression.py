@@ -0,0 +1,277 @@
+"""Response compression
+
+Compresses the responses with the best encoding that the client accepts,
+out of zstd, br and gzip. The zstd and br encodings are used if the
+zstandard and brotli packages are installed. The compressed responses of
+the popular features and pages are kept, so that they are compressed only
+once.
+
+Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
+"""
+
+import logging
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from functools import wraps
+from typing import Iterable, Iterator, Optional
+
+from flask import Response, g, make_response, request
+
+from app import app
+from app.profiler import stage
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Encodings in the order of preference, when the client accepts several of
+# them with the same quality
+ENCODINGS = tuple(e for e, available in (("zstd", zstandard is not None),
+                                         ("br", brotli is not None),
+                                         ("gzip", True)) if available)
+# Responses smaller than this are not compressed, in bytes
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", 1024))
+COMPRESSIBLE_MIMETYPES = ("application/json", "application/city+json",
+                          "application/geo+json", "application/x-yaml",
+                          "text/html")
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+ZSTD_LEVEL = 3
+
+
+def negotiate(accept_encodings) -> Optional[str]:
+    """The best of the :data:`ENCODINGS` in the Accept-Encoding of the
+    client, or None if it accepts none of them."""
+    best, best_quality = None, 0
+    for encoding in ENCODINGS:
+        quality = accept_encodings.quality(encoding)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "gzip":
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    raise ValueError(f"Unsupported encoding {encoding}")
+
+
+def compress_stream(chunks: Iterable, encoding: str) -> Iterator[bytes]:
+    """Compress a streamed response. The compressor is flushed after each
+    chunk, so that the client receives each chunk as soon as it is
+    produced."""
+    if encoding == "gzip":
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        process = compressor.compress
+
+        def flush():
+            return compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        def finish():
+            return compressor.flush()
+    elif encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        process = compressor.process
+        flush, finish = compressor.flush, compressor.finish
+    elif encoding == "zstd":
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        process = compressor.compress
+
+        def flush():
+            return compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+        def finish():
+            return compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+    else:
+        raise ValueError(f"Unsupported encoding {encoding}")
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        out = process(chunk) + flush()
+        if out:
+            yield out
+    yield finish()
+
+
+def is_compressible(response: Response) -> bool:
+    return (response.status_code == 200
+            and "Content-Encoding" not in response.headers
+            and response.mimetype in COMPRESSIBLE_MIMETYPES)
+
+
+def encode_etag(response: Response, encoding: str):
+    """Add the `encoding` to the strong ETag of the compressed `response`.
+
+    A strong ETag promises the same bytes, which a compressed body is not,
+    so each encoding gets its own tag, like "<sha1>-gzip". Weak ETags are
+    kept, the compressed response is equivalent to the uncompressed one.
+    """
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(f"{etag}-{encoding}")
+
+
+class CompressedStore:
+    """The compressed bodies of the recently requested responses.
+
+    Keyed by the ETag of a response and the encoding. Next to the body and
+    the headers, an `info` dict is kept with the values that the view set on
+    :data:`flask.g`. When the size of the stored bodies exceeds `max_bytes`,
+    the least recently used ones are evicted. The store can be shared by the
+    threads of a worker.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, etag: str, encoding: str) -> Optional[tuple]:
+        """The (body, headers, info) of the response, or None."""
+        with self._lock:
+            entry = self._entries.get((etag, encoding))
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((etag, encoding))
+            self.hits += 1
+            return entry
+
+    def add(self, etag: str, encoding: str, body: bytes, headers: dict,
+            info: Optional[dict] = None):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop((etag, encoding), None)
+            if old is not None:
+                self.nbytes -= len(old[0])
+            self._entries[(etag, encoding)] = (body, headers, info or {})
+            self.nbytes += len(body)
+            while self.nbytes > self.max_bytes:
+                _, (evicted, _, _) = self._entries.popitem(last=False)
+                self.nbytes -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "nbytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+compressed_store = CompressedStore(
+    max_bytes=int(os.environ.get("COMPRESSED_CACHE_MB", 64)) * 1024 * 1024)
+
+
+def stored_response(etag: str, encoding: str) -> Optional[Response]:
+    """The response of the `etag` in the `encoding` from the
+    :data:`compressed_store`, or None. The values that the view set on
+    :data:`flask.g` are restored."""
+    stored = compressed_store.get(etag, encoding)
+    if stored is None:
+        return None
+    for name, value in stored[2].items():
+        g.setdefault(name, value)
+    return Response(stored[0], headers=stored[1])
+
+
+def precompressed(view):
+    """Keep the compressed responses of a GET view in the
+    :data:`compressed_store`.
+
+    Must be applied below :func:`app.caching.conditional`, which sets the
+    ETag of the request. A stored response is returned without calling the
+    view. Streamed responses are not stored. The view can set the number of
+    returned features in ``g.number_returned``, it is restored with the
+    stored response, together with the uncompressed ``g.content_length``.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        etag = g.get("etag")
+        encoding = negotiate(request.accept_encodings)
+        if etag is not None and encoding is not None:
+            response = stored_response(etag, encoding)
+            if response is not None:
+                return response
+        return compress_response(make_response(view(*args, **kwargs)),
+                                 lookup=False)
+    return wrapper
+
+
+@app.after_request
+def compress_response(response: Response, lookup: bool = True) -> Response:
+    """Compress the responses that are not compressed yet.
+
+    If the request has an ETag on :data:`flask.g`, the compressed response
+    is kept in the :data:`compressed_store`, and if `lookup` is True, it is
+    taken from the store, see :func:`precompressed`. A strong ETag gets the
+    encoding, see :func:`encode_etag`.
+    """
+    response.vary.add("Accept-Encoding")
+    if not is_compressible(response):
+        return response
+    encoding = negotiate(request.accept_encodings)
+    if encoding is None:
+        return response
+    etag = g.get("etag")
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+        response.headers["Content-Encoding"] = encoding
+        encode_etag(response, encoding)
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    stored = None
+    if etag is not None and lookup:
+        stored = compressed_store.get(etag, encoding)
+    if stored is not None:
+        response.set_data(stored[0])
+        response.headers["Content-Encoding"] = encoding
+        encode_etag(response, encoding)
+        return response
+    g.content_length = len(data)
+    with stage("compress"):
+        response.set_data(compress(data, encoding))
+    response.headers["Content-Encoding"] = encoding
+    encode_etag(response, encoding)
+    logging.debug(f"Compressed the response with {encoding}.")
+    if etag is not None:
+        info = {"content_length": g.content_length}
+        if "number_returned" in g:
+            info["number_returned"] = g.number_returned
+        compressed_store.add(etag, encoding, response.get_data(),
+                             dict(response.headers), info)
+    return response
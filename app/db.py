@@ -6,8 +6,16 @@ Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Bal
 import logging
 import os
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
 import psycopg2 as pg
-from psycopg2.extensions import connection
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, connection
+from psycopg2.pool import PoolError
+
+from app.profiler import stage
 
 
 def get_connection() -> connection:
@@ -36,8 +44,10 @@ class Db(object):
     :raise: :class:`psycopg2.OperationalError`
     """
 
-    def __init__(self, dbfile=None):
-        if dbfile is None:
+    def __init__(self, dbfile=None, conn=None):
+        if conn is not None:
+            self.conn = conn
+        elif dbfile is None:
             self.conn = get_connection()
         else:
             self.dbfile = dbfile
@@ -52,13 +62,195 @@ class Db(object):
     def send_query(self, query):
         """Send a query to the DB when no results need to return (e.g. CREATE).
         """
-        with self.conn:
+        with self.conn, stage("db"):
             cur = self.conn.cursor()
             cur.execute(query)
 
-    def get_query(self, query):
+    def get_query(self, query, params=None):
         """DB query where the results need to return (e.g. SELECT)."""
-        with self.conn:
+        with self.conn, stage("db"):
             cur = self.conn.cursor()
-            cur.execute(query)
+            if params is None:
+                cur.execute(query)
+            else:
+                cur.execute(query, params)
             return cur.fetchall()
+
+
+class ConnectionPool(object):
+    """A pool of DB connections of a worker process.
+
+    Connections are opened on demand, up to `maxconn`. When all of them are
+    in use, a checkout waits at most `timeout` seconds for a connection to be
+    returned, and then raises :class:`psycopg2.pool.PoolError`. At most
+    `minconn` idle connections are kept open, the others are closed when they
+    are returned to the pool.
+
+    A connection is checked with a ``SELECT 1`` when it is taken from the
+    pool (if `check` is True), and it is replaced with a new connection if it
+    is broken. The connections of the parent process are discarded after a
+    fork, because they must not be shared between processes.
+
+    The defaults are read from the environment variables
+    POSTGRES_POOL_MIN, POSTGRES_POOL_MAX and POSTGRES_POOL_TIMEOUT.
+    """
+
+    def __init__(self, minconn: int = None, maxconn: int = None,
+                 timeout: float = None, check: bool = True):
+        self.minconn = int(os.environ.get("POSTGRES_POOL_MIN", 1)) \
+            if minconn is None else minconn
+        self.maxconn = int(os.environ.get("POSTGRES_POOL_MAX", 4)) \
+            if maxconn is None else maxconn
+        self.timeout = float(os.environ.get("POSTGRES_POOL_TIMEOUT", 10)) \
+            if timeout is None else timeout
+        if self.minconn < 0 or self.maxconn < max(1, self.minconn):
+            raise ValueError(
+                f"Invalid pool size min={self.minconn}, max={self.maxconn}")
+        self.check = check
+        self._cond = threading.Condition()
+        self._pid = os.getpid()
+        self._idle = []
+        self._size = 0
+        self._in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.timeouts = 0
+        self.reconnects = 0
+
+    def _check_pid(self):
+        """Forget the connections that were inherited from the parent."""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = []
+            self._size = 0
+            self._in_use = 0
+
+    def _is_alive(self, conn: connection) -> bool:
+        if conn.closed:
+            return False
+        if not self.check:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+        except (pg.OperationalError, pg.InterfaceError):
+            return False
+        return True
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._in_use -= 1
+            self._cond.notify()
+
+    def getconn(self) -> connection:
+        """Take a connection from the pool."""
+        start = time.perf_counter()
+        with self._cond:
+            self._check_pid()
+            waited = False
+            while not self._idle and self._size >= self.maxconn:
+                waited = True
+                remaining = start + self.timeout - time.perf_counter()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolError(
+                        f"No DB connection available within {self.timeout}s")
+                self._cond.wait(remaining)
+            if self._idle:
+                conn = self._idle.pop()
+            else:
+                conn = None
+                self._size += 1
+            self._in_use += 1
+            wait = time.perf_counter() - start
+            self.checkouts += 1
+            self.waits += waited
+            self.wait_time += wait
+            self.max_wait_time = max(self.max_wait_time, wait)
+        try:
+            if conn is None:
+                conn = get_connection()
+            elif not self._is_alive(conn):
+                logging.warning("Replacing a broken DB connection")
+                conn.close()
+                conn = get_connection()
+                with self._cond:
+                    self.reconnects += 1
+        except pg.Error:
+            self._release_slot()
+            raise
+        return conn
+
+    def putconn(self, conn: connection, close: bool = False):
+        """Return a connection to the pool."""
+        if not close and not conn.closed:
+            try:
+                if conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except (pg.OperationalError, pg.InterfaceError):
+                close = True
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            self._in_use -= 1
+            if close or conn.closed or len(self._idle) >= self.minconn:
+                self._size -= 1
+                if not conn.closed:
+                    conn.close()
+            else:
+                self._idle.append(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self) -> Iterator[Db]:
+        """Check out a connection for the duration of a `with` block.
+
+        The connection is discarded if the block raises a
+        :class:`psycopg2.OperationalError`.
+        """
+        conn = self.getconn()
+        close = False
+        try:
+            yield Db(conn=conn)
+        except (pg.OperationalError, pg.InterfaceError):
+            close = True
+            raise
+        finally:
+            self.putconn(conn, close=close)
+
+    def closeall(self):
+        """Close the idle connections."""
+        with self._cond:
+            self._check_pid()
+            for conn in self._idle:
+                conn.close()
+            self._size -= len(self._idle)
+            self._idle = []
+
+    def stats(self) -> dict:
+        """Usage statistics of the pool.
+
+        `saturation` is the fraction of the connections that are in use,
+        `waits` the number of checkouts that had to wait for a connection.
+        """
+        with self._cond:
+            self._check_pid()
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "min": self.minconn,
+                "max": self.maxconn,
+                "saturation": self._in_use / self.maxconn,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "wait_time": self.wait_time,
+                "max_wait_time": self.max_wait_time,
+                "timeouts": self.timeouts,
+                "reconnects": self.reconnects,
+            }
+
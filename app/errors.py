@@ -7,9 +7,10 @@ import logging
 
 from flask import jsonify
 
+from psycopg2.pool import PoolError
 from werkzeug.exceptions import HTTPException
 
-from app import app, auth
+from app import app, auth, token_auth
 
 
 @app.errorhandler(HTTPException)
@@ -40,7 +41,21 @@ def resource_not_found(e):
     ), 404
 
 
-@auth.error_handler
+@app.errorhandler(PoolError)
+def pool_exhausted(e):
+    logging.error(f"DB connection pool exhausted. {e}")
+    response = jsonify(
+        code=503,
+        name="Service Unavailable",
+        description=(
+            "The server is temporarily unable to handle the request, "
+            "because it is overloaded. Please try again later."
+        )
+    )
+    response.headers["Retry-After"] = "1"
+    return response, 503
+
+
 def auth_error(status):
     if status == 401:
         error = dict(
@@ -77,3 +92,7 @@ def auth_error(status):
             )
         )
     return jsonify(error), status
+
+
+auth.error_handler(auth_error)
+token_auth.error_handler(auth_error)
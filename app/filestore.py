@@ -0,0 +1,192 @@
+"""File-backed feature store
+
+Serves the features from the packed tiles that are written by
+data_prepare/pack_features.py, without a DB.
+
+Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
+"""
+
+import json
+import logging
+import mmap
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from app.index import ObjectIdSet, morton_code_array
+
+
+class FileStore(object):
+    """A read-only store of CityJSONFeatures in packed tile files.
+
+    Each tile is a JSONL file with one feature per line, and an offset index
+    of the features (object_id, offset, length, bbox), see INDEX_DTYPE in
+    data_prepare/pack_features.py for the format. The offset indexes of all
+    tiles are merged when the store is loaded, into arrays that are ordered
+    by object_id. Then a feature is fetched with a binary search on its
+    object_id and a single read from the memory-mapped tile file. The pages
+    of the tile files are shared by all the workers through the page cache.
+
+    All features of the store share the transform of the store metadata, so
+    a feature is returned as it is stored, without parsing it. At most
+    `max_open_tiles` tile files are kept open, the least recently used ones
+    are closed.
+
+    The store can stand in for a :class:`app.db.ConnectionPool`, see
+    :meth:`connection`.
+    """
+
+    def __init__(self, path, max_open_tiles: int = 256):
+        self.path = Path(path)
+        self.max_open_tiles = max_open_tiles
+        self.metadata = None
+        self.tile_ids = []
+        self.ids = None
+        self.tiles = None
+        self.offsets = None
+        self.lengths = None
+        self.bounds = None
+        self._open_tiles = OrderedDict()
+        self._lock = threading.Lock()
+        self.reads = 0
+        self.tile_opens = 0
+
+    @property
+    def loaded(self) -> bool:
+        return self.ids is not None
+
+    def __len__(self):
+        return 0 if self.ids is None else len(self.ids)
+
+    def load(self):
+        """Read the store metadata and merge the offset indexes of the
+        tiles."""
+        with (self.path / "meta.json").open("r") as fo:
+            self.metadata = json.dumps(json.load(fo), separators=(",", ":"))
+        indexes = []
+        self.tile_ids = []
+        for idx_path in sorted((self.path / "tiles").glob("*.idx")):
+            self.tile_ids.append(idx_path.stem)
+            indexes.append(np.load(idx_path))
+        if len(indexes) == 0:
+            raise FileNotFoundError(f"No tiles in the store {self.path}")
+        index = np.concatenate(indexes)
+        tiles = np.repeat(np.arange(len(indexes), dtype=np.int32),
+                          [len(i) for i in indexes])
+        ids, first = np.unique(index["object_id"], return_index=True)
+        if len(ids) < len(index):
+            logging.warning(f"{len(index) - len(ids)} features are in more "
+                            f"than one tile, serving their first copy.")
+        self.ids = ids
+        self.tiles = tiles[first]
+        self.offsets = index["offset"][first]
+        self.lengths = index["length"][first]
+        self.bounds = index["bbox"][first]
+        logging.info(f"Loaded the feature store {self.path} with "
+                     f"{len(self.ids)} features in {len(self.tile_ids)} "
+                     f"tiles.")
+
+    @property
+    def object_ids(self) -> ObjectIdSet:
+        """All the object ids of the store, ordered by object_id."""
+        return ObjectIdSet(self.ids)
+
+    def envelope_rows(self) -> List[tuple]:
+        """The (object_id, xmin, ymin, xmax, ymax) rows of the features that
+        have vertices, ordered by object_id. The envelopes are those of all
+        the vertices of the features."""
+        has_bbox = np.isfinite(self.bounds).all(axis=1)
+        return [(object_id.decode("utf-8"), *bbox) for object_id, bbox in
+                zip(self.ids[has_bbox], self.bounds[has_bbox].tolist())]
+
+    def morton_keys(self) -> np.ndarray:
+        """The Morton-keys of the envelope centres of the features, like
+        :func:`app.index.get_morton_keys`. The features without vertices get
+        the largest key."""
+        keys = np.full(len(self), np.iinfo(np.uint64).max, dtype=np.uint64)
+        has_bbox = np.isfinite(self.bounds).all(axis=1)
+        b = self.bounds[has_bbox]
+        keys[has_bbox] = morton_code_array((b[:, 0] + b[:, 2]) / 2,
+                                           (b[:, 1] + b[:, 3]) / 2)
+        return keys
+
+    def _tile(self, tile: int) -> mmap.mmap:
+        with self._lock:
+            mm = self._open_tiles.get(tile)
+            if mm is not None:
+                self._open_tiles.move_to_end(tile)
+                return mm
+            jsonl_path = self.path / "tiles" / f"{self.tile_ids[tile]}.jsonl"
+            with jsonl_path.open("rb") as fo:
+                mm = mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ)
+            self._open_tiles[tile] = mm
+            self.tile_opens += 1
+            # An evicted tile is closed when the last reader releases it
+            while len(self._open_tiles) > self.max_open_tiles:
+                self._open_tiles.popitem(last=False)
+            return mm
+
+    def _position(self, object_id: str) -> Optional[int]:
+        i = int(np.searchsorted(self.ids,
+                                np.array(object_id.encode("utf-8"))))
+        if i < len(self.ids) and self.ids[i] == object_id.encode("utf-8"):
+            return i
+        return None
+
+    def read(self, object_id: str) -> Optional[str]:
+        """The serialized feature of the `object_id`, or None if it is not
+        in the store."""
+        i = self._position(object_id)
+        if i is None:
+            return None
+        offset = int(self.offsets[i])
+        mm = self._tile(int(self.tiles[i]))
+        self.reads += 1
+        return mm[offset:offset + int(self.lengths[i])].decode("utf-8")
+
+    def load_features_raw(self, featureIds: List[str]) \
+            -> Tuple[Optional[str], List[str]]:
+        """Load a group of features, as serialized JSON strings.
+
+        Same as :func:`app.loading.load_cityjsonfeatures_raw`. The features
+        that do not exist are skipped, if none of them exist, the metadata
+        is None.
+        """
+        features = [f for f in map(self.read, featureIds) if f is not None]
+        if len(features) == 0:
+            logging.warning(f"None of the {len(featureIds)} features exist.")
+            return None, []
+        return self.metadata, features
+
+    def load_feature(self, featureId: str) -> Tuple[dict, dict]:
+        """Load a single feature.
+
+        :raise: :class:`KeyError` if the feature is not in the store
+        """
+        feature = self.read(featureId)
+        if feature is None:
+            raise KeyError(featureId)
+        return json.loads(self.metadata), json.loads(feature)
+
+    @contextmanager
+    def connection(self) -> Iterator["FileStore"]:
+        """Stands in for :meth:`app.db.ConnectionPool.connection`, the
+        store itself is passed to the loading functions."""
+        yield self
+
+    def closeall(self):
+        with self._lock:
+            self._open_tiles.clear()
+
+    def stats(self) -> dict:
+        return {
+            "features": len(self),
+            "tiles": len(self.tile_ids),
+            "open_tiles": len(self._open_tiles),
+            "tile_opens": self.tile_opens,
+            "reads": self.reads,
+        }
@@ -2,87 +2,772 @@
 
 Copyright (c) 2022 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
 """
-from typing import Tuple, List
-from bisect import bisect_left
+from typing import Iterable, Tuple, List, Optional
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
 from pathlib import Path
 import json
+import logging
+import sys
+import threading
+import time
 
+import numpy as np
+import shapely
 from shapely.strtree import STRtree
-from shapely.geometry import shape
+from shapely.geometry import box, shape
 
 
 class BBOXCache:
-    """Cached BBOX query of features.
+    """Cached BBOX queries of features.
 
-    If a new BBOX is requested then query the index,
-    store the feature subset in the
-    cache and return the feature subset.
+    Keeps the feature subsets of the recently requested BBOXes, so that
+    clients paging through different areas do not evict each other's
+    results. If a new BBOX is requested then query the index,
+    store the feature subset in the cache and return the feature subset.
 
-    If the previously requested BBOX is requested again,
-    return the feature subset from
-    the cache.
+    The BBOXes are compared as strings of the coordinate values that are
+    formatted to three decimal places. When the estimated size of the cached
+    feature subsets exceeds `max_bytes`, the least recently used entries are
+    evicted. If `ttl` is set, the entries that are older than `ttl` seconds
+    are not used anymore. The cache can be shared by the threads of a worker.
+
+    If an `order` is set, the feature subsets are in Morton order instead of
+    object_id order.
+
+    Without an index, the features of a BBOX that are counted in the DB are
+    only estimated if there are more than `max_exact_count`, see
+    :func:`count_features_in_bbox`.
     """
 
-    def __init__(self):
-        self.feature_subset = ()
-        self.bbox = ()
+    def __init__(self, bbox_index: Optional["BBOXIndex"] = None,
+                 max_bytes: int = 256 * 1024 * 1024,
+                 ttl: Optional[float] = None,
+                 order: Optional["MortonOrder"] = None,
+                 max_exact_count: Optional[int] = None):
+        self.bbox_index = bbox_index
+        self.order = order
+        self.max_exact_count = max_exact_count
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(bbox: Tuple[float, float, float, float]) -> Tuple[str, ...]:
+        """Normalize the `bbox` to the cache key."""
+        return tuple(map("{:.3f}".format, bbox))
 
     def add(self, feature_subset, bbox: Tuple[str, str, str, str]):
-        self.feature_subset = feature_subset
-        self.bbox = bbox
+        """Add the `feature_subset` of the normalized `bbox` to the cache."""
+        nbytes = sizeof_feature_subset(feature_subset)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if bbox in self._entries:
+                self.nbytes -= self._entries.pop(bbox)[2]
+            self._entries[bbox] = (feature_subset, time.monotonic(), nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, _, evicted_nbytes) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+                self.evictions += 1
 
     def get(self, conn, bbox: Tuple[float, float, float, float]):
-        """Get the featureIDs in the `bbox`.
-        BBOX comparison is string comparison of
-        the coordinate values that are formatted
-        to three decimal places.
-        """
+        """Get the featureIDs in the `bbox`."""
         # We expect that at this point we have a valid 'bbox',
         # as in a tuple of four floats.
-        bbox_new = tuple(map("{:.3f}".format, bbox))
-        if bbox_new == self.bbox:
-            return self.feature_subset
-        else:
-            self.add(get_features_in_bbox(conn, bbox), bbox_new)
-            return self.feature_subset
+        bbox_new = self.key(bbox)
+        with self._lock:
+            entry = self._entries.get(bbox_new)
+            if entry is not None and self.ttl is not None \
+                    and time.monotonic() - entry[1] > self.ttl:
+                del self._entries[bbox_new]
+                self.nbytes -= entry[2]
+                self.evictions += 1
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(bbox_new)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        # Query outside of the lock, so that other threads are not blocked.
+        feature_subset = get_features_in_bbox(conn, bbox, self.bbox_index)
+        if self.order is not None:
+            feature_subset = self.order.sort(feature_subset)
+        self.add(feature_subset, bbox_new)
+        return feature_subset
+
+    def peek(self, bbox: Tuple[float, float, float, float]):
+        """Get the cached featureIDs in the `bbox` without querying the
+        index. Returns None if the `bbox` is not cached."""
+        with self._lock:
+            entry = self._entries.get(self.key(bbox))
+            if entry is None or (self.ttl is not None and
+                                 time.monotonic() - entry[1] > self.ttl):
+                return None
+            return entry[0]
+
+    def get_page_after(self, conn, bbox: Tuple[float, float, float, float],
+                       after: Optional[str], limit: int) \
+            -> Tuple[Tuple[str], bool, Optional[int]]:
+        """Get a page of `limit` featureIDs in the `bbox` that follow the
+        featureID `after` in object_id order.
+
+        If the `bbox` is cached, the index is loaded or the features are in
+        Morton order, the page is taken from the complete feature subset.
+        Otherwise only the page is queried from the DB, in which case the
+        number of matched features is not known.
+
+        :return: the featureIDs of the page, whether there are more features
+            after the page, and the number of matched features or None
+        """
+        feature_subset = self.peek(bbox)
+        if feature_subset is None and (
+                self.order is not None or
+                (self.bbox_index is not None and self.bbox_index.loaded)):
+            feature_subset = self.get(conn, bbox)
+        if feature_subset is not None:
+            page, has_next = page_after(feature_subset, after, limit)
+            return page, has_next, len(feature_subset)
+        page = get_features_in_bbox_after(conn, bbox, after, limit + 1)
+        return page[:limit], len(page) > limit, None
+
+    def count(self, conn, bbox: Tuple[float, float, float, float]) \
+            -> Tuple[int, bool]:
+        """Count the features in the `bbox`, without listing them.
+
+        The count is taken from the cache or the index, which is exact, or
+        from the DB.
+
+        :return: the number of features and whether the number is exact
+        """
+        feature_subset = self.peek(bbox)
+        if feature_subset is not None:
+            return len(feature_subset), True
+        if self.bbox_index is not None and self.bbox_index.loaded:
+            return self.bbox_index.count(bbox), True
+        return count_features_in_bbox(conn, bbox, self.max_exact_count)
 
     def clear(self):
-        self.feature_subset = ()
-        self.bbox = ()
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        """Usage statistics of the cache."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+def sizeof_feature_subset(feature_subset) -> int:
+    """Estimate the memory size of a feature subset in bytes."""
+    if isinstance(feature_subset,
+                  (ObjectIdSet, MortonOrderedIds, IndexedIds)):
+        return feature_subset.nbytes
+    if isinstance(feature_subset, np.ndarray):
+        return feature_subset.nbytes
+    return sys.getsizeof(feature_subset) + sum(
+        map(sys.getsizeof, feature_subset))
+
+
+def encode_ids(object_ids) -> np.ndarray:
+    """The `object_ids` as an array of fixed-width UTF-8 byte strings, in
+    the same order. Unlike an array of str objects, it can be memory-mapped
+    from a snapshot and shared by the workers, see :mod:`app.snapshot`."""
+    object_ids = np.asarray(object_ids)
+    if object_ids.dtype.kind == "S":
+        return object_ids
+    return np.array([object_id.encode("utf-8") for object_id in object_ids],
+                    dtype=bytes)
+
+
+def decode_ids(ids: np.ndarray) -> Tuple[str, ...]:
+    """The str object ids of an array of :func:`encode_ids`."""
+    return tuple(object_id.decode("utf-8") for object_id in ids)
+
+
+class ObjectIdSet:
+    """A sorted, read-only sequence of object ids.
+
+    The ids are packed into a NumPy array of fixed-width byte strings,
+    instead of a tuple of Python str objects. This needs a fraction of the
+    memory, and since the array is a single Python object, reading it does
+    not update reference counts on its memory pages. Thus, if the set is
+    built before the uwsgi workers are forked, the workers share its pages.
+    The array can also be saved to a file, and loaded memory-mapped.
+
+    Indexing and slicing returns str object ids, lookups are binary searches.
+    """
+
+    def __init__(self, ids: np.ndarray):
+        self.ids = ids
+
+    @classmethod
+    def from_ids(cls, object_ids: Iterable[str]) -> "ObjectIdSet":
+        """Pack and sort the `object_ids`."""
+        encoded = [object_id.encode("utf-8") for object_id in object_ids]
+        width = max(map(len, encoded), default=1)
+        ids = np.array(encoded, dtype=f"S{width}")
+        ids.sort()
+        return cls(ids)
+
+    @classmethod
+    def load(cls, path) -> "ObjectIdSet":
+        """Load a set that was written with :meth:`save`, memory-mapped."""
+        return cls(np.load(path, mmap_mode="r"))
+
+    def save(self, path):
+        np.save(path, self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        return self.ids.nbytes
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return tuple(
+                object_id.decode("utf-8") for object_id in self.ids[item])
+        return self.ids[item].decode("utf-8")
+
+    def __iter__(self):
+        for object_id in self.ids:
+            yield object_id.decode("utf-8")
+
+    def __contains__(self, object_id: str):
+        i = self.bisect_left(object_id)
+        return i < len(self.ids) and self[i] == object_id
+
+    def bisect_left(self, object_id: str) -> int:
+        return int(np.searchsorted(
+            self.ids, np.array(object_id.encode("utf-8")), side="left"))
+
+    def bisect_right(self, object_id: str) -> int:
+        return int(np.searchsorted(
+            self.ids, np.array(object_id.encode("utf-8")), side="right"))
+
+    def index(self, object_id: str) -> int:
+        """Position of the `object_id` in the set.
+
+        :raise: :class:`ValueError` if the `object_id` is not in the set
+        """
+        i = self.bisect_left(object_id)
+        if i < len(self.ids) and self[i] == object_id:
+            return i
+        raise ValueError(f"{object_id} is not in the set")
+
+
+class MortonOrder:
+    """Order of the object ids by the Morton-key of their footprint centroid.
+
+    `keys[i]` is the Morton-key of `id_set[i]`. The objects with the same
+    key are ordered by object_id. Consecutive objects in this order are close
+    to each other, so that each page of a feature collection covers a compact
+    area.
+    """
+
+    def __init__(self, id_set: ObjectIdSet, keys: np.ndarray):
+        self.id_set = id_set
+        self.keys = keys
+
+    def all(self) -> "MortonOrderedIds":
+        """All the object ids, in Morton order."""
+        positions = np.argsort(self.keys, kind="stable").astype(np.int32)
+        return MortonOrderedIds(self, positions)
 
+    def sort(self, object_ids) -> "MortonOrderedIds":
+        """Put the `object_ids` in Morton order. The ids that are not in the
+        id set are dropped."""
+        if len(object_ids) == 0:
+            return MortonOrderedIds(self, np.empty(0, dtype=np.int32))
+        encoded = np.array([object_id.encode("utf-8")
+                            for object_id in object_ids])
+        positions = np.searchsorted(self.id_set.ids, encoded)
+        found = positions < len(self.id_set)
+        found[found] = self.id_set.ids[positions[found]] == encoded[found]
+        positions = np.unique(positions[found])
+        order = np.argsort(self.keys[positions], kind="stable")
+        return MortonOrderedIds(self, positions[order].astype(np.int32))
 
-def get_all_object_ids(conn) -> Tuple[str]:
-    """Retrieve all the object ids from the DB"""
-    # TODO OPTIMIZE: we could keep the shapely.rtree in memory instead
-    # of querying in sqlite, provided that there is enough RAM for it (~1.8GB).
+
+class MortonOrderedIds:
+    """A sequence of object ids in Morton order, see :class:`MortonOrder`.
+
+    Stores the positions of the ids in the id set of the `order`, and their
+    Morton-keys for binary searches.
+    """
+
+    def __init__(self, order: MortonOrder, positions: np.ndarray):
+        self.order = order
+        self.positions = positions
+        self.keys = order.keys[positions]
+
+    @property
+    def nbytes(self) -> int:
+        return self.positions.nbytes + self.keys.nbytes
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return tuple(object_id.decode("utf-8") for object_id
+                         in self.order.id_set.ids[self.positions[item]])
+        return self.order.id_set[int(self.positions[item])]
+
+    def __iter__(self):
+        for position in self.positions:
+            yield self.order.id_set[int(position)]
+
+    def bisect_right(self, object_id: str) -> int:
+        """Position after the `object_id` in the sequence.
+
+        The `object_id` does not need to be in the sequence, only in the id
+        set of the order.
+        """
+        try:
+            position = self.order.id_set.index(object_id)
+        except ValueError:
+            return len(self.positions)
+        key = self.order.keys[position]
+        lo = np.searchsorted(self.keys, key, side="left")
+        hi = np.searchsorted(self.keys, key, side="right")
+        return int(lo + np.searchsorted(self.positions[lo:hi], position,
+                                        side="right"))
+
+
+class IndexedIds:
+    """A sequence of object ids of an in-memory BBOX index, ordered by
+    object_id.
+
+    Stores the positions of the ids in the `object_ids` of the index, which
+    are ordered by object_id, instead of a tuple of str object ids. Thus the
+    result of a query on a large BBOX takes a few bytes per feature. The
+    ids are decoded to str when they are read.
+    """
+
+    def __init__(self, object_ids: np.ndarray, positions: np.ndarray):
+        self.object_ids = object_ids
+        self.positions = positions
+
+    @property
+    def nbytes(self) -> int:
+        return self.positions.nbytes
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return decode_ids(self.object_ids[self.positions[item]])
+        return self.object_ids[self.positions[item]].decode("utf-8")
+
+    def __iter__(self):
+        for position in self.positions:
+            yield self.object_ids[position].decode("utf-8")
+
+    def bisect_right(self, object_id: str) -> int:
+        """Position after the `object_id` in the sequence. The `object_id`
+        does not need to be in the sequence."""
+        position = np.searchsorted(
+            self.object_ids, np.array(object_id.encode("utf-8")),
+            side="right")
+        return int(np.searchsorted(self.positions, position, side="left"))
+
+
+def get_morton_keys(conn, id_set: ObjectIdSet) -> np.ndarray:
+    """Compute the Morton-key of the footprint centroid of each object in the
+    `id_set`.
+
+    The objects without a ground geometry get the largest key, so that they
+    are ordered after all the others.
+    """
+    query = """
+                SELECT co.object_id,
+                       ST_X(ST_Centroid(co.ground_geometry)),
+                       ST_Y(ST_Centroid(co.ground_geometry))
+                FROM cjdb.city_object co
+                WHERE co.ground_geometry IS NOT NULL;
+            """.replace("\n", "")
+    rows = conn.get_query(query)
+    keys = np.full(len(id_set), np.iinfo(np.uint64).max, dtype=np.uint64)
+    if len(rows) == 0:
+        return keys
+    positions = np.searchsorted(
+        id_set.ids, np.array([r[0].encode("utf-8") for r in rows]))
+    keys[positions] = morton_code_array(
+        np.array([r[1] for r in rows], dtype=np.float64),
+        np.array([r[2] for r in rows], dtype=np.float64))
+    return keys
+
+
+def get_all_object_ids(conn) -> ObjectIdSet:
+    """Retrieve all the object ids from the DB, ordered by object_id.
+
+    The ids are sorted in Python, so that their order does not depend on the
+    collation of the DB.
+    """
     query = """
                 SELECT co.object_id
                 FROM cjdb.city_object co;
             """.replace("\n", "")
-    return tuple(t[0] for t in conn.get_query(query))
+    return ObjectIdSet.from_ids(t[0] for t in conn.get_query(query))
 
 
-def get_features_in_bbox(conn, bbox: List[float]) -> Tuple[str]:
+def page_after(features, after: Optional[str], limit: int) \
+        -> Tuple[Tuple[str], bool]:
+    """Get the `limit` featureIDs that follow the featureID `after`.
+
+    The `features` must be ordered by object_id, or they are
+    :class:`MortonOrderedIds`. If `after` is None, the first page is
+    returned.
+
+    :return: the featureIDs of the page and whether there are more
+        features after the page
     """
-    Retrieve from the DB all the object ids of the buildings
-    lying in the input bbox.
+    if after is None:
+        start = 0
+    elif isinstance(features, (ObjectIdSet, MortonOrderedIds, IndexedIds)):
+        start = features.bisect_right(after)
+    else:
+        start = bisect_right(features, after)
+    end = start + limit
+    return tuple(features[start:end]), end < len(features)
+
+
+def bbox_condition(bbox: List[float]) -> str:
+    """The condition on the city objects that intersect the `bbox`."""
+    return (f"st_intersects(co.ground_geometry, ST_MakeEnvelope("
+            f"{bbox[0]}, {bbox[1]}, {bbox[2]}, {bbox[3]}, 7415))")
+
+
+def get_features_in_bbox(conn, bbox: List[float],
+                         bbox_index: Optional["BBOXIndex"] = None):
+    """
+    Retrieve all the object ids of the buildings lying in the input bbox.
+
+    The query is answered from the in-memory `bbox_index` if it is loaded,
+    as :class:`IndexedIds`, otherwise from the DB as a tuple.
     """
-    # TODO OPTIMIZE: we could keep the shapely.rtree in memory instead
-    # of querying in sqlite, provided that there is enough RAM for it (~1.8GB).
+    if bbox_index is not None and bbox_index.loaded:
+        return IndexedIds(bbox_index.object_ids,
+                          bbox_index.query_positions(bbox).astype(np.int32))
     query = f"""
                 SELECT co.object_id
                 FROM cjdb.city_object co
-                WHERE st_intersects(co.ground_geometry,
-                ST_MakeEnvelope({bbox[0]},
-                                {bbox[1]},
-                                {bbox[2]},
-                                {bbox[3]},  7415)
-                )
-                ORDER BY co.object_id;
+                WHERE {bbox_condition(bbox)}
+                ORDER BY co.object_id COLLATE "C";
             """.replace("\n", "")
     return tuple(t[0] for t in conn.get_query(query))
 
 
+def count_features_in_bbox(conn, bbox: List[float],
+                           max_exact: Optional[int] = None) \
+        -> Tuple[int, bool]:
+    """Count the buildings in the bbox in the DB, without retrieving their
+    object ids.
+
+    If `max_exact` is given, the number is first estimated by the query
+    planner, from the statistics of the table. If the estimate is larger
+    than `max_exact`, the estimate is returned instead of counting the
+    buildings.
+
+    :return: the number of buildings and whether the number is exact
+    """
+    where = f"""
+                FROM cjdb.city_object co
+                WHERE {bbox_condition(bbox)}"""
+    if max_exact is not None:
+        plan = conn.get_query(
+            f"EXPLAIN (FORMAT JSON) SELECT co.object_id {where};"
+            .replace("\n", ""))[0][0]
+        estimate = int(plan[0]["Plan"]["Plan Rows"])
+        if estimate > max_exact:
+            return estimate, False
+    rows = conn.get_query(f"SELECT count(*) {where};".replace("\n", ""))
+    return int(rows[0][0]), True
+
+
+class BBOXIndex:
+    """In-memory spatial index of the building footprints.
+
+    Keeps the ground geometries of all city objects in a shapely STRtree,
+    so that BBOX queries are answered in-process instead of with an
+    `st_intersects` query in the DB. The object ids are stored in object_id
+    order, thus the query results are ordered the same way as the results of
+    the DB query in :func:`get_features_in_bbox`.
+
+    If `envelopes` is True, only the envelopes of the ground geometries are
+    kept. This needs a fraction of the memory of the full footprints, but a
+    query returns every object whose envelope intersects the BBOX.
+    """
+
+    def __init__(self, envelopes: bool = False):
+        self.envelopes = envelopes
+        self.object_ids = None
+        self.tree = None
+
+    @property
+    def loaded(self) -> bool:
+        return self.tree is not None
+
+    def __len__(self):
+        return 0 if self.object_ids is None else len(self.object_ids)
+
+    def load(self, conn):
+        """Load the ground geometries from the DB and build the STRtree."""
+        if self.envelopes:
+            query = """
+                SELECT co.object_id,
+                       ST_XMin(co.ground_geometry),
+                       ST_YMin(co.ground_geometry),
+                       ST_XMax(co.ground_geometry),
+                       ST_YMax(co.ground_geometry)
+                FROM cjdb.city_object co
+                WHERE co.ground_geometry IS NOT NULL
+                ORDER BY co.object_id COLLATE "C";
+            """.replace("\n", "")
+        else:
+            query = """
+                SELECT co.object_id, ST_AsBinary(co.ground_geometry)
+                FROM cjdb.city_object co
+                WHERE co.ground_geometry IS NOT NULL
+                ORDER BY co.object_id COLLATE "C";
+            """.replace("\n", "")
+        self.build(conn.get_query(query))
+
+    def build(self, rows):
+        """Build the index from (object_id, WKB) rows, or from
+        (object_id, xmin, ymin, xmax, ymax) rows if `envelopes` is True.
+        The rows must be ordered by object_id."""
+        object_ids = encode_ids([r[0] for r in rows])
+        if self.envelopes:
+            self.build_arrays(object_ids, bounds=np.array(
+                [r[1:5] for r in rows], dtype=np.float64).reshape(-1, 4))
+        else:
+            self.build_arrays(object_ids,
+                              wkb=[bytes(r[1]) for r in rows])
+
+    def build_arrays(self, object_ids: np.ndarray,
+                     bounds: Optional[np.ndarray] = None,
+                     wkb: Optional[np.ndarray] = None):
+        """Build the index from the object ids and the (n, 4) `bounds` of
+        the envelopes, or the `wkb` of the footprints."""
+        if self.envelopes:
+            geometries = shapely.box(bounds[:, 0], bounds[:, 1],
+                                     bounds[:, 2], bounds[:, 3])
+        else:
+            geometries = shapely.from_wkb(wkb)
+        self.object_ids = encode_ids(object_ids)
+        self.tree = STRtree(geometries)
+        logging.info(f"Built the BBOX index of {len(object_ids)} "
+                     f"{'envelopes' if self.envelopes else 'footprints'}.")
+
+    def arrays(self) -> dict:
+        """The arguments of :meth:`build_arrays` that rebuild the index."""
+        if self.envelopes:
+            return {"object_ids": self.object_ids,
+                    "bounds": shapely.bounds(self.geometries)}
+        return {"object_ids": self.object_ids,
+                "wkb": shapely.to_wkb(self.geometries)}
+
+    @property
+    def geometries(self) -> np.ndarray:
+        return self.tree.geometries
+
+    def query_positions(self, bbox: List[float]) -> np.ndarray:
+        """Get the positions of the features that intersect the `bbox`, in
+        object_id order."""
+        idx = self.tree.query(box(*bbox), predicate="intersects")
+        idx.sort()
+        return idx
+
+    def query(self, bbox: List[float]) -> Tuple[str]:
+        """Get the object ids of the features that intersect the `bbox`,
+        ordered by object_id."""
+        return decode_ids(self.object_ids[self.query_positions(bbox)])
+
+    def count(self, bbox: List[float]) -> int:
+        """Count the features that intersect the `bbox`."""
+        return len(self.tree.query(box(*bbox), predicate="intersects"))
+
+    def clear(self):
+        self.object_ids = None
+        self.tree = None
+
+
+class TileIndex:
+    """Routes BBOX queries through the 3DBAG tiles.
+
+    Each feature of the `bbox_index` belongs to the first tile that it
+    intersects, and the index keeps the list of features of each tile. The
+    tiles that are completely inside the query BBOX contribute their whole
+    list, only the features of the tiles on the boundary of the BBOX are
+    tested one by one. Thus a large BBOX that covers many tiles costs little
+    more than concatenating their lists.
+
+    A feature that crosses a tile edge is also kept in the list of shared
+    features of the other tiles that it intersects, and it is tested if
+    these tiles are queried without its own tile. The results are the same
+    as the results of the `bbox_index`, provided that the tiles cover all
+    the features.
+    """
+
+    def __init__(self, bbox_index: BBOXIndex):
+        self.bbox_index = bbox_index
+        self.tile_ids = None
+        self.tree = None
+        self.owner = None
+        self.member_offsets = None
+        self.members = None
+        self.shared_offsets = None
+        self.shared = None
+
+    @property
+    def loaded(self) -> bool:
+        return self.tree is not None and self.bbox_index.loaded
+
+    def __len__(self):
+        return 0 if self.tile_ids is None else len(self.tile_ids)
+
+    def build(self, tiles_shapely):
+        """Build the tile lists from the output of
+        :func:`read_tiles_to_shapely`."""
+        tiles_shapely = list(tiles_shapely)
+        nr_tiles = len(tiles_shapely)
+        self.tile_ids = [g[1] for i, g in tiles_shapely]
+        self.tree = tiles_rtree(tiles_shapely)
+        tile_idx, feature_idx = self.bbox_index.tree.query(
+            self.tree.geometries, predicate="intersects")
+        # Ordered by feature, then by tile
+        order = np.lexsort((tile_idx, feature_idx))
+        tile_idx, feature_idx = tile_idx[order], feature_idx[order]
+        first = np.ones(len(feature_idx), dtype=bool)
+        first[1:] = feature_idx[1:] != feature_idx[:-1]
+        self.owner = np.full(len(self.bbox_index), -1, dtype=np.int64)
+        self.owner[feature_idx[first]] = tile_idx[first]
+        self.members, self.member_offsets = self._group(
+            tile_idx[first], feature_idx[first], nr_tiles)
+        self.shared, self.shared_offsets = self._group(
+            tile_idx[~first], feature_idx[~first], nr_tiles)
+        logging.info(f"Built the lists of features of {nr_tiles} tiles, "
+                     f"{len(self.shared)} features cross a tile edge.")
+
+    @staticmethod
+    def _group(tile_idx, feature_idx, nr_tiles):
+        """Group the features by tile, into a list and the tile offsets."""
+        order = np.lexsort((feature_idx, tile_idx))
+        offsets = np.searchsorted(tile_idx[order], np.arange(nr_tiles + 1))
+        return feature_idx[order], offsets
+
+    def tile_members(self, tile: int) -> np.ndarray:
+        """Positions of the features of the tile in the `bbox_index`."""
+        return self.members[
+            self.member_offsets[tile]:self.member_offsets[tile + 1]]
+
+    def tile_shared(self, tile: int) -> np.ndarray:
+        """Positions of the features of other tiles that intersect the
+        tile."""
+        return self.shared[
+            self.shared_offsets[tile]:self.shared_offsets[tile + 1]]
+
+    @property
+    def object_ids(self) -> np.ndarray:
+        return self.bbox_index.object_ids
+
+    def _query_tiles(self, bbox: List[float]) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        """Get the tiles that are inside the `bbox`, and the positions of
+        the features of the other tiles that intersect the `bbox`."""
+        query_box = box(*bbox)
+        tiles = self.tree.query(query_box, predicate="intersects")
+        if len(tiles) == 0:
+            return tiles, np.empty(0, dtype=np.int64)
+        inside = np.isin(tiles,
+                         self.tree.query(query_box, predicate="contains"))
+        candidates = [self.tile_members(t) for t in tiles[~inside]]
+        # The features of the tiles that are not queried
+        shared = np.unique(np.concatenate(
+            [self.tile_shared(t) for t in tiles]))
+        candidates.append(shared[~np.isin(self.owner[shared], tiles)])
+        candidates = np.concatenate(candidates)
+        hit = shapely.intersects(
+            self.bbox_index.geometries[candidates], query_box)
+        return tiles[inside], candidates[hit]
+
+    def query_positions(self, bbox: List[float]) -> np.ndarray:
+        """Get the positions of the features that intersect the `bbox` in
+        the `bbox_index`, in object_id order."""
+        inside, hits = self._query_tiles(bbox)
+        result = np.concatenate([self.tile_members(t) for t in inside] +
+                                [hits])
+        result.sort()
+        return result
+
+    def count(self, bbox: List[float]) -> int:
+        """Count the features that intersect the `bbox`, without listing
+        the features of the tiles that are inside the `bbox`."""
+        inside, hits = self._query_tiles(bbox)
+        return int(np.sum(self.member_offsets[inside + 1] -
+                          self.member_offsets[inside])) + len(hits)
+
+    def query(self, bbox: List[float]) -> Tuple[str]:
+        """Get the object ids of the features that intersect the `bbox`,
+        ordered by object_id."""
+        return decode_ids(
+            self.bbox_index.object_ids[self.query_positions(bbox)])
+
+    def clear(self):
+        self.tile_ids = None
+        self.tree = None
+        self.owner = None
+        self.member_offsets = None
+        self.members = None
+        self.shared_offsets = None
+        self.shared = None
+
+
+def get_features_in_bbox_after(conn, bbox: List[float],
+                               after: Optional[str], limit: int) \
+        -> Tuple[str]:
+    """
+    Retrieve from the DB the object ids of at most `limit` buildings
+    lying in the input bbox, that follow the object id `after`.
+
+    This is a keyset query, thus its cost does not depend on how deep the
+    page is in the result.
+    """
+    query = f"""
+                SELECT co.object_id
+                FROM cjdb.city_object co
+                WHERE {bbox_condition(bbox)}
+                AND co.object_id COLLATE "C" > %(after)s
+                ORDER BY co.object_id COLLATE "C"
+                LIMIT %(limit)s;
+            """.replace("\n", "")
+    params = {"after": "" if after is None else after, "limit": limit}
+    return tuple(t[0] for t in conn.get_query(query, params))
+
+
 def read_tiles_to_shapely(tiles_json):
     """Generator over (Polygon-id, (Polygon, tile_id))"""
     with Path(tiles_json).resolve().open("r") as fo:
@@ -97,7 +782,7 @@ def tiles_rtree(tiles_shapely):
 
     See https://shapely.readthedocs.io/en/stable/manual.html#str-packed-r-tree
     """
-    return STRtree(g[0] for i, g in tiles_shapely)
+    return STRtree([g[0] for i, g in tiles_shapely])
 
 
 def take_closest(myList, myNumber):
@@ -144,13 +829,34 @@ def __unpart1by1_64(n):
     return n
 
 
+def __part1by1_64_array(n: np.ndarray) -> np.ndarray:
+    """64-bit mask of an array, see __part1by1_64"""
+    n = n.astype(np.uint64) & np.uint64(0x00000000ffffffff)
+    n = (n | (n << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    n = (n | (n << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    n = (n | (n << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    n = (n | (n << np.uint64(2))) & np.uint64(0x3333333333333333)
+    n = (n | (n << np.uint64(1))) & np.uint64(0x5555555555555555)
+    return n
+
+
+def __unpart1by1_64_array(n: np.ndarray) -> np.ndarray:
+    """Inverse of __part1by1_64_array"""
+    n = n.astype(np.uint64) & np.uint64(0x5555555555555555)
+    n = (n ^ (n >> np.uint64(1))) & np.uint64(0x3333333333333333)
+    n = (n ^ (n >> np.uint64(2))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    n = (n ^ (n >> np.uint64(4))) & np.uint64(0x00ff00ff00ff00ff)
+    n = (n ^ (n >> np.uint64(8))) & np.uint64(0x0000ffff0000ffff)
+    n = (n ^ (n >> np.uint64(16))) & np.uint64(0x00000000ffffffff)
+    return n
+
+
 def interleave(*args):
     """Interleave two integers"""
     if len(args) != 2:
         raise ValueError('Usage: interleave2(x, y)')
     for arg in args:
         if not isinstance(arg, int):
-            print('Usage: interleave2(x, y)')
             raise ValueError("Supplied arguments contain a non-integer!")
 
     return __part1by1_64(args[0]) | (__part1by1_64(args[1]) << 1)
@@ -158,12 +864,23 @@ def interleave(*args):
 
 def deinterleave(n):
     if not isinstance(n, int):
-        print('Usage: deinterleave2(n)')
         raise ValueError("Supplied arguments contain a non-integer!")
 
     return __unpart1by1_64(n), __unpart1by1_64(n >> 1)
 
 
+def interleave_array(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Interleave two arrays of non-negative integers into uint64 codes"""
+    return __part1by1_64_array(np.asarray(x)) | (
+        __part1by1_64_array(np.asarray(y)) << np.uint64(1))
+
+
+def deinterleave_array(codes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    codes = np.asarray(codes, dtype=np.uint64)
+    return (__unpart1by1_64_array(codes),
+            __unpart1by1_64_array(codes >> np.uint64(1)))
+
+
 def morton_code(x: float, y: float):
     """Takes an (x,y) coordinate tuple and computes their Morton-key.
 
@@ -177,3 +894,172 @@ def rev_morton_code(morton_key: int) -> Tuple[float, float]:
     """Get the coordinates from a Morton-key"""
     x, y = deinterleave(morton_key)
     return float(x) / 100.0, float(y) / 100.0
+
+
+def morton_code_array(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Computes the Morton-keys of arrays of x and y coordinates.
+
+    The same as :func:`morton_code`, for millions of coordinates at once.
+    """
+    return interleave_array(
+        np.trunc(np.asarray(x, dtype=np.float64) * 100).astype(np.uint64),
+        np.trunc(np.asarray(y, dtype=np.float64) * 100).astype(np.uint64))
+
+
+def rev_morton_code_array(morton_keys: np.ndarray) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """Get the coordinates from an array of Morton-keys"""
+    x, y = deinterleave_array(morton_keys)
+    return x.astype(np.float64) / 100.0, y.astype(np.float64) / 100.0
+
+
+def morton_ranges(x_min: int, y_min: int, x_max: int, y_max: int,
+                  max_depth: int = 8) -> np.ndarray:
+    """Decompose a box of the integer grid into ranges of Morton-keys.
+
+    The box is split into quadrants recursively, in Morton order, and
+    the quadrants that are inside the box become a range of keys. This
+    skips the parts of the key range between the box corners that are
+    outside the box, like the BIGMIN/LITMAX jumps of a Z-order scan.
+    The boundary quadrants at `max_depth` are kept whole, thus the ranges
+    can cover some keys outside the box, but never miss one inside it.
+    The box limits are inclusive.
+
+    :return: an (n, 2) array of sorted, inclusive [first, last] key ranges
+    """
+    level = max(int(x_min ^ x_max).bit_length(),
+                int(y_min ^ y_max).bit_length())
+    stack = [(x_min >> level << level, y_min >> level << level, level, 0)]
+    ranges = []
+    while stack:
+        x0, y0, level, depth = stack.pop()
+        size = 1 << level
+        x1, y1 = x0 + size - 1, y0 + size - 1
+        if x0 > x_max or x1 < x_min or y0 > y_max or y1 < y_min:
+            continue
+        inside = x0 >= x_min and x1 <= x_max and y0 >= y_min and y1 <= y_max
+        if inside or level == 0 or depth == max_depth:
+            first = interleave(x0, y0)
+            last = first + size * size - 1
+            if ranges and ranges[-1][1] + 1 == first:
+                ranges[-1][1] = last
+            else:
+                ranges.append([first, last])
+            continue
+        half = size >> 1
+        # Push in reverse Morton order, so that the quadrants are popped in
+        # Morton order and the ranges come out sorted.
+        for dx, dy in ((1, 1), (0, 1), (1, 0), (0, 0)):
+            stack.append((x0 + dx * half, y0 + dy * half, level - 1,
+                          depth + 1))
+    return np.array(ranges, dtype=np.uint64).reshape(-1, 2)
+
+
+class MortonIndex:
+    """In-memory spatial index on the Morton-keys of the footprints.
+
+    An alternative to :class:`BBOXIndex` that needs no geometry library.
+    Keeps the envelopes of the ground geometries and the sorted Morton-keys
+    of their centres. A BBOX query is decomposed into key ranges with
+    :func:`morton_ranges` that are looked up with a binary search, then the
+    candidates are filtered on their envelopes. Like an envelope
+    :class:`BBOXIndex`, a query returns every object whose envelope
+    intersects the BBOX, ordered by object_id.
+
+    The query BBOX is enlarged by the largest half-size of the envelopes, so
+    that no object with its centre outside of the BBOX is missed.
+    """
+
+    def __init__(self, max_depth: int = 8):
+        self.max_depth = max_depth
+        self.object_ids = None
+        self.bounds = None
+        self.codes = None
+        self.order = None
+        self.max_half_size = (0.0, 0.0)
+
+    @property
+    def loaded(self) -> bool:
+        return self.codes is not None
+
+    def __len__(self):
+        return 0 if self.object_ids is None else len(self.object_ids)
+
+    def load(self, conn):
+        """Load the envelopes of the ground geometries from the DB."""
+        query = """
+                SELECT co.object_id,
+                       ST_XMin(co.ground_geometry),
+                       ST_YMin(co.ground_geometry),
+                       ST_XMax(co.ground_geometry),
+                       ST_YMax(co.ground_geometry)
+                FROM cjdb.city_object co
+                WHERE co.ground_geometry IS NOT NULL
+                ORDER BY co.object_id COLLATE "C";
+            """.replace("\n", "")
+        self.build(conn.get_query(query))
+
+    def build(self, rows):
+        """Build the index from (object_id, xmin, ymin, xmax, ymax) rows,
+        that are ordered by object_id."""
+        self.build_arrays(
+            encode_ids([r[0] for r in rows]),
+            bounds=np.array([r[1:5] for r in rows],
+                            dtype=np.float64).reshape(-1, 4))
+
+    def build_arrays(self, object_ids: np.ndarray, bounds: np.ndarray):
+        """Build the index from the object ids and the (n, 4) `bounds` of
+        their envelopes."""
+        object_ids = encode_ids(object_ids)
+        bounds = np.asarray(bounds, dtype=np.float64)
+        codes = morton_code_array((bounds[:, 0] + bounds[:, 2]) / 2,
+                                  (bounds[:, 1] + bounds[:, 3]) / 2)
+        order = np.argsort(codes, kind="stable")
+        if len(bounds) > 0:
+            self.max_half_size = (
+                float(np.max(bounds[:, 2] - bounds[:, 0])) / 2,
+                float(np.max(bounds[:, 3] - bounds[:, 1])) / 2)
+        self.object_ids = object_ids
+        self.bounds = bounds
+        self.order = order
+        self.codes = codes[order]
+        logging.info(f"Built the Morton index of {len(object_ids)} "
+                     f"envelopes.")
+
+    def arrays(self) -> dict:
+        """The arguments of :meth:`build_arrays` that rebuild the index."""
+        return {"object_ids": self.object_ids, "bounds": self.bounds}
+
+    def query_positions(self, bbox: List[float]) -> np.ndarray:
+        """Get the positions of the objects that intersect the `bbox`, in
+        object_id order."""
+        dx, dy = self.max_half_size
+        grid = [max(0, int(np.floor(c * 100))) for c in
+                (bbox[0] - dx, bbox[1] - dy, bbox[2] + dx, bbox[3] + dy)]
+        ranges = morton_ranges(*grid, max_depth=self.max_depth)
+        starts = np.searchsorted(self.codes, ranges[:, 0], side="left")
+        ends = np.searchsorted(self.codes, ranges[:, 1], side="right")
+        candidates = np.concatenate(
+            [self.order[s:e] for s, e in zip(starts, ends) if e > s] or
+            [np.empty(0, dtype=np.int64)])
+        b = self.bounds[candidates]
+        hit = ((b[:, 0] <= bbox[2]) & (b[:, 2] >= bbox[0]) &
+               (b[:, 1] <= bbox[3]) & (b[:, 3] >= bbox[1]))
+        result = candidates[hit]
+        result.sort()
+        return result
+
+    def query(self, bbox: List[float]) -> Tuple[str]:
+        """Get the object ids of the features that intersect the `bbox`,
+        ordered by object_id."""
+        return decode_ids(self.object_ids[self.query_positions(bbox)])
+
+    def count(self, bbox: List[float]) -> int:
+        """Count the features that intersect the `bbox`."""
+        return len(self.query_positions(bbox))
+
+    def clear(self):
+        self.object_ids = None
+        self.bounds = None
+        self.codes = None
+        self.order = None
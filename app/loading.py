@@ -4,58 +4,163 @@ Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Bal
 
 import json
 import logging
-from typing import List, Tuple
+from urllib.parse import quote
+from typing import Iterator, List, Optional, Tuple
 
 from cjdb.modules.exporter import Exporter
 from flask import request
 
-from app.parameters import Parameters
+from app.filestore import FileStore
+from app.profiler import stage
+from app.parameters import (STORAGE_CRS, SUPPORTED_CRS, Parameters,
+                            encode_cursor)
+from app.transformations import (transform_cityjsonfeatures,
+                                 translate_cityjsonfeatures)
+
+# Number of features that are loaded from the DB at once when streaming
+STREAM_BATCH_SIZE = 100
 
 
 def load_cityjsonfeature(featureId: List[str],
                          connection) -> \
         Tuple[str, str]:
-    """Loads a single feature."""
-    with Exporter(
+    """Loads a single feature.
+
+    :raise: :class:`KeyError` if the feature does not exist
+    """
+    if isinstance(connection, FileStore):
+        with stage("store"):
+            return connection.load_feature(featureId)
+    with stage("export"), Exporter(
         connection=connection.conn,
         schema="cjdb",
         sqlquery=f"SELECT '{featureId}' as object_id",
         output=None,
     ) as exporter:
         logging.info(exporter.sqlquery)
-        exporter.get_data()
+        try:
+            exporter.get_data()
+        except SystemExit:
+            # The Exporter exits if the feature does not exist
+            raise KeyError(featureId)
         feature = exporter.get_features()
         metadata = exporter.get_metadata()
-    return (json.loads(metadata), json.loads(feature[0]))
+    with stage("parse"):
+        return (json.loads(metadata), json.loads(feature[0]))
 
 
 def load_cityjsonfeatures(featureIds: List[str],
                           connection) -> \
         Tuple[str, List[str]]:
     """Loads a group of features."""
+    metadata, features = load_cityjsonfeatures_raw(featureIds, connection)
+    if metadata is None:
+        return None, []
+    with stage("parse"):
+        return (json.loads(metadata),
+                [json.loads(feature) for feature in features])
+
+
+def load_cityjsonfeatures_raw(featureIds: List[str],
+                              connection,
+                              translate: Optional[List[float]] = None) -> \
+        Tuple[str, List[str]]:
+    """Loads a group of features, as serialized JSON strings.
+
+    The features that do not exist are skipped. If none of them exist, the
+    metadata is None. By default the vertices are translated to the minimum
+    of the loaded features. A fixed `translate` can be given instead, so
+    that features that are loaded in several groups share the same
+    transform, see :func:`translate_features_raw`.
+
+    The `connection` can also be a :class:`app.filestore.FileStore`, all of
+    its features share the transform of the store.
+    """
+    if isinstance(connection, FileStore):
+        with stage("store"):
+            return connection.load_features_raw(featureIds)
     feature_ids_str = (
         str(
             [[x] for x in featureIds])[1:-1].replace(
                 "[", "(").replace("]", ")")
     )
-    with Exporter(
+    with stage("export"), Exporter(
         connection=connection.conn,
         schema="cjdb",
         sqlquery=f"""VALUES {feature_ids_str}""",
         output=None,
     ) as exporter:
-        exporter.get_data()
+        try:
+            exporter.get_data()
+        except SystemExit:
+            # The Exporter exits if none of the features exist
+            logging.warning(f"None of the {len(featureIds)} features exist.")
+            return None, []
         features = exporter.get_features()
         metadata = exporter.get_metadata()
-    return (json.loads(metadata),
-            [json.loads(feature) for feature in features])
+    if translate is not None:
+        metadata, features = translate_features_raw(metadata, features,
+                                                    translate)
+    return metadata, features
+
+
+def translate_features_raw(metadata: str, features: List[str],
+                           translate: List[float]) -> Tuple[str, List[str]]:
+    """Translate serialized features to the `translate`. The features are
+    only parsed if their translation is a different one."""
+    with stage("parse"):
+        metadata_obj = json.loads(metadata)
+        if metadata_obj["transform"]["translate"] == list(translate):
+            return metadata, features
+        features = [json.loads(f) for f in features]
+    metadata_obj, features = translate_cityjsonfeatures(
+        metadata_obj, features, translate)
+    with stage("serialize"):
+        return (json.dumps(metadata_obj, separators=(",", ":")),
+                [json.dumps(f, separators=(",", ":")) for f in features])
+
+
+def dump_feature_collection(obj: dict) -> str:
+    """Serialize a feature collection of raw features.
+
+    The "metadata" and "features" members of `obj` are already serialized
+    JSON strings, as they are returned by :func:`load_cityjsonfeatures_raw`.
+    They are spliced into the document without parsing them.
+    """
+    envelope = {k: v for k, v in obj.items()
+                if k not in ("metadata", "features")}
+    parts = [json.dumps(envelope, separators=(",", ":"))[:-1]]
+    if "metadata" in obj:
+        parts.append(',"metadata":')
+        parts.append(obj["metadata"])
+    parts.append(',"features":[')
+    parts.append(",".join(obj["features"]))
+    parts.append("]}")
+    return "".join(parts)
 
 
 def get_paginated_features(features: List[str],
                            url: str,
                            connection,
-                           parameters: Parameters):
-    """From https://stackoverflow.com/a/55546722"""
+                           parameters: Parameters,
+                           raw: bool = False):
+    """From https://stackoverflow.com/a/55546722
+
+    If `raw` is True, the metadata and the features are not parsed, see
+    :func:`dump_feature_collection`.
+    """
+    obj, res = paginate_features(features, url, parameters)
+    return add_features(obj, res, connection, raw)
+
+
+def paginate_features(features: List[str],
+                      url: str,
+                      parameters: Parameters) -> Tuple[dict, List[str]]:
+    """Make the envelope of a page of an offset paginated feature collection.
+
+    :return: the feature collection without features, and the featureIDs
+        of the page
+    """
     logging.debug(
         f"""Pagination started with limit {parameters.limit}
         and offset {parameters.offset}"""
@@ -88,7 +193,7 @@ def get_paginated_features(features: List[str],
             url_prev += f"bbox={bbox}&" + ol
         links.append(
             {
-                "href": url_prev,
+                "href": url_prev + query_suffix(parameters),
                 "rel": "prev",
                 "type": "application/city+json",
             }
@@ -103,23 +208,153 @@ def get_paginated_features(features: List[str],
             url_next += f"bbox={bbox}&" + ol
         links.append(
             {
-                "href": url_next,
+                "href": url_next + query_suffix(parameters),
                 "rel": "next",
                 "type": "application/city+json",
             }
         )
     obj["type"] = "FeatureCollection"
     obj["links"] = links
-    if not all(features) or len(features) == 0:
+    res = features[
+        (parameters.offset - 1):(parameters.offset - 1 + parameters.limit)
+    ]
+    return obj, res
+
+
+def paginate_features_after(features: Tuple[str],
+                            has_next: bool,
+                            url: str,
+                            parameters: Parameters,
+                            nr_matched: Optional[int] = None) -> dict:
+    """Make the envelope of a page of a cursor (keyset) paginated feature
+    collection.
+
+    The `features` are the featureIDs of the page. The 'next' link carries
+    a cursor token of the last featureID of the page.
+    """
+    logging.debug(
+        f"""Cursor pagination with limit {parameters.limit}
+        and cursor {parameters.cursor}"""
+    )
+    obj = {}
+    if nr_matched is not None:
+        obj["numberMatched"] = nr_matched
+    links = [
+        {
+            "href": request.url,
+            "rel": "self",
+            "type": "application/city+json",
+            "title": "this document",
+        }
+    ]
+    if has_next:
+        url_next = f"{url}?"
+        if parameters.bbox is not None:
+            url_next += "bbox={},{},{},{}&".format(*parameters.bbox)
+        url_next += (f"cursor={encode_cursor(features[-1])}"
+                     f"&limit={parameters.limit:d}")
+        links.append(
+            {
+                "href": url_next + query_suffix(parameters),
+                "rel": "next",
+                "type": "application/city+json",
+            }
+        )
+    obj["type"] = "FeatureCollection"
+    obj["links"] = links
+    return obj
+
+
+def query_suffix(parameters: Parameters) -> str:
+    """The query parameters that are carried over to the paging links."""
+    suffix = ""
+    if parameters.crs != STORAGE_CRS:
+        suffix += f"&crs={quote(parameters.crs, safe=':/')}"
+    if parameters.stream:
+        suffix += "&stream=true"
+    return suffix
+
+
+def add_features(obj: dict, features: List[str], connection,
+                 raw: bool = False, crs: str = STORAGE_CRS) -> dict:
+    """Load the `features` into the feature collection `obj`, in the
+    `crs`."""
+    if len(features) == 0:
         obj["numberReturned"] = 0
         obj["features"] = []
     else:
-        
-        res = features[
-            (parameters.offset - 1):(parameters.offset - 1 + parameters.limit)
-        ]
-        metadata, cityjsonfeatures = load_cityjsonfeatures(res, connection)
-        obj["metadata"] = metadata
-        obj["numberReturned"] = len(res)
+        load = load_cityjsonfeatures_raw if raw else load_cityjsonfeatures
+        metadata, cityjsonfeatures = load(features, connection)
+        if metadata is not None:
+            if crs != STORAGE_CRS:
+                transform = transform_features_raw if raw \
+                    else transform_features
+                metadata, cityjsonfeatures = transform(
+                    metadata, cityjsonfeatures, crs)
+            obj["metadata"] = metadata
+        obj["numberReturned"] = len(cityjsonfeatures)
         obj["features"] = cityjsonfeatures
     return obj
+
+
+def transform_features(metadata: dict, features: List[dict],
+                       crs: str) -> Tuple[dict, List[dict]]:
+    """Transform the features from the storage CRS to the `crs`."""
+    with stage("transform"):
+        return transform_cityjsonfeatures(metadata, features,
+                                          SUPPORTED_CRS[crs], crs)
+
+
+def transform_features_raw(metadata: str, features: List[str],
+                           crs: str) -> Tuple[str, List[str]]:
+    """Transform serialized features from the storage CRS to the `crs`."""
+    with stage("parse"):
+        metadata = json.loads(metadata)
+        features = [json.loads(f) for f in features]
+    metadata, features = transform_features(metadata, features, crs)
+    with stage("serialize"):
+        return (json.dumps(metadata, separators=(",", ":")),
+                [json.dumps(f, separators=(",", ":")) for f in features])
+
+
+def stream_feature_collection(obj: dict, features: List[str], pool,
+                              batch_size: int = STREAM_BATCH_SIZE,
+                              crs: str = STORAGE_CRS) \
+        -> Iterator[str]:
+    """Stream the feature collection `obj` with the `features`.
+
+    Yields the envelope, then the features in batches of `batch_size` as
+    they are loaded from the DB, then the trailer. Thus the memory use does
+    not depend on the number of features. The features of all batches are
+    exported with the transform of the first batch, so that they share the
+    metadata. A DB connection is taken from the `pool` for the duration of
+    the stream. The features are transformed to the `crs`.
+    """
+    yield json.dumps(obj, separators=(",", ":"))[:-1] + ',"features":['
+    metadata = None
+    translate = None
+    nr_returned = 0
+    if len(features) > 0:
+        with pool.connection() as connection:
+            for start in range(0, len(features), batch_size):
+                batch = features[start:start + batch_size]
+                batch_metadata, batch_features = load_cityjsonfeatures_raw(
+                    batch, connection, translate)
+                if batch_metadata is None:
+                    continue
+                if metadata is None:
+                    translate = json.loads(
+                        batch_metadata)["transform"]["translate"]
+                if crs != STORAGE_CRS:
+                    batch_metadata, batch_features = transform_features_raw(
+                        batch_metadata, batch_features, crs)
+                if metadata is None:
+                    metadata = batch_metadata
+                if len(batch_features) > 0:
+                    yield ("," if nr_returned > 0 else "") + \
+                        ",".join(batch_features)
+                    nr_returned += len(batch_features)
+    trailer = f'],"numberReturned":{nr_returned:d}'
+    if metadata is not None:
+        trailer += ',"metadata":' + metadata
+    yield trailer + "}"
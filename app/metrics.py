@@ -0,0 +1,159 @@
+"""Prometheus metrics
+
+Serves the latency and the size of the responses per route, the time of the
+stages of the requests (see :mod:`app.profiler`), the hits of the caches and
+the DB connections of the workers at /metrics, in the Prometheus text
+format. Requires the `metrics` extra (prometheus_client).
+
+With several worker processes, PROMETHEUS_MULTIPROC_DIR must be set to an
+empty directory that is shared by the workers, before they start. Each
+worker writes its metrics to the directory, and /metrics aggregates them,
+no matter which worker serves it.
+
+The caches and the connection pool count their own statistics, they are
+added to the metrics at the end of each request, so that they do not slow
+down the lookups.
+
+Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+
+from flask import Response, g, request
+
+from app import app
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+SIZE_BUCKETS = tuple(256 * 4 ** i for i in range(10))
+
+if prometheus_client is not None:
+    REQUEST_DURATION = prometheus_client.Histogram(
+        "api_request_duration_seconds", "Time to respond to a request.",
+        ["route", "method", "status"], buckets=LATENCY_BUCKETS)
+    RESPONSE_SIZE = prometheus_client.Histogram(
+        "api_response_size_bytes",
+        "Size of the response body as sent, without streamed responses.",
+        ["route"], buckets=SIZE_BUCKETS)
+    STAGE_DURATION = prometheus_client.Histogram(
+        "api_stage_duration_seconds",
+        "Time of a stage of a request. The 'db' stage is the time of the "
+        "DB queries, without the cjdb Exporter, which is the 'export' "
+        "stage.", ["stage"], buckets=LATENCY_BUCKETS)
+    CACHE_LOOKUPS = prometheus_client.Counter(
+        "api_cache_lookups_total", "Lookups in the caches of the workers.",
+        ["cache", "result"])
+    CACHE_EVICTIONS = prometheus_client.Counter(
+        "api_cache_evictions_total", "Entries evicted from the caches.",
+        ["cache"])
+    CACHE_BYTES = prometheus_client.Gauge(
+        "api_cache_bytes", "Size of the entries of the caches.", ["cache"],
+        multiprocess_mode="livesum")
+    DB_CONNECTIONS = prometheus_client.Gauge(
+        "api_db_connections", "Open DB connections of the workers.",
+        ["state"], multiprocess_mode="livesum")
+    DB_CHECKOUTS = prometheus_client.Counter(
+        "api_db_checkouts_total",
+        "Connections taken from the pools, and of them, the ones that had "
+        "to wait, or timed out.", ["result"])
+    # Export the counters before their first increase
+    for cache in ("bbox", "compressed"):
+        CACHE_LOOKUPS.labels(cache, "hit")
+        CACHE_LOOKUPS.labels(cache, "miss")
+        CACHE_EVICTIONS.labels(cache)
+    for result in ("total", "waited", "timeout"):
+        DB_CHECKOUTS.labels(result)
+
+
+class StatsSync:
+    """Adds the statistics that an object counts itself to the metrics.
+
+    The counters of the metrics are increased by the difference with the
+    statistics of the previous :meth:`sync`.
+    """
+
+    def __init__(self):
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def inc(self, counter, value: float, *labels):
+        key = (id(counter), labels)
+        with self._lock:
+            delta = value - self._last.get(key, 0)
+            self._last[key] = value
+        if delta > 0:
+            counter.labels(*labels).inc(delta)
+
+    def sync(self):
+        # This module is imported before the views
+        from app import compression, views
+        for cache, store in (("bbox", views.bbox_cache),
+                             ("compressed", compression.compressed_store)):
+            stats = store.stats()
+            self.inc(CACHE_LOOKUPS, stats["hits"], cache, "hit")
+            self.inc(CACHE_LOOKUPS, stats["misses"], cache, "miss")
+            self.inc(CACHE_EVICTIONS, stats["evictions"], cache)
+            CACHE_BYTES.labels(cache).set(store.nbytes)
+        if hasattr(views.backend, "maxconn"):
+            stats = views.backend.stats()
+            DB_CONNECTIONS.labels("in_use").set(stats["in_use"])
+            DB_CONNECTIONS.labels("idle").set(stats["idle"])
+            self.inc(DB_CHECKOUTS, stats["checkouts"], "total")
+            self.inc(DB_CHECKOUTS, stats["waits"], "waited")
+            self.inc(DB_CHECKOUTS, stats["timeouts"], "timeout")
+
+
+stats_sync = StatsSync()
+
+
+def record(response: Response) -> Response:
+    """Add the request and its `response` to the metrics."""
+    if prometheus_client is None:
+        return response
+    route = request.endpoint or "unmatched"
+    if "request_started" in g:
+        REQUEST_DURATION.labels(route, request.method,
+                                str(response.status_code)).observe(
+            time.perf_counter() - g.request_started)
+    if not response.is_streamed and response.content_length is not None:
+        RESPONSE_SIZE.labels(route).observe(response.content_length)
+    for name, duration in g.get("timings", {}).items():
+        STAGE_DURATION.labels(name).observe(duration)
+    stats_sync.sync()
+    return response
+
+
+def mark_process_dead():
+    """Remove the live gauges of this worker, when it exits."""
+    multiprocess.mark_process_dead(os.getpid())
+
+
+if prometheus_client is not None:
+    app.after_request(record)
+    if MULTIPROC_DIR:
+        atexit.register(mark_process_dead)
+
+    @app.get("/metrics")
+    def metrics():
+        stats_sync.sync()
+        if MULTIPROC_DIR:
+            registry = prometheus_client.CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = prometheus_client.REGISTRY
+        return Response(prometheus_client.generate_latest(registry),
+                        content_type=prometheus_client.CONTENT_TYPE_LATEST)
+else:
+    logging.info("prometheus_client is not installed, /metrics is "
+                 "disabled.")
@@ -2,9 +2,11 @@
 Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
 """
 
+import base64
 import logging
+import re
 from dataclasses import dataclass
-from typing import Optional, Tuple, Union
+from typing import List, Optional, Tuple, Union
 
 from flask import abort
 from pyproj import exceptions
@@ -14,6 +16,15 @@ from app.transformations import (transform_bbox_from_default_to_storage,
 
 STORAGE_CRS = "http://www.opengis.net/def/crs/EPSG/0/7415"
 
+# The CRSs of the responses, and their pyproj definition
+SUPPORTED_CRS = {
+    STORAGE_CRS: "EPSG:7415",
+    "http://www.opengis.net/def/crs/OGC/1.3/CRS84": "OGC:CRS84",
+    "http://www.opengis.net/def/crs/EPSG/0/4326": "EPSG:4326",
+    "http://www.opengis.net/def/crs/EPSG/0/3857": "EPSG:3857",
+    "http://www.opengis.net/def/crs/EPSG/0/28992": "EPSG:28992",
+}
+
 DEFAULT_BBOX = [
     10000,
     306250,
@@ -24,6 +35,53 @@ DEFAULT_BBOX = [
 DEFAULT_OFFSET = 1
 DEFAULT_LIMIT = 10
 DEFAULT_MAX_LIMIT = 100
+# Maximum number of featureIDs in a batch request
+BATCH_MAX_IDS = 1000
+FEATURE_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]+$")
+# Maximum limit of streamed responses. Their memory use does not depend on the
+# number of features.
+STREAM_MAX_LIMIT = 5000
+
+
+def parse_feature_ids(body) -> List[str]:
+    """Validate the JSON body of a batch request, {"ids": [featureId, ...]}.
+
+    :return: the featureIDs without duplicates, in the order of the request
+    """
+    ids = body.get("ids") if isinstance(body, dict) else None
+    if not isinstance(ids, list) or len(ids) == 0:
+        logging.error("The request body must have a non-empty 'ids' list.")
+        abort(400)
+    if len(ids) > BATCH_MAX_IDS:
+        logging.error("At most %d ids are allowed in a batch request.",
+                      BATCH_MAX_IDS)
+        abort(400)
+    for feature_id in ids:
+        if not isinstance(feature_id, str) or \
+                FEATURE_ID_PATTERN.match(feature_id) is None:
+            logging.error("Invalid featureId %s", feature_id)
+            abort(400)
+    return list(dict.fromkeys(ids))
+
+
+def encode_cursor(object_id: str) -> str:
+    """Encode the last object_id of a page into an opaque cursor token."""
+    return base64.urlsafe_b64encode(
+        object_id.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> str:
+    """Decode a cursor token into the object_id that it encodes.
+
+    :raise: :class:`ValueError` if the token is invalid
+    """
+    padded = cursor + "=" * (-len(cursor) % 4)
+    object_id = base64.b64decode(padded.encode("ascii"), altchars=b"-_",
+                                 validate=True).decode("utf-8")
+    if object_id == "":
+        raise ValueError("The cursor is empty")
+    return object_id
+
 
 @dataclass
 class Parameters:
@@ -33,12 +91,31 @@ class Parameters:
     crs: str
     bbox_crs: str
     bbox: Optional[Union[Tuple[float, float, float, float], str]] = None
+    cursor: Optional[str] = None
+    stream: Union[bool, str] = False
+    resulttype: str = "results"
 
     def __post_init__(self):
+        if self.resulttype not in ("results", "hits"):
+            logging.error(
+                "Invalid parameter value. Resulttype must be results or hits.")
+            abort(400)
+
+        if isinstance(self.stream, str):
+            if self.stream.lower() in ("true", "1"):
+                self.stream = True
+            elif self.stream.lower() in ("false", "0"):
+                self.stream = False
+            else:
+                logging.error(
+                    "Invalid parameter value. Stream must be true or false.")
+                abort(400)
+
         try:
             self.limit = int(self.limit)
-            if self.limit > DEFAULT_MAX_LIMIT:
-                self.limit = DEFAULT_MAX_LIMIT
+            max_limit = STREAM_MAX_LIMIT if self.stream else DEFAULT_MAX_LIMIT
+            if self.limit > max_limit:
+                self.limit = max_limit
         except ValueError as error:
             logging.error(
                 "Invalid parameter value. Limit must be integer. %s",
@@ -61,13 +138,15 @@ class Parameters:
             logging.error("Offset must be an positive integer.")
             abort(400)
 
-        if self.crs.lower() == STORAGE_CRS.lower():
-            self.crs = STORAGE_CRS
+        crs = {c.lower(): c for c in SUPPORTED_CRS}.get(
+            self.crs.lower().replace("https://", "http://"))
+        if crs is not None:
+            self.crs = crs
         else:
             error_msg = (
-                "Unknown crs %s. Must be either %s",
+                "Unknown crs %s. Must be one of %s",
                 self.crs,
-                STORAGE_CRS)
+                ", ".join(SUPPORTED_CRS))
             logging.error(error_msg)
             abort(400)
 
@@ -91,3 +170,54 @@ class Parameters:
             except ValueError as error:
                 logging.error("Invalid bbox values: %s ", error)
                 abort(400)
+
+        if self.cursor is not None:
+            try:
+                self.cursor = decode_cursor(self.cursor)
+            except ValueError as error:
+                logging.error("Invalid cursor: %s ", error)
+                abort(400)
+
+
+# The query parameters of each route
+ITEMS_PARAMETERS = ("bbox", "offset", "limit", "crs", "bbox-crs", "cursor",
+                    "stream", "resulttype")
+FEATURE_PARAMETERS = ("crs",)
+
+
+def check_parameter_names(args, allowed: Tuple[str, ...]):
+    """Abort if the query `args` have a parameter that is not `allowed`."""
+    for key in args.keys():
+        if key not in allowed:
+            logging.error("Unknown parameter %s. Allowed are %s.", key,
+                          ", ".join(allowed))
+            abort(400)
+
+
+def items_parameters(args) -> Parameters:
+    """Validate the query `args` of a request for the collection items."""
+    check_parameter_names(args, ITEMS_PARAMETERS)
+    if "offset" in args and "cursor" in args:
+        logging.error("The offset and cursor parameters are exclusive.")
+        abort(400)
+    return Parameters(
+        offset=args.get("offset", DEFAULT_OFFSET),
+        limit=args.get("limit", DEFAULT_LIMIT),
+        crs=args.get("crs", STORAGE_CRS),
+        bbox_crs=args.get("bbox-crs", STORAGE_CRS),
+        bbox=args.get("bbox", None),
+        cursor=args.get("cursor", None),
+        stream=args.get("stream", False),
+        resulttype=args.get("resulttype", "results")
+    )
+
+
+def feature_parameters(args) -> Parameters:
+    """Validate the query `args` of a request for a single feature."""
+    check_parameter_names(args, FEATURE_PARAMETERS)
+    return Parameters(
+        offset=DEFAULT_OFFSET,
+        limit=DEFAULT_LIMIT,
+        crs=args.get("crs", STORAGE_CRS),
+        bbox_crs=STORAGE_CRS
+    )
@@ -0,0 +1,165 @@
+"""Request timing and profiling
+
+The time of the stages of a request (selecting the features in the BBOX,
+exporting them from the DB, parsing and serializing the JSON) is measured
+with :func:`stage` and sent to the client in the Server-Timing header.
+
+Requests can also be profiled with cProfile. A fraction of the requests is
+sampled if PROFILE_SAMPLE_RATE is set, and administrators can profile a
+request with the X-Profile header, the value of which names the profile.
+The profiles are written to PROFILE_DIR/<host>/<date>_<commit>_<name>.pstat,
+like the profiles in profiling/.
+
+Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
+"""
+
+import cProfile
+import logging
+import os
+import random
+import re
+import socket
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+
+from flask import Response, g, has_request_context, request
+
+from app import app
+from app.authentication import Permission, check_password, check_token
+
+# Send the Server-Timing header, an empty value or 0 disables it
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "1") not in ("", "0")
+# Fraction of the requests that are profiled
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+PROFILE_DIR = os.environ.get(
+    "PROFILE_DIR", str(Path(__file__).parent.parent / "profiling"))
+PROFILE_HEADER = "X-Profile"
+
+# cProfile can only profile one request of a worker at a time
+_profile_lock = threading.Lock()
+
+
+@contextmanager
+def stage(name: str):
+    """Add the time of the block to the stage `name` of the request.
+
+    Outside of a request, for example while a response is streamed, the
+    block is not timed.
+    """
+    if not has_request_context():
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = g.setdefault("timings", {})
+        timings[name] = timings.get(name, 0.0) + \
+            time.perf_counter() - started
+
+
+def server_timing(response: Response) -> Response:
+    """Set the Server-Timing header from the stages of the request, in
+    milliseconds, with the total time of the request so far."""
+    if not SERVER_TIMING:
+        return response
+    metrics = [f"{name};dur={duration * 1000:.2f}"
+               for name, duration in g.get("timings", {}).items()]
+    if "request_started" in g:
+        metrics.append(
+            f"total;dur="
+            f"{(time.perf_counter() - g.request_started) * 1000:.2f}")
+    if metrics:
+        response.headers["Server-Timing"] = ", ".join(metrics)
+    return response
+
+
+def is_administrator() -> bool:
+    """Whether the credentials of the request are of an administrator.
+
+    The routes do not require authentication, so the credentials are
+    checked here, without authenticating the request.
+    """
+    user = None
+    authorization = request.headers.get("Authorization", "")
+    if authorization.startswith("Bearer "):
+        user = check_token(authorization[7:].strip())
+    elif request.authorization is not None:
+        user = check_password(request.authorization.username or "",
+                              request.authorization.password or "")
+    return user is not None and user.get_roles() == Permission.ADMINISTRATOR
+
+
+def profile_name() -> Optional[str]:
+    """The name of the profile of the request, or None if the request is
+    not profiled."""
+    requested = request.headers.get(PROFILE_HEADER)
+    if requested is not None and is_administrator():
+        return re.sub(r"[^A-Za-z0-9_-]", "-", requested)[:64] or \
+            request.endpoint
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        return request.endpoint
+    return None
+
+
+@lru_cache(maxsize=None)
+def source_commit() -> str:
+    """The abbreviated hash of the deployed commit, from GIT_COMMIT or the
+    git repository of the app."""
+    commit = os.environ.get("GIT_COMMIT")
+    if commit:
+        return commit[:8]
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short=8", "HEAD"],
+            cwd=Path(__file__).parent, capture_output=True, text=True,
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def profile_path(name: str, now: Optional[datetime] = None) -> Path:
+    """The file of the profile `name`. The time of the request is added to
+    the name, so that the profiles of a day do not overwrite each other."""
+    now = now or datetime.now()
+    return Path(PROFILE_DIR) / socket.gethostname() / \
+        f"{now:%Y-%m-%d}_{source_commit()}_{name}-{now:%H%M%S%f}.pstat"
+
+
+@app.before_request
+def start_request():
+    g.request_started = time.perf_counter()
+    name = profile_name()
+    if name is None or not _profile_lock.acquire(blocking=False):
+        return
+    g.profile_name = name
+    g.profile = cProfile.Profile()
+    g.profile.enable()
+
+
+@app.after_request
+def add_server_timing(response: Response) -> Response:
+    return server_timing(response)
+
+
+@app.teardown_request
+def save_profile(exc=None):
+    profile = g.pop("profile", None)
+    if profile is None:
+        return
+    try:
+        profile.disable()
+        path = profile_path(g.profile_name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        profile.dump_stats(path)
+        logging.info(f"Saved the profile of {request.path} to {path}.")
+    except OSError as e:
+        logging.error(f"Could not save the profile of {request.path}. {e}")
+    finally:
+        _profile_lock.release()
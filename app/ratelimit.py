@@ -0,0 +1,265 @@
+"""Rate limits and quotas
+
+Token-bucket rate limits and daily quotas of features and bytes, per user
+or API key, or per IP address for anonymous clients. The counters are kept
+in a memory-mapped file that is shared by all the workers on the host, so
+that they enforce a single budget per client.
+
+Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
+"""
+
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from functools import wraps
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+from flask import Response, abort, g, make_response, request
+
+from app import multi_auth
+from app.authentication import Permission
+
+# Requests per second, and the burst of requests that is allowed on top
+RATE_LIMIT_RATE = float(os.environ.get("RATE_LIMIT_RATE", 10))
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", 50))
+# Features and (uncompressed) bytes per day, 0 means no quota
+QUOTA_FEATURES_DAILY = int(os.environ.get("QUOTA_FEATURES_DAILY", 1000000))
+QUOTA_BYTES_DAILY = int(os.environ.get("QUOTA_BYTES_DAILY", 10 * 1024 ** 3))
+RATE_LIMIT_FILE = os.environ.get(
+    "RATE_LIMIT_FILE",
+    str(Path("/dev/shm" if Path("/dev/shm").is_dir()
+             else tempfile.gettempdir()) / "3dbag-api-ratelimit"))
+
+# key hash, tokens, last update, day, features, bytes
+SLOT = struct.Struct("<Qddqqq")
+# Number of slots that are searched for a client
+PROBES = 8
+SECONDS_PER_DAY = 86400
+
+
+def client_hash(client: str) -> int:
+    """A non-zero 64-bit hash of the client key."""
+    digest = hashlib.blake2b(client.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") or 1
+
+
+class RateLimiter:
+    """Token buckets and daily counters in a shared memory-mapped file.
+
+    The file is a hash table of `nr_slots` client slots. A client is looked
+    up in :data:`PROBES` consecutive slots, if it is not there, it takes an
+    empty slot or the slot that was not used for the longest time. The
+    table is locked with ``flock`` for each update, so that all processes
+    that open the same file share the counters. The file is opened again
+    after a fork, because a lock on an inherited file does not exclude the
+    parent.
+
+    A bucket holds at most `burst` tokens and is refilled with `rate` tokens
+    per second, each request takes a token. The daily counters are reset at
+    midnight UTC.
+    """
+
+    def __init__(self, path=RATE_LIMIT_FILE, nr_slots: int = 65536,
+                 rate: float = RATE_LIMIT_RATE,
+                 burst: float = RATE_LIMIT_BURST,
+                 quota_features: int = QUOTA_FEATURES_DAILY,
+                 quota_bytes: int = QUOTA_BYTES_DAILY):
+        self.path = Path(path)
+        self.nr_slots = nr_slots
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.quota_features = quota_features
+        self.quota_bytes = quota_bytes
+        self._pid = None
+        self._fd = None
+        self._mm = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def _open(self):
+        if self._pid == os.getpid():
+            return
+        size = self.nr_slots * SLOT.size
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._mm = mmap.mmap(self._fd, size, mmap.MAP_SHARED)
+        self._pid = os.getpid()
+
+    def _find(self, key: int, now: float) -> int:
+        """Offset of the slot of the `key`, which is reset if it was used
+        by another client."""
+        start = key % self.nr_slots
+        victim, victim_time = None, None
+        for i in range(PROBES):
+            offset = ((start + i) % self.nr_slots) * SLOT.size
+            slot_key, _, updated, _, _, _ = SLOT.unpack_from(self._mm, offset)
+            if slot_key == key:
+                return offset
+            if slot_key == 0:
+                victim = offset
+                break
+            if victim is None or updated < victim_time:
+                victim, victim_time = offset, updated
+        SLOT.pack_into(self._mm, victim, key, self.burst, now,
+                       int(now // SECONDS_PER_DAY), 0, 0)
+        return victim
+
+    def acquire(self, client: str) -> float:
+        """Take a token of the `client`.
+
+        :return: 0 if the request is allowed, otherwise the number of
+            seconds after which the client can try again
+        """
+        key = client_hash(client)
+        now = time.time()
+        day = int(now // SECONDS_PER_DAY)
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                offset = self._find(key, now)
+                _, tokens, updated, slot_day, features, nbytes = \
+                    SLOT.unpack_from(self._mm, offset)
+                if slot_day != day:
+                    slot_day, features, nbytes = day, 0, 0
+                tokens = min(self.burst,
+                             tokens + (now - updated) * self.rate)
+                if (0 < self.quota_features <= features or
+                        0 < self.quota_bytes <= nbytes):
+                    retry_after = (day + 1) * SECONDS_PER_DAY - now
+                elif tokens < 1:
+                    retry_after = (1 - tokens) / self.rate
+                else:
+                    tokens -= 1
+                    retry_after = 0.0
+                SLOT.pack_into(self._mm, offset, key, tokens, now, slot_day,
+                               features, nbytes)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return retry_after
+
+    def charge(self, client: str, features: int = 0, nbytes: int = 0):
+        """Add the `features` and `nbytes` that were sent to the `client` to
+        its daily counters."""
+        key = client_hash(client)
+        now = time.time()
+        day = int(now // SECONDS_PER_DAY)
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                offset = self._find(key, now)
+                _, tokens, updated, slot_day, used_features, used_bytes = \
+                    SLOT.unpack_from(self._mm, offset)
+                if slot_day != day:
+                    slot_day, used_features, used_bytes = day, 0, 0
+                SLOT.pack_into(self._mm, offset, key, tokens, updated,
+                               slot_day, used_features + features,
+                               used_bytes + nbytes)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def usage(self, client: str) -> dict:
+        """The tokens and the daily counters of the `client`."""
+        key = client_hash(client)
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_SH)
+            try:
+                start = key % self.nr_slots
+                for i in range(PROBES):
+                    slot = SLOT.unpack_from(
+                        self._mm, ((start + i) % self.nr_slots) * SLOT.size)
+                    if slot[0] == key:
+                        return {"tokens": slot[1], "features": slot[4],
+                                "bytes": slot[5]}
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return {"tokens": self.burst, "features": 0, "bytes": 0}
+
+
+rate_limiter = RateLimiter()
+
+
+def current_client() -> str:
+    """The authenticated user of the request, or the IP address of an
+    anonymous client."""
+    user = multi_auth.current_user()
+    if user is not None:
+        return f"user:{user.username}"
+    return f"ip:{request.remote_addr}"
+
+
+def counted(chunks: Iterable, client: str) -> Iterator:
+    """Charge the bytes of a streamed response when the stream ends."""
+    nbytes = 0
+    try:
+        for chunk in chunks:
+            nbytes += len(chunk)
+            yield chunk
+    finally:
+        rate_limiter.charge(client, nbytes=nbytes)
+
+
+def admit() -> Optional[str]:
+    """Take a token of the client of the request.
+
+    Aborts with 429 and a Retry-After header if the client is over its
+    limit.
+
+    :return: the client, or None if the client is not limited
+    """
+    if not rate_limiter.enabled:
+        return None
+    user = multi_auth.current_user()
+    if user is not None and user.get_roles() == Permission.ADMINISTRATOR:
+        return None
+    client = current_client()
+    retry_after = rate_limiter.acquire(client)
+    if retry_after > 0:
+        logging.debug(f"Rate limited {client} for {retry_after:.1f}s.")
+        abort(429, retry_after=max(1, int(retry_after + 0.999)))
+    return client
+
+
+def charge(client: str, response: Response) -> Response:
+    """Charge the features and the bytes of the `response` to the
+    `client`. The bytes of a streamed response are charged when the stream
+    ends."""
+    if response.is_streamed:
+        response.response = counted(response.response, client)
+        rate_limiter.charge(client, features=g.get("number_returned", 0))
+    else:
+        rate_limiter.charge(
+            client, features=g.get("number_returned", 0),
+            nbytes=g.get("content_length", response.content_length or 0))
+    return response
+
+
+def limited(view):
+    """Apply the rate limit and the quotas to a view.
+
+    Must be applied below the authentication, so that the user is known.
+    Responds with 429 and a Retry-After header if the client is over its
+    limit. The view sets the number of returned features in
+    ``g.number_returned``, which is charged to the client with the
+    uncompressed size of the response. Administrators are not limited.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        client = admit()
+        if client is None:
+            return view(*args, **kwargs)
+        return charge(client, make_response(view(*args, **kwargs)))
+    return wrapper
@@ -0,0 +1,162 @@
+"""Index snapshots
+
+Loading the object ids and the BBOX index from the DB takes full scans of
+cjdb.city_object, in every worker, at every start. A snapshot keeps them in
+binary files instead, that the workers load memory-mapped, so that they
+share the pages of the files. The snapshot is tied to the data version of
+the DB, and it is rebuilt by the first worker that starts after the data
+changed. Only the snapshot of the current data version is kept.
+
+Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
+"""
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+
+from app import db
+from app.caching import DATASET_VERSION
+
+# The directory of the snapshots, an empty value disables them
+SNAPSHOT_DIR = os.environ.get(
+    "INDEX_SNAPSHOT_DIR",
+    str(Path(tempfile.gettempdir()) / "3dbag-api-snapshot"))
+# Changes when the files of a snapshot change
+FORMAT_VERSION = 1
+
+
+def data_version(conn) -> str:
+    """The version of the data in the DB.
+
+    Made of the dataset version, the last cjdb import and the largest id of
+    the city objects, which are all read without scanning the tables.
+    """
+    try:
+        last_import = conn.get_query(
+            "SELECT max(id), max(finished_at) FROM cjdb.import_meta;")[0]
+    except db.pg.Error as e:
+        logging.warning(f"Cannot read the imports of the DB. {e}")
+        last_import = (None, None)
+    max_id = conn.get_query("SELECT max(id) FROM cjdb.city_object;")[0][0]
+    return f"{DATASET_VERSION}:{last_import[0]}:{last_import[1]}:{max_id}"
+
+
+def snapshot_key(version: str, **settings) -> str:
+    """The name of the snapshot of the data `version`, that is built with
+    the `settings`."""
+    h = hashlib.sha1(f"{FORMAT_VERSION}\0{version}".encode("utf-8"))
+    for name, value in sorted(settings.items()):
+        h.update(f"\0{name}={value}".encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+def pack_array(array: np.ndarray) -> Dict[str, np.ndarray]:
+    """Convert an array to arrays that can be saved without pickling.
+
+    The str of an object array are encoded to fixed-width byte strings, the
+    bytes are concatenated, with their offsets. The object ids of the
+    indexes are fixed-width byte strings already, see
+    :func:`app.index.encode_ids`, so they are saved as they are.
+    """
+    if array.dtype != object:
+        return {"": array}
+    if len(array) > 0 and isinstance(array[0], bytes):
+        lengths = np.fromiter(map(len, array), dtype=np.int64,
+                              count=len(array))
+        offsets = np.zeros(len(array) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return {".data": np.frombuffer(b"".join(array), dtype=np.uint8),
+                ".offsets": offsets}
+    return {".str": np.array([s.encode("utf-8") for s in array],
+                             dtype=bytes)}
+
+
+def unpack_array(arrays: Dict[str, np.ndarray]) -> np.ndarray:
+    """The inverse of :func:`pack_array`. The str are returned as the
+    memory-mapped byte strings, they are decoded when they are read."""
+    if "" in arrays:
+        return arrays[""]
+    if ".str" in arrays:
+        return arrays[".str"]
+    data, offsets = arrays[".data"], arrays[".offsets"]
+    out = np.empty(len(offsets) - 1, dtype=object)
+    out[:] = [data[start:end].tobytes()
+              for start, end in zip(offsets[:-1], offsets[1:])]
+    return out
+
+
+class Snapshot:
+    """A directory of named arrays.
+
+    The arrays are written to a temporary directory that is renamed when it
+    is complete, so that a snapshot is either complete or missing.
+    """
+
+    def __init__(self, root, key: str, version: Optional[str] = None):
+        self.root = Path(root)
+        self.key = key
+        self.version = version
+        self.path = self.root / key
+
+    def exists(self) -> bool:
+        return (self.path / "meta.json").exists()
+
+    @contextmanager
+    def lock(self):
+        """Hold an exclusive lock on the snapshot directory, so that only
+        one worker builds a snapshot, and the others wait for it."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.root / ".lock", "w") as fo:
+            fcntl.flock(fo, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fo, fcntl.LOCK_UN)
+
+    def load(self) -> Dict[str, np.ndarray]:
+        """The arrays of the snapshot, memory-mapped."""
+        meta = json.loads((self.path / "meta.json").read_text())
+        arrays = {}
+        for name, parts in meta["arrays"].items():
+            arrays[name] = unpack_array({
+                part: np.load(self.path / f"{name}{part}.npy",
+                              mmap_mode="r")
+                for part in parts})
+        return arrays
+
+    def save(self, arrays: Dict[str, np.ndarray]):
+        """Write the `arrays`, and remove the other snapshots."""
+        tmp = Path(tempfile.mkdtemp(dir=self.root, prefix=".tmp-"))
+        meta = {"version": self.version, "created": time.time(),
+                "arrays": {}}
+        for name, array in arrays.items():
+            packed = pack_array(np.asarray(array))
+            for part, a in packed.items():
+                np.save(tmp / f"{name}{part}.npy", a)
+            meta["arrays"][name] = list(packed)
+        (tmp / "meta.json").write_text(json.dumps(meta))
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.rename(tmp, self.path)
+        for other in self.root.iterdir():
+            if other.is_dir() and other.name != self.key:
+                shutil.rmtree(other, ignore_errors=True)
+
+
+def open_snapshot(conn, **settings) -> Optional[Snapshot]:
+    """The snapshot of the current data of the DB, which may not exist
+    yet, or None if the snapshots are disabled."""
+    if not SNAPSHOT_DIR:
+        return None
+    version = data_version(conn)
+    return Snapshot(SNAPSHOT_DIR, snapshot_key(version, **settings),
+                    version)
@@ -2,13 +2,37 @@
 Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
 """
 
-from typing import Tuple
+import threading
+from typing import List, Tuple
 
-from pyproj import Transformer
+import numpy as np
+from pyproj import CRS, Transformer
 
 DEFAULT = "OGC:CRS84"
 STORAGE = "epsg:28992"
 
+# Scale of the integer vertices of features in a geographic CRS,
+# about 1cm in the Netherlands.
+GEOGRAPHIC_SCALE = 1e-7
+
+_transformers = threading.local()
+
+
+def get_transformer(from_crs: str, to_crs: str) -> Transformer:
+    """Get a cached Transformer from one CRS to another.
+
+    Creating a Transformer is expensive, so they are cached. The cache is
+    per thread, because a Transformer must not be shared between threads.
+    """
+    cache = getattr(_transformers, "cache", None)
+    if cache is None:
+        cache = _transformers.cache = {}
+    transformer = cache.get((from_crs, to_crs))
+    if transformer is None:
+        transformer = Transformer.from_crs(from_crs, to_crs)
+        cache[(from_crs, to_crs)] = transformer
+    return transformer
+
 
 def transform_bbox(
     bbox: Tuple[float, float, float, float], from_crs: str, to_crs: str
@@ -16,7 +40,7 @@ def transform_bbox(
     """Transform a bbox from one CRS to another"""
     if from_crs == to_crs:
         return bbox
-    transformer = Transformer.from_crs(from_crs, to_crs)
+    transformer = get_transformer(from_crs, to_crs)
     x1, y1 = transformer.transform(bbox[0], bbox[1])
     x2, y2 = transformer.transform(bbox[2], bbox[3])
 
@@ -31,3 +55,96 @@ def transform_bbox_from_default_to_storage(bbox):
 def transform_bbox_from_storage_to_default(bbox):
     """Transform bbox from 28992 to CRS84"""
     return transform_bbox(bbox=bbox, from_crs=STORAGE, to_crs=DEFAULT)
+
+
+def transform_to_crs(transform: dict, to_crs: str) -> dict:
+    """Compute the CityJSON "transform" of the vertices in `to_crs`.
+
+    The translation is the storage translation in `to_crs`. The scale is
+    GEOGRAPHIC_SCALE for a geographic CRS, otherwise the storage scale.
+    The height is not transformed.
+    """
+    x, y = get_transformer(STORAGE, to_crs).transform(
+        transform["translate"][0], transform["translate"][1])
+    if CRS.from_user_input(to_crs).is_geographic:
+        scale_xy = [GEOGRAPHIC_SCALE, GEOGRAPHIC_SCALE]
+    else:
+        scale_xy = list(transform["scale"][:2])
+    return {
+        "scale": scale_xy + [transform["scale"][2]],
+        "translate": [x, y, transform["translate"][2]],
+    }
+
+
+def transform_vertices(vertices: np.ndarray, transform: dict,
+                       new_transform: dict, to_crs: str) -> np.ndarray:
+    """Transform an (n, 3) array of integer CityJSON vertices from the
+    storage CRS to `to_crs`, in one batch.
+
+    The vertices are decompressed with `transform` and compressed again with
+    `new_transform` (see :func:`transform_to_crs`). The heights are kept.
+    """
+    scale = np.asarray(transform["scale"], dtype=np.float64)
+    translate = np.asarray(transform["translate"], dtype=np.float64)
+    new_scale = np.asarray(new_transform["scale"], dtype=np.float64)
+    new_translate = np.asarray(new_transform["translate"], dtype=np.float64)
+    x, y = get_transformer(STORAGE, to_crs).transform(
+        vertices[:, 0] * scale[0] + translate[0],
+        vertices[:, 1] * scale[1] + translate[1])
+    transformed = np.empty_like(vertices, dtype=np.int64)
+    transformed[:, 0] = np.rint((x - new_translate[0]) / new_scale[0])
+    transformed[:, 1] = np.rint((y - new_translate[1]) / new_scale[1])
+    transformed[:, 2] = vertices[:, 2]
+    return transformed
+
+
+def transform_cityjsonfeatures(metadata: dict, features: List[dict],
+                               to_crs: str, crs_uri: str) \
+        -> Tuple[dict, List[dict]]:
+    """Transform CityJSONFeatures from the storage CRS to `to_crs`.
+
+    The vertices of all the `features` are transformed in one batch, then
+    the "transform" and the "referenceSystem" of the `metadata` are
+    replaced. The `metadata` and `features` are modified in place.
+    """
+    new_transform = transform_to_crs(metadata["transform"], to_crs)
+    counts = [len(feature["vertices"]) for feature in features]
+    if sum(counts) > 0:
+        vertices = np.array(
+            [v for feature in features for v in feature["vertices"]],
+            dtype=np.int64)
+        transformed = transform_vertices(
+            vertices, metadata["transform"], new_transform, to_crs)
+        offsets = np.cumsum([0] + counts)
+        for feature, start, end in zip(features, offsets[:-1], offsets[1:]):
+            feature["vertices"] = transformed[start:end].tolist()
+    metadata["transform"] = new_transform
+    metadata.setdefault("metadata", {})["referenceSystem"] = crs_uri
+    return metadata, features
+
+
+def translate_cityjsonfeatures(metadata: dict, features: List[dict],
+                               translate: List[float]) \
+        -> Tuple[dict, List[dict]]:
+    """Compress the vertices of the CityJSONFeatures with the `translate`,
+    instead of the translation of the `metadata`.
+
+    The scale is kept, so the vertices only change by an integer offset.
+    The `metadata` and `features` are modified in place.
+    """
+    transform = metadata["transform"]
+    offset = np.rint(
+        (np.asarray(transform["translate"], dtype=np.float64)
+         - np.asarray(translate, dtype=np.float64))
+        / np.asarray(transform["scale"], dtype=np.float64)).astype(np.int64)
+    counts = [len(feature["vertices"]) for feature in features]
+    if offset.any() and sum(counts) > 0:
+        vertices = np.array(
+            [v for feature in features for v in feature["vertices"]],
+            dtype=np.int64) + offset
+        offsets = np.cumsum([0] + counts)
+        for feature, start, end in zip(features, offsets[:-1], offsets[1:]):
+            feature["vertices"] = vertices[start:end].tolist()
+    metadata["transform"] = {"scale": transform["scale"],
+                             "translate": list(translate)}
+    return metadata, features
@@ -4,33 +4,152 @@ Copyright (c) 2022 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Bal
 """
 
 import logging
+import os
+import time
 from pathlib import Path
+from typing import Tuple
 
 import yaml
-from flask import (abort, jsonify, make_response, render_template, request,
-                   url_for)
-
-from app import app, auth, db, db_users, index, loading
-from app.authentication import Permission, UserAuth
-from app.parameters import (DEFAULT_LIMIT, DEFAULT_OFFSET, STORAGE_CRS,
-                            Parameters)
-
-bbox_cache = index.BBOXCache()
-
-conn = db.Db()
-logging.debug("Collecting all available object ids.")
-DEFAULT_FEATURE_SET = index.get_all_object_ids(conn)
-conn.conn.close()
+from flask import (Response, abort, g, jsonify, make_response,
+                   render_template, request, url_for)
+
+from app import (app, auth, caching, compression, db, db_users, filestore,
+                 index, loading, multi_auth, ratelimit, snapshot)
+from app.profiler import stage
+from app.authentication import (Permission, UserAuth, generate_api_key,
+                                invalidate_credentials)
+from app.parameters import (STORAGE_CRS, SUPPORTED_CRS, Parameters,
+                            feature_parameters, items_parameters,
+                            parse_feature_ids)
+
+# The in-memory BBOX index is one of 'footprint', 'envelope', 'morton' or
+# 'none'. With 'none', BBOX queries are sent to the DB.
+BBOX_INDEX = os.environ.get("BBOX_INDEX", "footprint").lower()
+# The order of the features in the collection, 'object_id' or 'morton'.
+FEATURE_ORDER = os.environ.get("FEATURE_ORDER", "object_id").lower()
+# The 3DBAG tile index (GeoJSON), for routing the BBOX queries by tile.
+TILES_JSON = os.environ.get("TILES_JSON")
+
+# The directory of a file-backed feature store. If set, the features are
+# served from the store, instead of the DB.
+FEATURE_STORE = os.environ.get("FEATURE_STORE")
+
+if BBOX_INDEX == "morton":
+    bbox_index = index.MortonIndex()
+else:
+    # The feature store only has the envelopes of the features
+    bbox_index = index.BBOXIndex(
+        envelopes=(BBOX_INDEX == "envelope" or FEATURE_STORE is not None))
+
+
+def load_indexes(conn) -> dict:
+    """Load the object ids, their Morton-keys and the BBOX index from the DB.
+
+    :return: the arrays of an index snapshot, the BBOX index is built
+    """
+    started = time.perf_counter()
+    logging.debug("Collecting all available object ids.")
+    id_set = index.get_all_object_ids(conn)
+    arrays = {"object_ids": id_set.ids}
+    logging.info(f"Collected {len(id_set)} object ids "
+                 f"({id_set.nbytes / 1e6:.1f} MB) in "
+                 f"{time.perf_counter() - started:.1f}s.")
+    if FEATURE_ORDER == "morton":
+        started = time.perf_counter()
+        arrays["morton_keys"] = index.get_morton_keys(conn, id_set)
+        logging.info(f"Computed the Morton-keys of the features in "
+                     f"{time.perf_counter() - started:.1f}s.")
+    if BBOX_INDEX in ("footprint", "envelope", "morton"):
+        started = time.perf_counter()
+        try:
+            bbox_index.load(conn)
+        except (MemoryError, db.pg.Error) as e:
+            logging.error(f"Could not load the BBOX index, falling back to "
+                          f"the DB for BBOX queries. {e}")
+            bbox_index.clear()
+        if bbox_index.loaded:
+            arrays.update({f"bbox_{name}": a
+                           for name, a in bbox_index.arrays().items()})
+            logging.info(f"Loaded the BBOX index in "
+                         f"{time.perf_counter() - started:.1f}s.")
+    return arrays
+
+
+startup = time.perf_counter()
+morton_order = None
+if FEATURE_STORE:
+    backend = filestore.FileStore(FEATURE_STORE)
+    backend.load()
+    DEFAULT_FEATURE_SET = FEATURE_IDS = backend.object_ids
+    if FEATURE_ORDER == "morton":
+        morton_order = index.MortonOrder(DEFAULT_FEATURE_SET,
+                                         backend.morton_keys())
+        DEFAULT_FEATURE_SET = morton_order.all()
+    # There is no DB to send the BBOX queries to
+    bbox_index.build(backend.envelope_rows())
+else:
+    backend = db.ConnectionPool()
+    conn = db.Db()
+    index_snapshot = snapshot.open_snapshot(
+        conn, bbox_index=BBOX_INDEX, feature_order=FEATURE_ORDER)
+    if index_snapshot is None:
+        arrays = load_indexes(conn)
+    else:
+        # The first worker builds the snapshot, the others wait for it
+        with index_snapshot.lock():
+            if index_snapshot.exists():
+                started = time.perf_counter()
+                arrays = index_snapshot.load()
+                bbox_arrays = {name[5:]: a for name, a in arrays.items()
+                               if name.startswith("bbox_")}
+                if bbox_arrays:
+                    bbox_index.build_arrays(**bbox_arrays)
+                logging.info(f"Loaded the index snapshot "
+                             f"{index_snapshot.path} in "
+                             f"{time.perf_counter() - started:.1f}s.")
+            else:
+                arrays = load_indexes(conn)
+                # An incomplete snapshot would disable the BBOX index until
+                # the data changes
+                if BBOX_INDEX == "none" or bbox_index.loaded:
+                    index_snapshot.save(arrays)
+                    logging.info(f"Saved the index snapshot "
+                                 f"{index_snapshot.path}.")
+    conn.conn.close()
+    DEFAULT_FEATURE_SET = FEATURE_IDS = index.ObjectIdSet(
+        arrays["object_ids"])
+    if FEATURE_ORDER == "morton":
+        morton_order = index.MortonOrder(DEFAULT_FEATURE_SET,
+                                         arrays["morton_keys"])
+        DEFAULT_FEATURE_SET = morton_order.all()
+if TILES_JSON and isinstance(bbox_index, index.BBOXIndex) \
+        and bbox_index.loaded:
+    logging.debug(f"Building the tile lists from {TILES_JSON}.")
+    tile_index = index.TileIndex(bbox_index)
+    tile_index.build(index.read_tiles_to_shapely(TILES_JSON))
+    bbox_index = tile_index
+
+bbox_cache = index.BBOXCache(
+    bbox_index,
+    max_bytes=int(os.environ.get("BBOX_CACHE_MB", 256)) * 1024 * 1024,
+    ttl=float(os.environ["BBOX_CACHE_TTL"])
+    if "BBOX_CACHE_TTL" in os.environ else None,
+    order=morton_order,
+    max_exact_count=int(os.environ.get("BBOX_COUNT_EXACT_MAX", 100000))
+)
+logging.info(f"Loaded {len(DEFAULT_FEATURE_SET)} features in "
+             f"{time.perf_counter() - startup:.1f}s.")
 
 
 @app.get('/')
+@caching.static
 def landing_page():
     return {
         "title": "3DBAG API",
         "description": "3DBAG is an extended version of the 3DBAG data set. It contains additional information that is either derived from the 3DBAG, or integrated from other data sources.", # noqa
         "links": [
             {
-                "href": request.url,
+                "href": url_for("landing_page", _external=True),
                 "rel": "self",
                 "type": "application/json",
                 "title": "this document"
@@ -64,6 +183,7 @@ def landing_page():
 
 
 @app.get('/api')
+@caching.static
 def api():
     rdir = Path(app.root_path) / "schemas"
     with (rdir / "3dbagapi_spec.yaml").open("r") as fo:
@@ -72,11 +192,13 @@ def api():
 
 
 @app.get('/api.html')
+@caching.static
 def api_html():
     return render_template("redoc_ui.html")
 
 
 @app.get('/conformance')
+@caching.static
 def conformance():
     return {
         "conformsTo": [
@@ -86,10 +208,11 @@ def conformance():
 
 
 @app.get('/collections')
+@caching.static
 def collections():
     return {
         "collections": [
-            pand(),
+            pand_collection(),
         ],
         "links": [
             {
@@ -99,14 +222,18 @@ def collections():
                 "title": "this document"
             },
         ],
-        "crs": [
-            STORAGE_CRS
-        ]
+        "crs": list(SUPPORTED_CRS)
     }
 
 
 @app.get('/collections/pand')
+@caching.static
 def pand():
+    return pand_collection()
+
+
+def pand_collection() -> dict:
+    """The description of the pand collection."""
     return {
         "id": "pand",
         "title": "Pand",
@@ -125,12 +252,10 @@ def pand():
             },
         },
         "itemType": "feature",
-        "crs": [
-            STORAGE_CRS
-        ],
+        "crs": list(SUPPORTED_CRS),
         "storageCrs": STORAGE_CRS,
         "version": {
-            "collection": "v2023.10.08",
+            "collection": caching.DATASET_VERSION,
             "api": "0.1"
         },
         "links": [
@@ -162,64 +287,182 @@ def pand():
     }
 
 
+def validate_items():
+    """Abort the request for the collection items if it is invalid."""
+    items_parameters(request.args)
+
+
 @app.get('/collections/pand/items')
-# @auth.login_required
+# @multi_auth.login_required
+@ratelimit.limited
+@caching.conditional(validate=validate_items)
+@compression.precompressed
 def pand_items():
-    # Validation
-    for key in request.args.keys():
-        if key not in ["bbox", "offset", "limit", "crs", "bbox-crs"]:
-            error_msg = "Unknown parameter %s", key
-            logging.error(error_msg)
-            abort(400)
-
-    query_params = Parameters(
-        offset=request.args.get("offset", DEFAULT_OFFSET),
-        limit=request.args.get("limit", DEFAULT_LIMIT),
-        crs=request.args.get("crs", STORAGE_CRS),
-        bbox_crs=request.args.get("bbox-crs", STORAGE_CRS),
-        bbox=request.args.get("bbox", None)
-    )
-    conn = db.Db()
+    query_params = items_parameters(request.args)
+    if query_params.resulttype == "hits":
+        return pand_items_hits(query_params)
+    with backend.connection() as conn:
+        feature_collection, page = items_page(conn, query_params)
+        if not query_params.stream:
+            loading.add_features(feature_collection, page, conn, raw=True,
+                                 crs=query_params.crs)
+    return items_response(feature_collection, page, query_params)
+
+
+def items_page(conn, query_params: Parameters) -> Tuple[dict, Tuple[str]]:
+    """Select the page of features of the request.
+
+    :return: the feature collection without features, and the featureIDs
+        of the page
+    """
+    if "offset" not in request.args:
+        # Keyset pagination, unless the client asked for an offset
+        if query_params.bbox:
+            with stage("bbox"):
+                page, has_next, nr_matched = bbox_cache.get_page_after(
+                    conn, query_params.bbox, query_params.cursor,
+                    query_params.limit)
+        else:
+            page, has_next = index.page_after(
+                DEFAULT_FEATURE_SET, query_params.cursor,
+                query_params.limit)
+            nr_matched = len(DEFAULT_FEATURE_SET)
+        feature_collection = loading.paginate_features_after(
+            page, has_next,
+            url_for("pand_items", _external=True),
+            query_params, nr_matched)
+    else:
+        if query_params.bbox:
+            with stage("bbox"):
+                feature_subset = bbox_cache.get(conn, query_params.bbox)
+
+        else:
+            feature_subset = DEFAULT_FEATURE_SET
+
+        logging.debug(f" Selection of {len(feature_subset)}  features.")
+        feature_collection, page = loading.paginate_features(
+            feature_subset,
+            url_for("pand_items", _external=True),
+            query_params)
+    g.number_returned = len(page)
+    return feature_collection, page
+
+
+def items_response(feature_collection: dict, page: Tuple[str],
+                   query_params: Parameters) -> Response:
+    """The response with a page of features. Unless the response is
+    streamed, the features are in the `feature_collection` already."""
+    if query_params.stream:
+        # The stream takes its own connection, because it is consumed after
+        # the view returns.
+        response = Response(
+            loading.stream_feature_collection(feature_collection, page,
+                                              backend,
+                                              crs=query_params.crs),
+            mimetype="application/json")
+    else:
+        with stage("serialize"):
+            body = loading.dump_feature_collection(feature_collection)
+        response = make_response(body, 200)
+        response.mimetype = "application/json"
+    response.headers["Content-Crs"] = f"<{query_params.crs}>"
+    return response
 
-    if query_params.bbox:
-        feature_subset = bbox_cache.get(conn, query_params.bbox)
 
+def pand_items_hits(query_params: Parameters):
+    """Only count the features, without listing them."""
+    if query_params.bbox:
+        with backend.connection() as conn, stage("bbox"):
+            nr_matched, exact = bbox_cache.count(conn, query_params.bbox)
     else:
-        feature_subset = DEFAULT_FEATURE_SET
+        nr_matched, exact = len(DEFAULT_FEATURE_SET), True
+    return hits_collection(nr_matched, exact)
+
 
-    logging.debug(f" Selection of {len(feature_subset)}  features.")
-    response = make_response(jsonify(loading.get_paginated_features(
-        feature_subset,
-        url_for("pand_items", _external=True), conn,
-        query_params)), 200)
+def hits_collection(nr_matched: int, exact: bool) -> dict:
+    """The feature collection of a request with resulttype=hits."""
+    feature_collection = {
+        "type": "FeatureCollection",
+        "links": [
+            {
+                "href": request.url,
+                "rel": "self",
+                "type": "application/city+json",
+                "title": "this document",
+            }
+        ]
+    }
+    feature_collection["numberMatched"] = nr_matched
+    if not exact:
+        feature_collection["numberMatchedEstimated"] = True
+    feature_collection["numberReturned"] = 0
+    feature_collection["features"] = []
+    return feature_collection
+
+
+@app.post('/collections/pand/items/batch')
+# @multi_auth.login_required
+@ratelimit.limited
+def pand_items_batch():
+    """Get the features of a list of featureIDs in one FeatureCollection."""
+    query_params = feature_parameters(request.args)
+    feature_ids = parse_feature_ids(request.get_json(silent=True))
+    logging.debug(f"Requesting a batch of {len(feature_ids)} features")
+    feature_collection = {
+        "type": "FeatureCollection",
+        "links": [
+            {
+                "href": request.url,
+                "rel": "self",
+                "type": "application/city+json",
+                "title": "this document",
+            }
+        ]
+    }
+    with backend.connection() as conn:
+        loading.add_features(feature_collection, feature_ids, conn,
+                             raw=True, crs=query_params.crs)
+    g.number_returned = feature_collection["numberReturned"]
+    with stage("serialize"):
+        body = loading.dump_feature_collection(feature_collection)
+    response = make_response(body, 200)
+    response.mimetype = "application/json"
     response.headers["Content-Crs"] = f"<{query_params.crs}>"
-    conn.conn.close()
     return response
 
 
+def validate_feature(featureId):
+    """Abort the request for a single feature if it is invalid, or if the
+    feature does not exist."""
+    feature_parameters(request.args)
+    if featureId not in FEATURE_IDS:
+        abort(404)
+
+
 @app.get('/collections/pand/items/<featureId>')
-# @auth.login_required
+# @multi_auth.login_required
+@ratelimit.limited
+@caching.conditional(validate=validate_feature)
+@compression.precompressed
 def get_feature(featureId):
     logging.debug(f"Requesting {featureId}")
-    for key in request.args.keys():
-        if key not in ["crs"]:
-            error_msg = """Unknown parameter %s.
-                            For GET requests for specifics features
-                            (/collections/pand/items/<featureId>)
-                            only 'crs' is available.""", key
-            logging.error(error_msg)
-            abort(400)
-
-    query_params = Parameters(
-        offset=request.args.get("offset", DEFAULT_OFFSET),
-        limit=request.args.get("limit", DEFAULT_LIMIT),
-        crs=request.args.get("crs", STORAGE_CRS),
-        bbox_crs=request.args.get("bbox-crs", STORAGE_CRS),
-        bbox=request.args.get("bbox", None)
-    )
-    conn = db.Db()
-    metadata, cityjsonfeature = loading.load_cityjsonfeature(featureId, conn)
-    conn.conn.close()
+    query_params = feature_parameters(request.args)
+    with backend.connection() as conn:
+        try:
+            metadata, cityjsonfeature = loading.load_cityjsonfeature(
+                featureId, conn)
+        except KeyError:
+            abort(404)
+    g.number_returned = 1
+    return feature_response(metadata, cityjsonfeature, query_params.crs)
+
+
+def feature_response(metadata: dict, cityjsonfeature: dict,
+                     crs: str) -> Response:
+    """The response with a single feature, in the `crs`."""
+    if crs != STORAGE_CRS:
+        metadata, _ = loading.transform_features(
+            metadata, [cityjsonfeature], crs)
 
     links = [
         {
@@ -245,24 +488,28 @@ def get_feature(featureId):
             "rel": "child",
             "type": "application/city+json"
         })
-    response = make_response(jsonify({
-        "id": cityjsonfeature["id"],
-        "metadata": metadata,
-        "feature": cityjsonfeature,
-        "links": links
-    }), 200)
-    response.headers["Content-Crs"] = f"<{query_params.crs}>"
+    with stage("serialize"):
+        response = make_response(jsonify({
+            "id": cityjsonfeature["id"],
+            "metadata": metadata,
+            "feature": cityjsonfeature,
+            "links": links
+        }), 200)
+    response.headers["Content-Crs"] = f"<{crs}>"
 
     return response
 
 
 @app.route("/register", methods=["GET", "POST"])
-# @auth.login_required(role=Permission.ADMINISTRATOR)
+# @multi_auth.login_required(role=Permission.ADMINISTRATOR)
 def register():
     user = UserAuth(**request.json)
     db_users.session.add(user)
     db_users.session.commit()
-    return jsonify({"message": f"Registered user: {user.username}"})
+    api_key = generate_api_key(user)
+    invalidate_credentials()
+    return jsonify({"message": f"Registered user: {user.username}",
+                    "api_key": api_key})
 
 
 if __name__ == '__main__':
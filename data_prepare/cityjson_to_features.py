@@ -1,11 +1,34 @@
-"""Split a CityJSON file into CityJSONFeatures, and write them to separate files."""
+"""Split CityJSON tiles into CityJSONFeatures, and pack them into a feature
+store.
+
+Each tile is split in a single pass. The vertices of a feature are collected
+and renumbered while its geometries are copied, so a tile costs time linear
+in its size. The features are written with data_prepare/pack_features.py,
+one JSONL file and offset index per tile. The tiles are split in parallel
+by a process pool.
+
+A tile is done when its offset index exists in the store. A run skips the
+tiles that are done, so an interrupted run is resumed by starting it again
+with the same arguments. The tiles that failed are listed in failed.txt in
+the store.
+
+Run from the root of the repository:
+
+    python -m data_prepare.cityjson_to_features <tiles>... <outdir>
+"""
 import gzip
 import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
 
 import click
 import cjio, cjio.cityjson
 
+from data_prepare.pack_features import load_or_write_store_meta, pack_tile
+
 
 def export2jsonl_meta(cm):
     """Export the metadata of the file."""
@@ -45,26 +68,168 @@ def co_to_jsonl(cm, theid, idsdone):
     return json_str
 
 
-@click.command()
-@click.argument('filename', type=click.Path(exists=True))
-@click.argument('outdir', type=click.Path(exists=True))
-def run(filename, outdir):
-    tile_id = filename.rsplit(".")[0].rsplit("_")[3]
-    with gzip.open(filename, "r") as fo:
+def remap_boundaries(boundaries, vertices: List[list],
+                     mapping: Dict[int, int], feature_vertices: List[list]):
+    """Copy the `boundaries` with the vertex indices of the feature.
+
+    A vertex that is not in the `mapping` yet is appended to the
+    `feature_vertices`.
+    """
+    if isinstance(boundaries, int):
+        new = mapping.get(boundaries)
+        if new is None:
+            new = mapping[boundaries] = len(feature_vertices)
+            feature_vertices.append(vertices[boundaries])
+        return new
+    return [remap_boundaries(b, vertices, mapping, feature_vertices)
+            for b in boundaries]
+
+
+def feature_object_ids(city_objects: dict, theid: str) -> List[str]:
+    """The id of a root CityObject and the ids of all its descendants."""
+    ids = [theid]
+    for coid in ids:
+        ids.extend(city_objects[coid].get("children", []))
+    return ids
+
+
+def split_features(j: dict) -> Iterator[dict]:
+    """Split a CityJSON document into CityJSONFeatures, one per root
+    CityObject.
+
+    The geometries are copied in one pass per feature, that renumbers the
+    vertices that they use. Geometry templates and textures are not
+    renumbered this way, the features of a document with these are made
+    with :func:`co_to_jsonl` instead.
+    """
+    city_objects = j["CityObjects"]
+    vertices = j["vertices"]
+    appearance = j.get("appearance")
+    if appearance is not None:
+        appearance = {k: v for k, v in appearance.items()
+                      if k not in ("textures", "vertices-texture")}
+    for theid, co in city_objects.items():
+        if "parents" in co:
+            continue
+        mapping = {}
+        feature_vertices = []
+        feature_objects = {}
+        for coid in feature_object_ids(city_objects, theid):
+            co = city_objects[coid]
+            if "geometry" in co:
+                co = dict(co)
+                co["geometry"] = [
+                    dict(g, boundaries=remap_boundaries(
+                        g["boundaries"], vertices, mapping,
+                        feature_vertices))
+                    for g in co["geometry"]]
+            feature_objects[coid] = co
+        feature = {
+            "type": "CityJSONFeature",
+            "id": theid,
+            "CityObjects": feature_objects,
+            "vertices": feature_vertices,
+        }
+        if appearance:
+            feature["appearance"] = appearance
+        yield feature
+
+
+def tile_id_from_filename(filename) -> str:
+    return Path(filename).name.split(".")[0].rsplit("_")[3]
+
+
+def read_tile(filename):
+    """Read a (gzipped) CityJSON tile and upgrade it to v1.1."""
+    opener = gzip.open if str(filename).endswith(".gz") else open
+    with opener(filename, "r") as fo:
         cm = cjio.cityjson.reader(file=fo, ignore_duplicate_keys=True)
     cm.upgrade_version("1.1", 3)
-    meta_json = export2jsonl_meta(cm)
-    outdir_tile = Path(outdir) / tile_id
-    outdir_tile.mkdir(exist_ok=True)
-    with (outdir_tile / f"meta.json").open("w") as fo:
-        fo.write(meta_json)
-    idsdone = set()
-    for coid in cm.j["CityObjects"]:
-        json_str = co_to_jsonl(cm, coid, idsdone)
-        if json_str is not None:
-            with (outdir_tile / f"{coid}.json").open("w") as fo:
-                fo.write(json_str)
+    return cm
+
+
+def tile_features(cm) -> Iterator[dict]:
+    """The CityJSONFeatures of a tile."""
+    if "geometry-templates" in cm.j or \
+            "textures" in cm.j.get("appearance", {}):
+        idsdone = set()
+        for coid in cm.j["CityObjects"]:
+            json_str = co_to_jsonl(cm, coid, idsdone)
+            if json_str is not None:
+                yield json.loads(json_str)
+    else:
+        yield from split_features(cm.j)
+
+
+def split_tile(filename, outdir, transform: dict) -> Tuple[str, int]:
+    """Split a tile and pack its features into the store in `outdir`, with
+    the `transform` of the store."""
+    tile_id = tile_id_from_filename(filename)
+    cm = read_tile(filename)
+    n = pack_tile(tile_id, tile_features(cm), cm.j["transform"], transform,
+                  outdir)
+    return tile_id, n
+
+
+def list_tiles(inputs) -> List[Path]:
+    """The tile files of the `inputs`, the files in a directory are
+    included."""
+    tiles = []
+    for path in map(Path, inputs):
+        if path.is_dir():
+            tiles.extend(sorted(path.glob("*.json.gz")))
+            tiles.extend(sorted(path.glob("*.json")))
+        else:
+            tiles.append(path)
+    return tiles
+
+
+def pending_tiles(tiles: List[Path], outdir: Path,
+                  overwrite: bool = False) -> List[Path]:
+    """The `tiles` that are not in the store yet."""
+    if overwrite:
+        return list(tiles)
+    return [t for t in tiles if not (
+        outdir / "tiles" / f"{tile_id_from_filename(t)}.idx").exists()]
+
+
+@click.command()
+@click.argument('inputs', nargs=-1, required=True,
+                type=click.Path(exists=True))
+@click.argument('outdir', type=click.Path(file_okay=False))
+@click.option('-j', '--jobs', type=int, default=os.cpu_count(),
+              show_default=True, help="Number of processes.")
+@click.option('--overwrite', is_flag=True,
+              help="Split the tiles that are already in the store again.")
+def run(inputs, outdir, jobs, overwrite):
+    outdir = Path(outdir)
+    tiles = list_tiles(inputs)
+    todo = pending_tiles(tiles, outdir, overwrite)
+    click.echo(f"{len(tiles) - len(todo)} of {len(tiles)} tiles are done.")
+    if len(todo) == 0:
+        return
+    if (outdir / "meta.json").exists():
+        meta = load_or_write_store_meta(outdir, None)
+    else:
+        # The store takes the metadata and the transform of the first tile
+        meta = load_or_write_store_meta(
+            outdir, json.loads(export2jsonl_meta(read_tile(todo[0]))))
+    failed = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(split_tile, t, outdir, meta["transform"]):
+                   t for t in todo}
+        for future in as_completed(futures):
+            try:
+                tile_id, n = future.result()
+                click.echo(f"{tile_id}: {n} features")
+            except Exception as e:
+                logging.error(f"Could not split {futures[future]}. {e}")
+                failed.append(str(futures[future]))
+    with (outdir / "failed.txt").open("w") as fo:
+        fo.write("".join(f"{t}\n" for t in failed))
+    click.echo(f"Split {len(todo) - len(failed)} tiles, "
+               f"{len(failed)} failed.")
 
 
 if __name__ == "__main__":
-    run()
\ No newline at end of file
+    run()
@@ -0,0 +1,112 @@
+"""Pack the CityJSONFeatures of the tiles into a file-backed feature store.
+
+cityjson_to_features.py splits the tiles into a store with
+:func:`pack_tile`. The store is a directory with:
+
+- meta.json: the CityJSON metadata of the store, with the transform that is
+  shared by all the features.
+- tiles/<tile_id>.jsonl: the features of a tile, one per line.
+- tiles/<tile_id>.idx: the offset index of the tile, a NumPy .npy array of
+  INDEX_DTYPE records, ordered by object_id.
+
+The vertices of the features are converted to the transform of the store,
+so that features from different tiles can be served in the same response.
+The store is read by app/filestore.py.
+"""
+import json
+import os
+from pathlib import Path
+from typing import Tuple
+
+import numpy as np
+
+# The fields of the offset index after the object_id. FileStore.load in
+# app/filestore.py reads them by name, the data_prepare scripts do not
+# import the app, so they are not shared.
+INDEX_DTYPE = [("offset", "<u8"), ("length", "<u4"), ("bbox", "<f8", (4,))]
+
+
+def index_dtype(id_width: int) -> np.dtype:
+    """The record of the offset index, with the object_id of `id_width`
+    bytes."""
+    return np.dtype([("object_id", f"S{max(1, id_width)}")] + INDEX_DTYPE)
+
+
+def convert_vertices(vertices, tile_transform: dict, transform: dict) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """Convert the `vertices` from the `tile_transform` to the `transform`.
+
+    :return: the real coordinates and the converted vertices
+    """
+    v = np.array(vertices, dtype=np.int64).reshape(-1, 3)
+    real = v * np.array(tile_transform["scale"]) + \
+        np.array(tile_transform["translate"])
+    if tile_transform == transform:
+        return real, v
+    converted = np.rint((real - np.array(transform["translate"])) /
+                        np.array(transform["scale"])).astype(np.int64)
+    return real, converted
+
+
+def pack_feature(feature: dict, tile_transform: dict, transform: dict):
+    """Convert the vertices of the `feature` to the `transform`.
+
+    :return: the serialized feature and the 2D envelope of its vertices,
+        the envelope is NaN if the feature has no vertices
+    """
+    real, converted = convert_vertices(feature["vertices"], tile_transform,
+                                       transform)
+    feature["vertices"] = converted.tolist()
+    if len(real) == 0:
+        bbox = [np.nan] * 4
+    else:
+        bbox = [*real[:, :2].min(axis=0), *real[:, :2].max(axis=0)]
+    return json.dumps(feature, separators=(",", ":")), bbox
+
+
+def pack_tile(tile_id: str, features, tile_transform: dict, transform: dict,
+              store_dir: Path) -> int:
+    """Write the `features` of a tile into the store.
+
+    The `features` are CityJSONFeature dicts. The files are written under a
+    temporary name and then renamed, the offset index last. Thus a tile with
+    an offset index is complete.
+
+    :return: the number of packed features
+    """
+    tiles_dir = Path(store_dir) / "tiles"
+    tiles_dir.mkdir(parents=True, exist_ok=True)
+    jsonl_path = tiles_dir / f"{tile_id}.jsonl"
+    idx_path = tiles_dir / f"{tile_id}.idx"
+    records = []
+    offset = 0
+    with open(f"{jsonl_path}.tmp", "wb") as fo:
+        for feature in features:
+            feature_str, bbox = pack_feature(feature, tile_transform,
+                                             transform)
+            line = feature_str.encode("utf-8")
+            fo.write(line + b"\n")
+            records.append((feature["id"].encode("utf-8"), offset,
+                            len(line), bbox))
+            offset += len(line) + 1
+    index = np.array(records, dtype=index_dtype(
+        max((len(r[0]) for r in records), default=1)))
+    index.sort(order="object_id")
+    with open(f"{idx_path}.tmp", "wb") as fo:
+        np.save(fo, index)
+    os.replace(f"{jsonl_path}.tmp", jsonl_path)
+    os.replace(f"{idx_path}.tmp", idx_path)
+    return len(records)
+
+
+def load_or_write_store_meta(store_dir: Path, meta: dict) -> dict:
+    """Read the metadata of the store, or create it from the `meta` of a
+    tile if the store is new."""
+    meta_path = Path(store_dir) / "meta.json"
+    if meta_path.exists():
+        with meta_path.open("r") as fo:
+            return json.load(fo)
+    meta_path.parent.mkdir(parents=True, exist_ok=True)
+    with meta_path.open("w") as fo:
+        json.dump(meta, fo, separators=(",", ":"))
+    return meta
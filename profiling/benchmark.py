@@ -0,0 +1,427 @@
+"""Load and latency benchmark of the API.
+
+Replays the scenarios that were profiled on godzilla (see profiling/godzilla)
+and the paging and concurrent mixed workloads, and reports the throughput
+and the latency percentiles of each scenario. The results are saved as
+profiling/<host>/<date>_<commit>_benchmark.json, so that the runs of
+different commits can be compared with the `compare` command.
+
+The requests are sent either to a running server (--url), or to the Flask
+app in this process (the default). The app is configured with the same
+environment variables as the server, so it can be served from a local
+PostGIS, or from a file-backed feature store (FEATURE_STORE) without a DB.
+In the app, the rate limits are disabled, unless RATE_LIMIT_RATE is set.
+
+    python -m profiling.benchmark run --requests 200 --concurrency 8
+    python -m profiling.benchmark compare <baseline.json> <results.json>
+
+Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
+"""
+
+import base64
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import subprocess
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from datetime import date
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlencode, urljoin, urlsplit
+
+import click
+import numpy as np
+
+PROFILING_DIR = Path(__file__).parent
+ITEMS = "collections/pand/items"
+# The areas of the godzilla profiles, see test/test_api.py
+BBOX = "68194.423,395606.054,68608.839,396076.441"
+BBOX_LARGE = "77797.577,450905.086,85494.901,456719.503"
+BBOX_VERYLARGE = "75877.011,446130.034,92446.593,460259.369"
+FEATURE_ID = "NL.IMBAG.Pand.1655100000500573"
+# The environment variables that change the performance of the app, they
+# are saved with the results
+SETTINGS = ("DATASET_VERSION", "FEATURE_STORE", "BBOX_INDEX", "FEATURE_ORDER",
+            "TILES_JSON", "BBOX_CACHE_MB", "BBOX_CACHE_TTL",
+            "BBOX_COUNT_EXACT_MAX", "COMPRESSED_CACHE_MB", "COMPRESS_MIN_SIZE",
+            "POSTGRES_POOL_MIN", "POSTGRES_POOL_MAX", "INDEX_SNAPSHOT_DIR",
+            "RATE_LIMIT_RATE")
+
+
+@dataclass
+class Scenario:
+    """The requests of a scenario.
+
+    An iteration of a scenario requests the `url` with the `params`, and
+    follows the 'next' links of the responses until `pages` pages are
+    requested. An iteration of a mixed scenario runs one of the scenarios
+    of `mix`, drawn with their weights.
+    """
+    description: str
+    url: str = ""
+    params: Dict[str, str] = field(default_factory=dict)
+    pages: int = 1
+    mix: Dict[str, int] = field(default_factory=dict)
+
+
+SCENARIOS = {
+    "bbox": Scenario("Small area, first page", ITEMS, {"bbox": BBOX}),
+    "bbox_large": Scenario("Large area in Den Haag, first page", ITEMS,
+                           {"bbox": BBOX_LARGE}),
+    "bbox_verylarge": Scenario("Very large area in Den Haag, first page",
+                               ITEMS, {"bbox": BBOX_VERYLARGE}),
+    "features_bbox_large": Scenario(
+        "Number of features in the large area", ITEMS,
+        {"bbox": BBOX_LARGE, "resulttype": "hits"}),
+    "features_bbox_verylarge": Scenario(
+        "Number of features in the very large area", ITEMS,
+        {"bbox": BBOX_VERYLARGE, "resulttype": "hits"}),
+    "feature": Scenario("A single feature", f"{ITEMS}/{FEATURE_ID}"),
+    "paging": Scenario("The first 10 pages of the large area", ITEMS,
+                       {"bbox": BBOX_LARGE}, pages=10),
+    "paging_all": Scenario("The first 10 pages of the collection", ITEMS,
+                           pages=10),
+    "mixed": Scenario("Features, areas and pages, concurrently",
+                      mix={"feature": 6, "bbox": 2, "bbox_large": 1,
+                           "bbox_verylarge": 1, "features_bbox_large": 1,
+                           "paging": 1}),
+}
+
+
+class AppTarget:
+    """Send the requests to the Flask app in this process."""
+
+    base_url = "http://localhost/"
+
+    def __init__(self):
+        os.environ.setdefault("RATE_LIMIT_RATE", "0")
+        from app import app
+        self.app = app
+        self._local = threading.local()
+
+    def get(self, url: str, headers: dict) -> Tuple[int, bytes, str]:
+        if not hasattr(self._local, "client"):
+            self._local.client = self.app.test_client()
+        response = self._local.client.get(urljoin(self.base_url, url),
+                                          headers=headers)
+        return response.status_code, response.get_data(), \
+            response.headers.get("Content-Encoding", "")
+
+
+class HttpTarget:
+    """Send the requests to a server, with a persistent connection per
+    thread."""
+
+    def __init__(self, base_url: str, timeout: float = 60):
+        self.base_url = base_url.rstrip("/") + "/"
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self, scheme: str, netloc: str):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            cls = http.client.HTTPSConnection if scheme == "https" \
+                else http.client.HTTPConnection
+            connection = self._local.connection = cls(netloc,
+                                                      timeout=self.timeout)
+        return connection
+
+    def get(self, url: str, headers: dict) -> Tuple[int, bytes, str]:
+        parts = urlsplit(urljoin(self.base_url, url))
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        connection = self._connection(parts.scheme, parts.netloc)
+        try:
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+            return response.status, response.read(), \
+                response.getheader("Content-Encoding", "")
+        except (OSError, http.client.HTTPException):
+            # The server closed the connection, the next request opens a
+            # new one
+            connection.close()
+            self._local.connection = None
+            raise
+
+
+def decompress(body: bytes, encoding: str) -> bytes:
+    if encoding == "gzip":
+        return zlib.decompress(body, 47)
+    if encoding == "br":
+        import brotli
+        return brotli.decompress(body)
+    if encoding == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    return body
+
+
+def next_link(body: bytes, encoding: str = "") -> Optional[str]:
+    """The 'next' link of a page, or None."""
+    try:
+        links = json.loads(decompress(body, encoding)).get("links", [])
+    except (ValueError, zlib.error):
+        return None
+    for link in links:
+        if link.get("rel") == "next":
+            return link["href"]
+    return None
+
+
+def run_iteration(target, scenario: Scenario,
+                  headers: dict) -> List[Tuple[float, int, int]]:
+    """Run an iteration of the `scenario`.
+
+    :return: the (latency, status, size) of each request
+    """
+    samples = []
+    url = scenario.url
+    if scenario.params:
+        url += "?" + urlencode(scenario.params)
+    for _ in range(scenario.pages):
+        started = time.perf_counter()
+        try:
+            status, body, encoding = target.get(url, headers)
+        except (OSError, http.client.HTTPException) as e:
+            logging.error(f"GET {url} failed. {e}")
+            samples.append((time.perf_counter() - started, 0, 0))
+            break
+        samples.append((time.perf_counter() - started, status, len(body)))
+        if status != 200:
+            break
+        url = next_link(body, encoding) if scenario.pages > 1 else None
+        if url is None:
+            break
+    return samples
+
+
+def summarize(latencies, statuses, sizes, elapsed: float) -> dict:
+    """The throughput and the latency percentiles of the requests.
+
+    The latencies are in seconds, they are reported in milliseconds.
+    """
+    latencies = np.asarray(latencies, dtype=float) * 1000
+    statuses = np.asarray(statuses, dtype=int)
+    if len(latencies) == 0:
+        return {"requests": 0, "errors": 0}
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "requests": len(latencies),
+        "errors": int(np.count_nonzero((statuses < 200) | (statuses >= 400))),
+        "statuses": {str(s): int(n) for s, n in
+                     zip(*np.unique(statuses, return_counts=True))},
+        "elapsed_s": elapsed,
+        "throughput_rps": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "bytes_per_s": float(np.sum(sizes)) / elapsed if elapsed > 0 else 0.0,
+        "mean_ms": float(latencies.mean()),
+        "min_ms": float(latencies.min()),
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+        "max_ms": float(latencies.max()),
+    }
+
+
+def run_scenario(target, name: str, iterations: int, concurrency: int,
+                 warmup: int = 1, headers: Optional[dict] = None,
+                 seed: int = 0,
+                 scenarios: Optional[Dict[str, Scenario]] = None) -> dict:
+    """Run `iterations` iterations of the scenario `name` with `concurrency`
+    threads, after `warmup` iterations that are not measured.
+
+    The scenarios of a mixed scenario are drawn before the run with the
+    `seed`, so that runs with the same options send the same requests.
+    """
+    scenarios = scenarios or SCENARIOS
+    scenario = scenarios[name]
+    headers = headers or {}
+    if scenario.mix:
+        rng = random.Random(seed)
+        names, weights = zip(*scenario.mix.items())
+        plan = rng.choices(names, weights=weights, k=iterations)
+        for warmup_name in names:
+            for _ in range(warmup):
+                run_iteration(target, scenarios[warmup_name], headers)
+    else:
+        plan = [name] * iterations
+        for _ in range(warmup):
+            run_iteration(target, scenario, headers)
+
+    results = [None] * iterations
+
+    def work(i):
+        results[i] = run_iteration(target, scenarios[plan[i]], headers)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(work, range(iterations)))
+    elapsed = time.perf_counter() - started
+
+    samples = [s for iteration in results for s in iteration]
+    summary = summarize([s[0] for s in samples], [s[1] for s in samples],
+                        [s[2] for s in samples], elapsed)
+    summary.update(description=scenario.description,
+                   iterations=iterations, concurrency=concurrency)
+    if scenario.mix:
+        summary["by_scenario"] = {}
+        for part in sorted(set(plan)):
+            part_samples = [s for p, iteration in zip(plan, results)
+                            if p == part for s in iteration]
+            summary["by_scenario"][part] = summarize(
+                [s[0] for s in part_samples], [s[1] for s in part_samples],
+                [s[2] for s in part_samples], elapsed)
+    return summary
+
+
+def git_commit() -> Tuple[str, bool]:
+    """The abbreviated hash of the checked out commit, and whether the
+    working tree has changes."""
+    def git(*args):
+        return subprocess.run(("git",) + args, cwd=PROFILING_DIR,
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    try:
+        return git("rev-parse", "--short=8", "HEAD"), \
+            bool(git("status", "--porcelain", "--untracked-files=no"))
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+
+
+def results_path(commit: str, host: str, name: str = "benchmark") -> Path:
+    """The file of the results, next to the profiles of the `host`."""
+    return PROFILING_DIR / host / f"{date.today().isoformat()}_{commit}_" \
+                                  f"{name}.json"
+
+
+def print_summary(name: str, summary: dict):
+    if summary["requests"] == 0:
+        click.echo(f"{name:<24} no requests")
+        return
+    click.echo(f"{name:<24} {summary['requests']:>6} req "
+               f"{summary['errors']:>4} err "
+               f"{summary['throughput_rps']:>9.1f} req/s  "
+               f"p50 {summary['p50_ms']:>8.1f}  "
+               f"p95 {summary['p95_ms']:>8.1f}  "
+               f"p99 {summary['p99_ms']:>8.1f} ms")
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--url", help="Base URL of a running server, for example "
+                            "http://localhost:5000. Without it, the requests "
+                            "are sent to the app in this process.")
+@click.option("-s", "--scenario", "scenarios", multiple=True,
+              type=click.Choice(list(SCENARIOS)),
+              help="Scenario to run, can be repeated. Default: all.")
+@click.option("-n", "--requests", "iterations", default=100, show_default=True,
+              help="Iterations per scenario. An iteration of a paging "
+                   "scenario requests several pages.")
+@click.option("-c", "--concurrency", default=4, show_default=True,
+              help="Number of concurrent clients.")
+@click.option("--warmup", default=1, show_default=True,
+              help="Iterations before the measurement, per scenario.")
+@click.option("--accept-encoding", default="gzip", show_default=True,
+              help="Accept-Encoding of the requests, empty for none.")
+@click.option("--feature-id", default=FEATURE_ID, show_default=True,
+              help="Feature of the 'feature' scenario, for data sets that "
+                   "do not have the default one.")
+@click.option("--user", help="Basic authentication as user:password.")
+@click.option("--seed", default=0, show_default=True,
+              help="Seed of the mixed workloads.")
+@click.option("--host", default=socket.gethostname(), show_default=True,
+              help="Name of the machine in the results path.")
+@click.option("-o", "--output", type=click.Path(dir_okay=False),
+              help="Results file. Default: "
+                   "profiling/<host>/<date>_<commit>_benchmark.json.")
+def run(url, scenarios, iterations, concurrency, warmup, accept_encoding,
+        feature_id, user, seed, host, output):
+    """Run the benchmark and save the results."""
+    logging.getLogger().setLevel(logging.WARNING)
+    started = time.perf_counter()
+    target = HttpTarget(url) if url else AppTarget()
+    startup = time.perf_counter() - started
+    headers = {}
+    if accept_encoding:
+        headers["Accept-Encoding"] = accept_encoding
+    if user:
+        headers["Authorization"] = \
+            "Basic " + base64.b64encode(user.encode("utf-8")).decode("ascii")
+
+    commit, dirty = git_commit()
+    results = {
+        "commit": commit,
+        "dirty": dirty,
+        "date": date.today().isoformat(),
+        "host": host,
+        "python": platform.python_version(),
+        "target": url or "app",
+        "startup_s": None if url else startup,
+        "settings": {name: os.environ[name] for name in SETTINGS
+                     if name in os.environ},
+        "options": {"requests": iterations, "concurrency": concurrency,
+                    "warmup": warmup, "accept_encoding": accept_encoding,
+                    "feature_id": feature_id, "seed": seed},
+        "scenarios": {},
+    }
+    catalog = dict(SCENARIOS)
+    catalog["feature"] = replace(catalog["feature"],
+                                 url=f"{ITEMS}/{feature_id}")
+    for name in scenarios or SCENARIOS:
+        summary = run_scenario(target, name, iterations, concurrency,
+                               warmup=warmup, headers=headers, seed=seed,
+                               scenarios=catalog)
+        results["scenarios"][name] = summary
+        print_summary(name, summary)
+
+    path = Path(output) if output else results_path(commit, host)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("w") as fo:
+        json.dump(results, fo, indent=2)
+    click.echo(f"Saved the results to {path}")
+
+
+def compare_results(baseline: dict, results: dict) -> Dict[str, dict]:
+    """The relative change of the throughput and the latency percentiles of
+    the scenarios that are in both results."""
+    changes = {}
+    for name, summary in results["scenarios"].items():
+        base = baseline["scenarios"].get(name)
+        if base is None or not base.get("requests") or \
+                not summary.get("requests"):
+            continue
+        changes[name] = {
+            metric: summary[metric] / base[metric] - 1
+            if base[metric] else None
+            for metric in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms")}
+    return changes
+
+
+@cli.command()
+@click.argument("baseline", type=click.Path(exists=True, dir_okay=False))
+@click.argument("results", type=click.Path(exists=True, dir_okay=False))
+def compare(baseline, results):
+    """Compare the RESULTS of a run to the BASELINE run."""
+    with open(baseline) as fo:
+        baseline = json.load(fo)
+    with open(results) as fo:
+        results = json.load(fo)
+    click.echo(f"{baseline['commit']} -> {results['commit']}")
+    for name, change in compare_results(baseline, results).items():
+        click.echo(f"{name:<24} " + "  ".join(
+            f"{metric} {'n/a' if value is None else f'{value:+.1%}'}"
+            for metric, value in change.items()))
+
+
+if __name__ == "__main__":
+    cli()
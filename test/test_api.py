@@ -50,6 +50,22 @@ class TestDev:
         promise = views.load_cityjsonfeature(feature_id)
         assert feature_id in dict(promise)["CityObjects"]
 
+    def test_collections_pand_items_batch(self, client):
+        """Should drop the duplicates and omit the unknown featureIDs."""
+        feature_id = views.DEFAULT_FEATURE_SET[0]
+        response = client.post(
+            "/collections/pand/items/batch",
+            json={"ids": [feature_id, feature_id, "NL.IMBAG.Pand.0"]})
+        assert response.status_code == 200
+        assert [f["id"] for f in response.get_json()["features"]] == \
+            [feature_id]
+        response = client.post("/collections/pand/items/batch",
+                               json={"ids": ["NL.IMBAG.Pand.0", "a b"]})
+        assert response.status_code == 400
+        response = client.post("/collections/pand/items/batch?limit=5",
+                               json={"ids": [feature_id]})
+        assert response.status_code == 400
+
 
 class TestOnPodzilla:
     def test_collections_pand_items_bbox(self, app, authorization):
@@ -81,3 +97,26 @@ class TestOnPodzilla:
             assert response.status_code == 200
             print(len(response.get_json()["features"]))
 
+    def test_collections_pand_items_bbox_hits(self, app, authorization):
+        """Very large area in Den Haag, only the number of features"""
+        bbox = "75877.011,446130.034,92446.593,460259.369"
+        with app.test_request_context("/collections/pand/items",
+                                      headers=authorization,
+                                      query_string={"bbox": bbox,
+                                                    "resulttype": "hits"}):
+            response = views.pand_items().get_json()
+            assert response["numberReturned"] == 0
+            assert response["numberMatched"] > 0
+
+    def test_collections_pand_items_not_modified(self, client):
+        """Should only answer 304 to the requests that would get a 200."""
+        headers = {"If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"}
+        response = client.get("/collections/pand/items", headers=headers)
+        assert response.status_code == 304
+        for query_string in ({"foo": "bar"}, {"limit": -5}):
+            response = client.get("/collections/pand/items",
+                                  headers=headers, query_string=query_string)
+            assert response.status_code == 400
+        response = client.get("/collections/pand/items/NL.IMBAG.Pand.0",
+                              headers=headers)
+        assert response.status_code == 404
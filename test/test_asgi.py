@@ -0,0 +1,67 @@
+"""
+Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
+"""
+
+import asyncio
+import json
+
+from app import asgi
+
+
+def call(path, query=b"", headers=()):
+    """Send a request to the ASGI app, and collect the response."""
+    scope = {"type": "http", "asgi": {"version": "3.0"},
+             "http_version": "1.1", "method": "GET", "scheme": "http",
+             "path": path, "query_string": query, "root_path": "",
+             "headers": list(headers), "client": ("127.0.0.1", 1234),
+             "server": ("localhost", 80)}
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(asgi.application(scope, receive, send))
+    headers = {k.decode(): v.decode() for k, v in messages[0]["headers"]}
+    return (messages[0]["status"], headers,
+            b"".join(m.get("body", b"") for m in messages[1:]))
+
+
+def test_wsgi_environ():
+    environ = asgi.wsgi_environ({
+        "type": "http", "method": "GET", "path": "/api/collections",
+        "root_path": "/api", "query_string": b"f=json",
+        "headers": [(b"content-type", b"application/json"),
+                    (b"accept", b"text/html"), (b"accept", b"*/*")]})
+    assert environ["SCRIPT_NAME"] == "/api"
+    assert environ["PATH_INFO"] == "/collections"
+    assert environ["QUERY_STRING"] == "f=json"
+    assert environ["CONTENT_TYPE"] == "application/json"
+    assert environ["HTTP_ACCEPT"] == "text/html,*/*"
+
+
+def test_asgi_items():
+    status, headers, body = call("/collections/pand/items", b"limit=2")
+    assert status == 200
+    assert json.loads(body)["numberReturned"] == 2
+    # The stages in the threads of the executor are timed too
+    stages = [m.split(";")[0] for m in headers["server-timing"].split(", ")]
+    assert "export" in stages or "store" in stages
+    status, _, _ = call("/collections/pand/items", b"limit=2",
+                        [(b"if-none-match", headers["etag"].encode())])
+    assert status == 304
+    status, _, body = call("/collections/pand/items", b"limit=2&foo=1")
+    assert status == 400
+    assert json.loads(body)["code"] == 400
+    status, _, _ = call("/collections/pand/items", b"limit=-5",
+                        [(b"if-none-match", headers["etag"].encode())])
+    assert status == 400
+
+
+def test_asgi_fallback():
+    """Should serve the other routes with the Flask app."""
+    status, _, body = call("/conformance")
+    assert status == 200
+    assert "conformsTo" in json.loads(body)
@@ -0,0 +1,66 @@
+"""
+Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
+"""
+
+from app.authentication import (ApiKeyIndex, AuthenticatedUser,
+                                CredentialCache, Permission, hash_api_key)
+
+
+def test_hash_api_key():
+    assert hash_api_key("abc") == hash_api_key("abc")
+    assert hash_api_key("abc") != hash_api_key("abd")
+    assert len(hash_api_key("abc")) == 64
+
+
+def test_credential_cache():
+    """Should only return the user for the verified password, until the TTL
+    expires."""
+    user = AuthenticatedUser("balazs", Permission.USER)
+    cache = CredentialCache(ttl=60)
+    cache.add("balazs", "1234", user)
+    assert cache.get("balazs", "1234") is user
+    assert cache.get("balazs", "4321") is None
+    assert cache.get("gina", "1234") is None
+    cache.clear()
+    assert cache.get("balazs", "1234") is None
+    expired = CredentialCache(ttl=-1)
+    expired.add("balazs", "1234", user)
+    assert expired.get("balazs", "1234") is None
+
+
+class FakeApiKeyIndex(ApiKeyIndex):
+    """An ApiKeyIndex of the keys in `keys`, instead of the DB."""
+
+    def __init__(self, keys, **kwargs):
+        super().__init__(**kwargs)
+        self.keys = keys
+        self.queries = []
+
+    def query(self, key_hash=None):
+        self.queries.append(key_hash)
+        return {h: user for h, user in self.keys.items()
+                if key_hash is None or h == key_hash}
+
+
+def test_api_key_index():
+    """Should find the keys that were added after the index was loaded,
+    and only query the DB once for an unknown key, until the negative TTL
+    expires."""
+    user = AuthenticatedUser("balazs", Permission.USER)
+    index = FakeApiKeyIndex({hash_api_key("abc"): user}, ttl=60,
+                            negative_ttl=60)
+    assert index.get("abc") is user
+    assert index.queries == [None]
+    new_user = AuthenticatedUser("gina", Permission.USER)
+    index.keys[hash_api_key("def")] = new_user
+    assert index.get("def") is new_user
+    assert index.get("def") is new_user
+    assert index.queries == [None, hash_api_key("def")]
+    assert index.get("xyz") is None
+    assert index.get("xyz") is None
+    assert index.queries == [None, hash_api_key("def"), hash_api_key("xyz")]
+    expired = FakeApiKeyIndex({}, ttl=60, negative_ttl=-1)
+    assert expired.get("xyz") is None
+    assert expired.get("xyz") is None
+    assert expired.queries == [None, hash_api_key("xyz"),
+                               hash_api_key("xyz")]
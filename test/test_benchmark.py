@@ -0,0 +1,43 @@
+"""
+Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
+"""
+
+import gzip
+
+import pytest
+
+from profiling.benchmark import compare_results, next_link, summarize
+
+
+def test_summarize():
+    """Should report the throughput, the errors and the latency percentiles
+    in milliseconds."""
+    latencies = [i / 1000 for i in range(1, 101)]
+    statuses = [200] * 98 + [404, 500]
+    summary = summarize(latencies, statuses, [10] * 100, elapsed=2.0)
+    assert summary["requests"] == 100
+    assert summary["errors"] == 2
+    assert summary["statuses"] == {"200": 98, "404": 1, "500": 1}
+    assert summary["throughput_rps"] == 50
+    assert summary["bytes_per_s"] == 500
+    assert summary["p50_ms"] == pytest.approx(50.5)
+    assert summary["p99_ms"] == pytest.approx(99.01)
+    assert summarize([], [], [], elapsed=1.0)["requests"] == 0
+
+    baseline = {"scenarios": {"bbox": summary}}
+    faster = {"scenarios": {"bbox": dict(summary, p50_ms=25.25,
+                                         throughput_rps=100),
+                            "new": summary}}
+    change = compare_results(baseline, faster)
+    assert list(change) == ["bbox"]
+    assert change["bbox"]["p50_ms"] == pytest.approx(-0.5)
+    assert change["bbox"]["throughput_rps"] == pytest.approx(1.0)
+
+
+def test_next_link():
+    """Should find the next page in a compressed page."""
+    page = b'{"links": [{"rel": "self", "href": "a"}, ' \
+           b'{"rel": "next", "href": "b"}]}'
+    assert next_link(page) == "b"
+    assert next_link(gzip.compress(page), "gzip") == "b"
+    assert next_link(b'{"links": []}') is None
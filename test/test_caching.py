@@ -0,0 +1,102 @@
+"""
+Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
+"""
+
+from datetime import datetime, timezone
+
+import pytest
+from flask import abort, request
+from werkzeug.exceptions import NotFound
+
+from app.caching import (conditional, dataset_last_modified, make_etag,
+                         static, static_documents)
+
+
+def test_dataset_last_modified():
+    assert dataset_last_modified("v2023.10.08") == datetime(
+        2023, 10, 8, tzinfo=timezone.utc)
+    assert dataset_last_modified("latest") is None
+
+
+def test_make_etag(app):
+    """Should not depend on the order of the query parameters."""
+    with app.test_request_context("/collections/pand/items?limit=5&bbox=1"):
+        etag = make_etag()
+    with app.test_request_context("/collections/pand/items?bbox=1&limit=5"):
+        assert make_etag() == etag
+    with app.test_request_context("/collections/pand/items?bbox=1&limit=6"):
+        assert make_etag() != etag
+    with app.test_request_context("/collections/pand/items?bbox=1&limit=5"):
+        assert make_etag("v2024.01.01") != etag
+
+
+def test_conditional(app):
+    """Should answer with 304 without calling the view."""
+    calls = []
+
+    @conditional
+    def pand_items():
+        calls.append(1)
+        return {"type": "FeatureCollection"}
+
+    with app.test_request_context("/collections/pand/items"):
+        response = pand_items()
+        assert response.status_code == 200
+        assert response.headers["Cache-Control"] == "public, max-age=86400"
+        etag = response.headers["ETag"]
+    with app.test_request_context("/collections/pand/items",
+                                  headers={"If-None-Match": etag}):
+        assert pand_items().status_code == 304
+    with app.test_request_context(
+            "/collections/pand/items",
+            headers={"If-Modified-Since": "Mon, 09 Oct 2023 00:00:00 GMT"}):
+        assert pand_items().status_code == 304
+    assert len(calls) == 1
+
+
+def test_conditional_validate(app):
+    """Should not answer with 304 to invalid requests."""
+    @conditional(validate=lambda featureId: abort(404))
+    def get_feature(featureId):
+        return {"id": featureId}
+
+    with app.test_request_context(
+            "/collections/pand/items/x",
+            headers={"If-Modified-Since": "Mon, 09 Oct 2023 00:00:00 GMT"}):
+        with pytest.raises(NotFound):
+            get_feature("x")
+
+
+def test_static(app):
+    """Should render a document once per host, with a strong ETag, which
+    matches the ETags of the compressed responses."""
+    calls = []
+
+    @static
+    def conformance():
+        calls.append(1)
+        return {"href": request.url_root}
+
+    static_documents.clear()
+    with app.test_request_context("/conformance"):
+        response = conformance()
+        etag = response.headers["ETag"]
+        assert not etag.startswith("W/")
+        assert response.headers["Cache-Control"] == "public, max-age=3600"
+    with app.test_request_context("/conformance",
+                                  headers={"If-None-Match": etag}):
+        assert conformance().status_code == 304
+    gzip_etag = f'{etag[:-1]}-gzip"'
+    with app.test_request_context("/conformance",
+                                  headers={"If-None-Match": gzip_etag}):
+        response = conformance()
+        assert response.status_code == 304
+        assert response.headers["ETag"] == gzip_etag
+    with app.test_request_context("/conformance"):
+        assert conformance().get_json() == {"href": "http://localhost/"}
+    with app.test_request_context("/conformance",
+                                  base_url="https://example.com/api"):
+        assert conformance().get_json() == {
+            "href": "https://example.com/api/"}
+    assert len(calls) == 2
+    static_documents.clear()
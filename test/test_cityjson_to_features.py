@@ -0,0 +1,44 @@
+"""
+Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
+"""
+
+from data_prepare.cityjson_to_features import (split_features,
+                                               tile_id_from_filename)
+
+
+def test_split_features():
+    """Should make a feature per root CityObject, with its children and only
+    the vertices that they use."""
+    j = {
+        "CityObjects": {
+            "NL.IMBAG.Pand.0001": {"type": "Building",
+                                   "children": ["NL.IMBAG.Pand.0001-0"]},
+            "NL.IMBAG.Pand.0001-0": {
+                "type": "BuildingPart",
+                "parents": ["NL.IMBAG.Pand.0001"],
+                "geometry": [{"type": "MultiSurface", "lod": "1.2",
+                              "boundaries": [[[4, 2, 0]], [[0, 2, 4]]]}]},
+            "NL.IMBAG.Pand.0002": {
+                "type": "Building",
+                "geometry": [{"type": "MultiSurface", "lod": "0",
+                              "boundaries": [[[1, 3, 5]]]}]},
+        },
+        "vertices": [[i, i, i] for i in range(6)],
+    }
+    features = list(split_features(j))
+    assert [f["id"] for f in features] == [
+        "NL.IMBAG.Pand.0001", "NL.IMBAG.Pand.0002"]
+    assert list(features[0]["CityObjects"]) == [
+        "NL.IMBAG.Pand.0001", "NL.IMBAG.Pand.0001-0"]
+    part = features[0]["CityObjects"]["NL.IMBAG.Pand.0001-0"]
+    assert part["geometry"][0]["boundaries"] == [[[0, 1, 2]], [[2, 1, 0]]]
+    assert features[0]["vertices"] == [[4, 4, 4], [2, 2, 2], [0, 0, 0]]
+    assert features[1]["vertices"] == [[1, 1, 1], [3, 3, 3], [5, 5, 5]]
+    # The tile is not modified
+    assert j["CityObjects"]["NL.IMBAG.Pand.0002"]["geometry"][0][
+        "boundaries"] == [[[1, 3, 5]]]
+
+
+def test_tile_id_from_filename():
+    assert tile_id_from_filename(
+        "tiles/3dbag_v21031_7425c21b_5910.city.json.gz") == "5910"
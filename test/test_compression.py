@@ -0,0 +1,55 @@
+"""
+Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
+"""
+
+import gzip
+
+from flask import Response
+
+from werkzeug.datastructures import Accept
+from werkzeug.http import parse_accept_header
+
+from app.compression import (ENCODINGS, CompressedStore, compress,
+                             compress_stream, encode_etag, negotiate)
+
+
+def test_negotiate():
+    """Should pick the accepted encoding with the highest quality."""
+    def accept(header):
+        return parse_accept_header(header, Accept)
+    assert negotiate(accept("gzip, deflate")) == "gzip"
+    assert negotiate(accept("identity")) is None
+    assert negotiate(accept("*")) == ENCODINGS[0]
+    assert negotiate(accept("gzip;q=1.0, *;q=0.5")) == "gzip"
+    assert negotiate(accept("gzip;q=0, deflate")) is None
+
+
+def test_compress():
+    data = b'{"type":"FeatureCollection","features":[]}' * 100
+    assert gzip.decompress(compress(data, "gzip")) == data
+    chunks = [data[:1000].decode("utf-8"), data[1000:]]
+    assert gzip.decompress(b"".join(compress_stream(chunks, "gzip"))) == data
+
+
+def test_compressed_store():
+    """Should evict the least recently used bodies."""
+    store = CompressedStore(max_bytes=20)
+    store.add("a", "gzip", b"0123456789", {})
+    store.add("b", "gzip", b"0123456789", {})
+    assert store.get("a", "gzip") == (b"0123456789", {}, {})
+    store.add("c", "gzip", b"0123456789", {})
+    assert store.get("b", "gzip") is None
+    assert store.get("a", "br") is None
+    assert len(store) == 2
+
+
+def test_encode_etag():
+    """Should add the encoding to strong ETags only."""
+    response = Response()
+    response.set_etag("abc", weak=False)
+    encode_etag(response, "gzip")
+    assert response.headers["ETag"] == '"abc-gzip"'
+    response = Response()
+    response.set_etag("abc", weak=True)
+    encode_etag(response, "gzip")
+    assert response.headers["ETag"] == 'W/"abc"'
@@ -0,0 +1,16 @@
+"""
+Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
+"""
+
+from app.db import Db
+
+
+def test_get_query_sqlite():
+    """Should query a sqlite DB with and without parameters."""
+    db = Db(dbfile=":memory:")
+    db.send_query("CREATE TABLE t (object_id TEXT)")
+    db.send_query("INSERT INTO t VALUES ('a'), ('b')")
+    assert db.get_query("SELECT object_id FROM t ORDER BY object_id") == \
+        [("a",), ("b",)]
+    assert db.get_query("SELECT object_id FROM t WHERE object_id > ?",
+                        ("a",)) == [("b",)]
@@ -0,0 +1,54 @@
+"""
+Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
+"""
+
+import json
+
+import pytest
+
+from app.filestore import FileStore
+from data_prepare.pack_features import load_or_write_store_meta, pack_tile
+
+
+def make_feature(object_id, vertices):
+    return {
+        "type": "CityJSONFeature",
+        "id": object_id,
+        "CityObjects": {object_id: {"type": "Building"}},
+        "vertices": vertices,
+    }
+
+
+def test_file_store(tmp_path):
+    """Should serve the features of several tiles in the transform of the
+    store."""
+    transform_1 = {"scale": [0.001, 0.001, 0.001],
+                   "translate": [1000.0, 2000.0, 0.0]}
+    transform_2 = {"scale": [0.001, 0.001, 0.001],
+                   "translate": [1010.0, 2000.0, 0.0]}
+    meta = load_or_write_store_meta(
+        tmp_path, {"type": "CityJSON", "version": "1.1",
+                   "transform": transform_1})
+    pack_tile("t1", [make_feature("NL.IMBAG.Pand.0002", [[0, 0, 0],
+                                                         [1000, 500, 0]]),
+                     make_feature("NL.IMBAG.Pand.0001", [[5, 5, 5]])],
+              transform_1, meta["transform"], tmp_path)
+    pack_tile("t2", [make_feature("NL.IMBAG.Pand.0003", [[0, 0, 0]])],
+              transform_2, meta["transform"], tmp_path)
+
+    store = FileStore(tmp_path)
+    store.load()
+    assert tuple(store.object_ids) == (
+        "NL.IMBAG.Pand.0001", "NL.IMBAG.Pand.0002", "NL.IMBAG.Pand.0003")
+    assert store.envelope_rows()[1] == (
+        "NL.IMBAG.Pand.0002", 1000.0, 2000.0, 1001.0, 2000.5)
+    metadata, features = store.load_features_raw(
+        ["NL.IMBAG.Pand.0003", "NL.IMBAG.Pand.9999", "NL.IMBAG.Pand.0001"])
+    assert json.loads(metadata)["transform"] == transform_1
+    assert [json.loads(f)["id"] for f in features] == [
+        "NL.IMBAG.Pand.0003", "NL.IMBAG.Pand.0001"]
+    # Converted from the transform of the second tile
+    assert json.loads(features[0])["vertices"] == [[10000, 0, 0]]
+    assert store.load_features_raw(["NL.IMBAG.Pand.9999"]) == (None, [])
+    with pytest.raises(KeyError):
+        store.load_feature("NL.IMBAG.Pand.9999")
@@ -5,8 +5,16 @@ Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Bal
 import json
 from pathlib import Path
 
+import numpy as np
+from shapely import box
+
 from app.db import Db
-from app.index import get_features_in_bbox, morton_code, take_closest
+from app.index import (BBOXCache, BBOXIndex, IndexedIds, MortonIndex,
+                       MortonOrder, ObjectIdSet, TileIndex,
+                       get_features_in_bbox, morton_code,
+                       morton_code_array, page_after, rev_morton_code,
+                       rev_morton_code_array, sizeof_feature_subset,
+                       take_closest)
 
 
 def test_bbox_within_tile():
@@ -67,3 +75,162 @@ def test_features_in_bbox_verylarge(app):
     feature_subset = get_features_in_bbox(DB, bbox)
     print(len(feature_subset))
     DB.conn.close()
+
+
+def test_bbox_index():
+    """Should return the ids of the footprints in the BBOX, by object_id."""
+    rows = [
+        ("NL.IMBAG.Pand.0001", 0.0, 0.0, 1.0, 1.0),
+        ("NL.IMBAG.Pand.0002", 2.0, 2.0, 3.0, 3.0),
+        ("NL.IMBAG.Pand.0003", 0.5, 0.5, 2.5, 2.5),
+    ]
+    bbox_index = BBOXIndex(envelopes=True)
+    bbox_index.build(rows)
+    assert bbox_index.loaded
+    assert bbox_index.query((0.8, 0.8, 2.1, 2.1)) == (
+        "NL.IMBAG.Pand.0001", "NL.IMBAG.Pand.0002", "NL.IMBAG.Pand.0003")
+    assert bbox_index.query((2.6, 0.0, 3.0, 1.0)) == ()
+    assert bbox_index.query((2.6, 2.6, 3.0, 3.0)) == ("NL.IMBAG.Pand.0002",)
+
+
+def test_indexed_ids():
+    """Should list and count the features of a BBOX from the index, without
+    a tuple of the ids."""
+    rows = [(f"NL.IMBAG.Pand.{i:04d}", float(i), 0.0, i + 0.5, 0.5)
+            for i in range(10)]
+    bbox_index = BBOXIndex(envelopes=True)
+    bbox_index.build(rows)
+    bbox = (2.2, 0.0, 6.2, 1.0)
+    subset = get_features_in_bbox(None, bbox, bbox_index)
+    assert isinstance(subset, IndexedIds)
+    assert len(subset) == bbox_index.count(bbox) == 5
+    assert tuple(subset) == bbox_index.query(bbox)
+    assert subset[1:3] == ("NL.IMBAG.Pand.0003", "NL.IMBAG.Pand.0004")
+    assert page_after(subset, "NL.IMBAG.Pand.0004", 2) == (
+        ("NL.IMBAG.Pand.0005", "NL.IMBAG.Pand.0006"), False)
+    # The cursor does not need to be in the subset
+    assert page_after(subset, "NL.IMBAG.Pand.0000", 1) == (
+        ("NL.IMBAG.Pand.0002",), True)
+    bbox_cache = BBOXCache(bbox_index)
+    assert bbox_cache.count(None, bbox) == (5, True)
+
+
+def test_tile_index():
+    """Should return the same ids as the BBOX index, also for the features
+    that cross a tile edge."""
+    rows = [
+        ("NL.IMBAG.Pand.0001", 0.0, 0.0, 1.0, 1.0),
+        ("NL.IMBAG.Pand.0002", 2.0, 2.0, 3.0, 3.0),
+        ("NL.IMBAG.Pand.0003", 0.5, 0.5, 2.5, 2.5),
+        ("NL.IMBAG.Pand.0004", 1.5, 1.5, 2.5, 2.5),
+    ]
+    bbox_index = BBOXIndex(envelopes=True)
+    bbox_index.build(rows)
+    tiles = [(i, (box(x, y, x + 2.0, y + 2.0), f"{x:.0f}-{y:.0f}"))
+             for i, (x, y) in enumerate(((0.0, 0.0), (2.0, 0.0),
+                                         (0.0, 2.0), (2.0, 2.0)))]
+    tile_index = TileIndex(bbox_index)
+    tile_index.build(tiles)
+    assert tile_index.loaded
+    assert len(tile_index) == 4
+    for bbox in ((0.8, 0.8, 2.1, 2.1), (2.6, 0.0, 3.0, 1.0),
+                 (2.6, 2.6, 3.0, 3.0), (2.2, 0.5, 3.5, 1.9),
+                 (-1.0, -1.0, 5.0, 5.0)):
+        assert tile_index.query(bbox) == bbox_index.query(bbox)
+        assert tile_index.count(bbox) == bbox_index.count(bbox)
+
+
+def test_bbox_cache():
+    """Should keep several BBOXes and evict the least recently used ones."""
+    subset = tuple(f"NL.IMBAG.Pand.{i:016d}" for i in range(10))
+    bbox_cache = BBOXCache(max_bytes=2 * sizeof_feature_subset(subset))
+    bbox_1 = BBOXCache.key((1.0, 1.0, 2.0, 2.0))
+    bbox_2 = BBOXCache.key((2.0, 2.0, 3.0, 3.0))
+    bbox_3 = BBOXCache.key((3.0, 3.0, 4.0, 4.0))
+    bbox_cache.add(subset, bbox_1)
+    bbox_cache.add(subset, bbox_2)
+    # conn is not used on a cache hit
+    assert bbox_cache.get(None, (1.0, 1.0, 2.0, 2.0)) is subset
+    bbox_cache.add(subset, bbox_3)
+    assert len(bbox_cache) == 2
+    assert bbox_cache.get(None, (1.0001, 1.0, 2.0, 2.0)) is subset
+    stats = bbox_cache.stats()
+    assert stats["hits"] == 2
+    assert stats["evictions"] == 1
+
+
+def test_page_after():
+    """Should return the page that follows the featureID of the cursor."""
+    features = tuple(f"NL.IMBAG.Pand.{i:016d}" for i in range(25))
+    page, has_next = page_after(features, None, 10)
+    assert page == features[:10]
+    assert has_next
+    page, has_next = page_after(features, page[-1], 10)
+    assert page == features[10:20]
+    page, has_next = page_after(features, page[-1], 10)
+    assert page == features[20:]
+    assert not has_next
+
+
+def test_object_id_set(tmp_path):
+    """Should behave as a sorted sequence of object ids."""
+    object_ids = ["NL.IMBAG.Pand.0002-0", "NL.IMBAG.Pand.0003",
+                  "NL.IMBAG.Pand.0001", "NL.IMBAG.Pand.0002"]
+    id_set = ObjectIdSet.from_ids(object_ids)
+    assert len(id_set) == 4
+    assert tuple(id_set) == tuple(sorted(object_ids))
+    assert id_set[1] == "NL.IMBAG.Pand.0002"
+    assert id_set[1:3] == ("NL.IMBAG.Pand.0002", "NL.IMBAG.Pand.0002-0")
+    assert "NL.IMBAG.Pand.0002-0" in id_set
+    assert "NL.IMBAG.Pand.0004" not in id_set
+    assert id_set.index("NL.IMBAG.Pand.0003") == 3
+    page, has_next = page_after(id_set, "NL.IMBAG.Pand.0002", 1)
+    assert page == ("NL.IMBAG.Pand.0002-0",)
+    assert has_next
+    id_set.save(tmp_path / "ids.npy")
+    assert tuple(ObjectIdSet.load(tmp_path / "ids.npy")) == tuple(id_set)
+
+
+def test_morton_order():
+    """Should page through the features in Morton order."""
+    id_set = ObjectIdSet.from_ids(f"NL.IMBAG.Pand.{i:04d}" for i in range(4))
+    centroids = [(1.0, 1.0), (0.0, 0.0), (1.0, 0.0), (0.0, 1.0)]
+    keys = np.array([morton_code(*c) for c in centroids], dtype=np.uint64)
+    morton_order = MortonOrder(id_set, keys)
+    features = morton_order.all()
+    assert tuple(features) == ("NL.IMBAG.Pand.0001", "NL.IMBAG.Pand.0002",
+                               "NL.IMBAG.Pand.0003", "NL.IMBAG.Pand.0000")
+    page, has_next = page_after(features, "NL.IMBAG.Pand.0002", 2)
+    assert page == ("NL.IMBAG.Pand.0003", "NL.IMBAG.Pand.0000")
+    assert not has_next
+    subset = morton_order.sort(("NL.IMBAG.Pand.0000", "NL.IMBAG.Pand.0001"))
+    assert tuple(subset) == ("NL.IMBAG.Pand.0001", "NL.IMBAG.Pand.0000")
+
+
+def test_morton_code_array():
+    """Should compute the same keys as morton_code."""
+    x = np.array([68194.423, 85494.901, 10000.0])
+    y = np.array([395606.054, 456719.503, 623690.0])
+    codes = morton_code_array(x, y)
+    assert codes.tolist() == [morton_code(*p) for p in zip(x, y)]
+    x_rev, y_rev = rev_morton_code_array(codes)
+    assert x_rev.tolist() == [rev_morton_code(int(c))[0] for c in codes]
+    assert y_rev.tolist() == [rev_morton_code(int(c))[1] for c in codes]
+
+
+def test_morton_index():
+    """Should return the same features as the envelope BBOXIndex."""
+    rows = [
+        (f"NL.IMBAG.Pand.{i:04d}", x, y, x + 20.0, y + 15.0)
+        for i, (x, y) in enumerate(
+            (x, y) for x in range(77000, 78000, 35)
+            for y in range(450000, 451000, 45))
+    ]
+    morton_index = MortonIndex()
+    morton_index.build(rows)
+    bbox_index = BBOXIndex(envelopes=True)
+    bbox_index.build(rows)
+    for bbox in ((77100.5, 450100.5, 77400.0, 450333.3),
+                 (76000.0, 449000.0, 77001.0, 450001.0),
+                 (80000.0, 460000.0, 80001.0, 460001.0)):
+        assert morton_index.query(bbox) == bbox_index.query(bbox)
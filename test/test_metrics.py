@@ -0,0 +1,36 @@
+"""
+Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
+"""
+
+import pytest
+
+prometheus_client = pytest.importorskip("prometheus_client")
+
+from app.metrics import StatsSync  # noqa: E402
+
+
+def test_metrics(client):
+    """Should serve the latency of the routes and the cache lookups."""
+    assert client.get("/conformance").status_code == 200
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    text = response.get_data(as_text=True)
+    assert 'api_request_duration_seconds_count{method="GET",' \
+           'route="conformance",status="200"}' in text
+    assert 'api_cache_lookups_total{cache="bbox",result="hit"}' in text
+
+
+def test_stats_sync():
+    """Should add the increase of the statistics to the counters."""
+    registry = prometheus_client.CollectorRegistry()
+    counter = prometheus_client.Counter("lookups", "", ["result"],
+                                        registry=registry)
+    sync = StatsSync()
+    sync.inc(counter, 3, "hit")
+    sync.inc(counter, 5, "hit")
+    assert registry.get_sample_value("lookups_total", {"result": "hit"}) == 5
+    # The statistics of a forked worker start again from 0
+    sync.inc(counter, 0, "hit")
+    sync.inc(counter, 2, "hit")
+    assert registry.get_sample_value("lookups_total", {"result": "hit"}) == 7
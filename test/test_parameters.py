@@ -0,0 +1,36 @@
+"""
+Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
+"""
+
+import pytest
+from werkzeug.exceptions import BadRequest
+
+from app.parameters import (BATCH_MAX_IDS, decode_cursor, encode_cursor,
+                            parse_feature_ids)
+
+
+def test_parse_feature_ids():
+    """Should drop the duplicates and keep the order of the request."""
+    assert parse_feature_ids({"ids": ["b", "a", "b"]}) == ["b", "a"]
+
+
+@pytest.mark.parametrize("body", [
+    None,
+    {"ids": []},
+    {"ids": "NL.IMBAG.Pand.1655100000500573"},
+    {"ids": ["NL.IMBAG.Pand.1655100000500573", "'; DROP TABLE --"]},
+    {"ids": [1]},
+    {"ids": [f"NL.IMBAG.Pand.{i:016d}" for i in range(BATCH_MAX_IDS + 1)]},
+])
+def test_parse_feature_ids_invalid(body):
+    with pytest.raises(BadRequest):
+        parse_feature_ids(body)
+
+
+def test_decode_cursor():
+    """Should decode the cursors that were encoded, and reject the rest."""
+    assert decode_cursor(encode_cursor("NL.IMBAG.Pand.0503100000000010")) \
+        == "NL.IMBAG.Pand.0503100000000010"
+    for cursor in ("!!!", "", "a+b/", "é"):
+        with pytest.raises(ValueError):
+            decode_cursor(cursor)
@@ -0,0 +1,61 @@
+"""
+Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
+"""
+
+import base64
+import pstats
+
+from flask import g
+
+from app import profiler
+from app.authentication import (AuthenticatedUser, Permission,
+                                credential_cache)
+
+
+def test_stage(app):
+    """Should add up the time of the stages of a request in the
+    Server-Timing header."""
+    with app.test_request_context("/collections/pand/items"):
+        with profiler.stage("bbox"):
+            pass
+        with profiler.stage("export"):
+            pass
+        with profiler.stage("bbox"):
+            pass
+        assert set(g.timings) == {"bbox", "export"}
+        response = profiler.server_timing(app.make_response("{}"))
+        metrics = response.headers["Server-Timing"].split(", ")
+        assert [m.split(";")[0] for m in metrics] == ["bbox", "export"]
+    # Outside of a request, the stages are not timed
+    with profiler.stage("bbox"):
+        pass
+
+
+def test_profile_header(client, tmp_path, monkeypatch):
+    """Should only profile the requests of administrators."""
+    monkeypatch.setattr(profiler, "PROFILE_DIR", str(tmp_path))
+    credential_cache.add("admin", "secret", AuthenticatedUser(
+        "admin", Permission.ADMINISTRATOR))
+    credential_cache.add("user", "secret", AuthenticatedUser(
+        "user", Permission.USER))
+
+    def headers(username):
+        credentials = base64.b64encode(f"{username}:secret".encode("utf-8"))
+        return {"Authorization": f"Basic {credentials.decode('ascii')}",
+                "X-Profile": "conformance/slow"}
+
+    # Checking the credentials does not authenticate the request
+    with client.application.test_request_context(
+            "/conformance", headers=headers("admin")):
+        assert profiler.profile_name() == "conformance-slow"
+        assert "current_user" not in g
+    response = client.get("/conformance", headers=headers("user"))
+    assert "total;dur=" in response.headers["Server-Timing"]
+    assert not list(tmp_path.rglob("*.pstat"))
+    client.get("/conformance", headers=headers("admin"))
+    profiles = list(tmp_path.rglob("*.pstat"))
+    assert len(profiles) == 1
+    assert profiles[0].name.endswith(".pstat")
+    assert "_conformance-slow-" in profiles[0].name
+    assert pstats.Stats(str(profiles[0])).total_calls > 0
+    credential_cache.clear()
@@ -0,0 +1,42 @@
+"""
+Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
+"""
+
+from flask import g
+
+from app.authentication import AuthenticatedUser, Permission
+from app.ratelimit import RateLimiter, current_client
+
+
+def test_shared_budget(tmp_path):
+    """Should enforce one budget for the limiters that share a file."""
+    path = tmp_path / "ratelimit"
+    first = RateLimiter(path, nr_slots=16, rate=0.001, burst=3)
+    second = RateLimiter(path, nr_slots=16, rate=0.001, burst=3)
+    assert first.acquire("ip:1") == 0
+    assert second.acquire("ip:1") == 0
+    assert first.acquire("ip:1") == 0
+    assert second.acquire("ip:1") > 0
+    # Other clients have their own bucket
+    assert second.acquire("ip:2") == 0
+
+
+def test_quota(tmp_path):
+    """Should refuse a client that used its daily quota until midnight."""
+    limiter = RateLimiter(tmp_path / "ratelimit", nr_slots=16, rate=100,
+                          burst=100, quota_features=10, quota_bytes=0)
+    assert limiter.acquire("user:a") == 0
+    limiter.charge("user:a", features=10, nbytes=1000)
+    assert limiter.usage("user:a")["features"] == 10
+    assert limiter.acquire("user:a") > 1
+    assert limiter.acquire("user:b") == 0
+
+
+def test_current_client(app):
+    """Should only key the requests of authenticated users on the user."""
+    with app.test_request_context("/collections/pand/items",
+                                  environ_base={"REMOTE_ADDR": "10.0.0.1"}):
+        g.current_user = "victim"
+        assert current_client() == "ip:10.0.0.1"
+        g.flask_httpauth_user = AuthenticatedUser("victim", Permission.USER)
+        assert current_client() == "user:victim"
@@ -0,0 +1,51 @@
+"""
+Copyright (c) 2023 TU Delft 3D geoinformation group, Ravi Peters (3DGI), and Balázs Dukai (3DGI)
+"""
+
+import numpy as np
+import shapely
+
+from app.index import BBOXIndex, MortonIndex, ObjectIdSet
+from app.snapshot import Snapshot, snapshot_key
+
+
+def test_snapshot(tmp_path):
+    """Should rebuild the same indexes from a snapshot."""
+    footprints = BBOXIndex()
+    footprints.build([
+        ("NL.IMBAG.Pand.0001", shapely.to_wkb(shapely.box(0, 0, 1, 1))),
+        ("NL.IMBAG.Pand.0002", shapely.to_wkb(shapely.box(5, 5, 6, 7))),
+    ])
+    envelopes = MortonIndex()
+    envelopes.build([("NL.IMBAG.Pand.0001", 0, 0, 1, 1),
+                     ("NL.IMBAG.Pand.0002", 5, 5, 6, 7)])
+    id_set = ObjectIdSet.from_ids(["NL.IMBAG.Pand.0002",
+                                   "NL.IMBAG.Pand.0001"])
+    arrays = {"object_ids": id_set.ids}
+    arrays.update({f"footprint_{k}": v
+                   for k, v in footprints.arrays().items()})
+    arrays.update({f"morton_{k}": v for k, v in envelopes.arrays().items()})
+
+    key = snapshot_key("v1", bbox_index="footprint")
+    assert key != snapshot_key("v2", bbox_index="footprint")
+    Snapshot(tmp_path, "old").save({"object_ids": id_set.ids})
+    snapshot = Snapshot(tmp_path, key, "v1")
+    assert not snapshot.exists()
+    snapshot.save(arrays)
+    assert snapshot.exists()
+    assert not (tmp_path / "old").exists()
+
+    loaded = snapshot.load()
+    assert tuple(ObjectIdSet(loaded["object_ids"])) == (
+        "NL.IMBAG.Pand.0001", "NL.IMBAG.Pand.0002")
+    restored = BBOXIndex()
+    restored.build_arrays(**{k[10:]: v for k, v in loaded.items()
+                             if k.startswith("footprint_")})
+    assert restored.query([4, 4, 10, 10]) == ("NL.IMBAG.Pand.0002",)
+    # The workers share the memory-mapped object ids
+    assert np.shares_memory(restored.object_ids,
+                            loaded["footprint_object_ids"])
+    restored = MortonIndex()
+    restored.build_arrays(**{k[7:]: v for k, v in loaded.items()
+                             if k.startswith("morton_")})
+    assert restored.query([0.5, 0.5, 2, 2]) == ("NL.IMBAG.Pand.0001",)
@@ -7,7 +7,9 @@ from typing import Tuple
 from pytest import approx
 
 from app.transformations import (transform_bbox_from_default_to_storage,
-                                 transform_bbox_from_storage_to_default)
+                                 transform_bbox_from_storage_to_default,
+                                 transform_cityjsonfeatures,
+                                 translate_cityjsonfeatures)
 
 BBOX_28992: Tuple[float, float, float, float] = (
     13593.338,
@@ -32,3 +34,39 @@ def test_transform_bbox_from_default_to_storage():
 def test_transform_bbox_from_storage_to_default():
     new_box = transform_bbox_from_storage_to_default(BBOX_28992)
     assert new_box == approx(BBOX_CRS84)
+
+
+def test_transform_cityjsonfeatures():
+    metadata = {
+        "transform": {"scale": [0.001, 0.001, 0.001],
+                      "translate": [BBOX_28992[0], BBOX_28992[1], 0.0]},
+        "metadata": {
+            "referenceSystem": "https://www.opengis.net/def/crs/EPSG/0/7415"
+        },
+    }
+    features = [{"vertices": [[0, 0, 1500]]},
+                {"vertices": [[256000000, 0, 2500]]}]
+    metadata, features = transform_cityjsonfeatures(
+        metadata, features, "OGC:CRS84",
+        "http://www.opengis.net/def/crs/OGC/1.3/CRS84")
+    scale = metadata["transform"]["scale"]
+    translate = metadata["transform"]["translate"]
+    vertices = [[v[i] * scale[i] + translate[i] for i in range(3)]
+                for f in features for v in f["vertices"]]
+    assert vertices[0] == approx([BBOX_CRS84[0], BBOX_CRS84[1], 1.5])
+    assert vertices[1] == approx([BBOX_CRS84[2], BBOX_CRS84[3], 2.5])
+    assert metadata["metadata"]["referenceSystem"] == \
+        "http://www.opengis.net/def/crs/OGC/1.3/CRS84"
+
+
+def test_translate_cityjsonfeatures():
+    """Should keep the coordinates of the vertices."""
+    metadata = {"transform": {"scale": [0.001, 0.001, 0.001],
+                              "translate": [85000.0, 447000.0, 0.0]}}
+    features = [{"vertices": [[0, 0, 0], [1000, 2000, 3000]]},
+                {"vertices": []}]
+    metadata, features = translate_cityjsonfeatures(
+        metadata, features, [84999.5, 447001.0, 0.0])
+    assert metadata["transform"]["translate"] == [84999.5, 447001.0, 0.0]
+    assert features[0]["vertices"] == [[500, -1000, 0], [1500, 1000, 3000]]
+    assert features[1]["vertices"] == []